@@ -0,0 +1,865 @@
+# Benchmarks for the hot paths of the bot. Run directly with
+#   python3 bench.py
+# to run them all, or with
+#   python3 bench.py --json results.json
+# to only run the suite (see suite), which times the board, store, render
+# and queue paths over synthetic games and writes the results to
+# results.json as well as printing them, and with
+#   python3 bench.py --compare old.json new.json
+# to compare two such files. No Telegram token is needed, everything runs
+# locally.
+
+# So we can get our arguments
+import sys
+
+# For timing
+from time import perf_counter, monotonic, sleep, process_time
+
+# For reproducible games
+import random
+
+# For the suite's results
+import json
+import os
+import platform
+from datetime import datetime, timezone
+
+# To size the checkpoint cache
+import pickle
+
+# The things we're timing
+from board import Board, Empty, codes, orderMoves, moveKey
+from store import Store
+import events
+
+# Plays a random game of the given number of moves on a fresh board,
+# alternating colors and only picking open spaces. Yields each event as it
+# would be handed to Board.addEvent.
+def randomGame (size, moves, seed=0):
+    rng = random.Random(seed)
+    board = Board(size)
+    players = ["Black", "White"]
+    for i in range(moves):
+        spaces = [(r, c) for r in range(size) for c in range(size)
+                  if board.get(r, c) == Empty]
+        if len(spaces) == 0:
+            return
+        row, col = rng.choice(spaces)
+        evt = (i, events.move, (players[i % 2], row, col))
+        board.addEvent(evt)
+        yield evt
+
+# Times Board.addEvent over a growing game, reporting the average cost per
+# move in buckets so that growth (or the lack of it) is visible. The replay
+# column is what every move used to cost: a full buildGame of the journal.
+def benchAddEvent (size=19, moves=300, bucket=50):
+    print("addEvent on %dx%d, per move cost by game length" % (size, size))
+    print("%10s %14s %14s" % ("moves", "addEvent (us)", "replay (us)"))
+    board = Board(size)
+    spent = 0.0
+    replayed = 0.0
+    for i, evt in enumerate(randomGame(size, moves)):
+        start = perf_counter()
+        board.addEvent(evt)
+        spent += perf_counter() - start
+
+        start = perf_counter()
+        board.buildGame(board.store.log())
+        replayed += perf_counter() - start
+
+        if (i + 1) % bucket == 0:
+            print("%10d %14.1f %14.1f" % (i + 1, spent / bucket * 1e6,
+                                          replayed / bucket * 1e6))
+            spent = 0.0
+            replayed = 0.0
+
+# Times a burst of undoes at the end of a long game for several checkpoint
+# settings of the Store, along with how much memory the checkpoints take
+# (measured as their pickled size). A max of 0 turns them off.
+def benchUndo (size=19, moves=300, undoes=20):
+    print("%d undoes after %d moves on %dx%d" % (undoes, moves, size, size))
+    print("%10s %8s %14s %14s" % ("interval", "max", "per undo (us)",
+                                  "cache (bytes)"))
+    game = list(randomGame(size, moves))
+    for (interval, maxCheckpoints) in [(16, 0), (64, 4), (16, 32), (4, 128)]:
+        board = Board(size)
+        board.store.setCheckpoints(interval, maxCheckpoints)
+        for evt in game:
+            board.addEvent(evt)
+        cached = len(pickle.dumps(list(board.store.checkpoints.values())))
+        start = perf_counter()
+        for i in range(undoes):
+            board.addEvent((moves + i, events.undo, None))
+        spent = perf_counter() - start
+        print("%10d %8d %14.1f %14d" % (interval, maxCheckpoints,
+                                        spent / undoes * 1e6, cached))
+
+# The board sizes games can be played on (see processing.confirm_resize)
+sizes = (7, 9, 13, 17, 19)
+
+# Generates a game of about moves moves on a size board, as the events of
+# its updates in the order they arrive. It's made to look like a real
+# game: moves are legal, and half of them are played next to one of the
+# other player's stones, so there are captures. After a move there's a
+# chance of a burst of undos (of up to undoBurst). Update ids are handed
+# out in order, but one in lateEvery events arrives up to late places
+# after it should.
+def syntheticGame (size, moves, seed=0, undoChance=0.04, undoBurst=4,
+                   lateEvery=20, late=5):
+    rng = random.Random(seed)
+    board = Board(size)
+    players = ["Black", "White"]
+    evts = []
+    played = 0
+    while played < moves:
+        player = players[len(board.moves) % 2]
+        spaces = [(r, c) for r in range(size) for c in range(size)
+                  if board.get(r, c) == Empty]
+        if len(spaces) == 0:
+            break
+        near = [(r, c) for (r, c) in spaces
+                if any(board.get(r + dr, c + dc) == players[1 - players.index(player)]
+                       for (dr, dc) in [(0, 1), (1, 0), (0, -1), (-1, 0)])]
+        if len(near) > 0 and rng.random() < 0.5:
+            (row, col) = rng.choice(near)
+        else:
+            (row, col) = rng.choice(spaces)
+        evts.append((len(evts), events.move, (player, row, col)))
+        board.addEvent(evts[-1])
+        played += 1
+        if rng.random() < undoChance:
+            for i in range(rng.randint(1, undoBurst)):
+                evts.append((len(evts), events.undo, None))
+                board.addEvent(evts[-1])
+    # Some arrive late
+    for i in range(0, len(evts), lateEvery):
+        j = min(len(evts) - 1, i + rng.randint(1, late))
+        evts.insert(j, evts.pop(i))
+    return evts
+
+# The update ids of count events in the order they arrive: in order, with
+# one in twenty arriving up to late places late, or shuffled
+def arrivals (count, order, late=100, seed=0):
+    rng = random.Random(seed)
+    ids = list(range(count))
+    if order == 'shuffled':
+        rng.shuffle(ids)
+    elif order == 'late':
+        for i in range(0, count, 20):
+            j = min(count - 1, i + rng.randrange(1, late))
+            ids.insert(j, ids.pop(i))
+    return ids
+
+# Times Store.insert building journals of count events arriving in order,
+# with some late or shuffled: one at a time with the order function that
+# walks back through the journal, one at a time by key, and as a single
+# bulk_insert. Then a batch of late events (from the last tenth of the ids)
+# is added to a full journal, one at a time and in bulk.
+def benchInsert (count=10000, batch=500):
+    print("Store.insert into %d event journals, per event (us)" % count)
+    print("%-10s %14s %14s %14s" % ("arrival", "orderFunc", "key", "bulk"))
+    for order in ['in order', 'late', 'shuffled']:
+        evts = [(i, events.move, None) for i in arrivals(count, order)]
+        times = []
+        for make in [lambda: Store(orderMoves), lambda: Store(key=moveKey)]:
+            store = make()
+            start = perf_counter()
+            for evt in evts:
+                store.insert(evt)
+            times.append(perf_counter() - start)
+        store = Store(key=moveKey)
+        start = perf_counter()
+        store.bulk_insert(evts)
+        times.append(perf_counter() - start)
+        print("%-10s %14.2f %14.2f %14.2f" % tuple([order] + [t / count * 1e6
+                                                             for t in times]))
+
+    rng = random.Random(0)
+    late = [(count - rng.random() * count / 10, events.move, None)
+            for i in range(batch)]
+    times = []
+    for (make, bulk) in [(lambda: Store(orderMoves), False),
+                         (lambda: Store(key=moveKey), False),
+                         (lambda: Store(key=moveKey), True)]:
+        store = make()
+        for i in range(count):
+            store.insert((i, events.move, None))
+        start = perf_counter()
+        if bulk:
+            store.bulk_insert(late)
+        else:
+            for evt in late:
+                store.insert(evt)
+        times.append(perf_counter() - start)
+    print("%-10s %14.2f %14.2f %14.2f" % tuple(["%d late" % batch] +
+                                               [t / batch * 1e6
+                                                for t in times]))
+
+# Times a full rebuild of a finished game and the average cost of a move
+# (placing the stone and any captures) for the common board sizes, along
+# with the pickled size of the board as saved to disk
+def benchSizes (sizes=(9, 13, 19)):
+    print("%6s %8s %14s %14s %14s" % ("size", "moves", "pickle (bytes)",
+                                      "rebuild (us)", "per move (us)"))
+    for size in sizes:
+        game = list(randomGame(size, size * size))
+        board = Board(size)
+        for evt in game:
+            board.addEvent(evt)
+        pickled = len(pickle.dumps(board, pickle.HIGHEST_PROTOCOL))
+
+        start = perf_counter()
+        board.buildGame(board.store.log())
+        rebuilt = perf_counter() - start
+
+        board.empty()
+        start = perf_counter()
+        for move in board.moves:
+            board.makeMove(move)
+        moved = perf_counter() - start
+
+        print("%6d %8d %14d %14.1f %14.1f" % (size, len(game), pickled,
+                                              rebuilt * 1e6,
+                                              moved / len(board.moves) * 1e6))
+
+# Times drawing a half full board, from scratch (as every image used to be
+# drawn, with the templates, sprites and font thrown away each time), from
+# the cached templates and by patching the previous image after a move,
+# along with the PNG encoding that follows
+def benchRender (sizes=(9, 13, 19), rounds=20):
+    # Only needed here, and it needs PIL
+    import processing
+    from io import BytesIO
+    print("%6s %14s %14s %14s %14s" % ("size", "scratch (ms)",
+                                       "template (ms)", "patch (ms)",
+                                       "encode (ms)"))
+    for size in sizes:
+        board = Board(size)
+        for evt in randomGame(size, size * size // 2):
+            board.addEvent(evt)
+
+        start = perf_counter()
+        for i in range(rounds):
+            processing.label_font = None
+            processing.templates.clear()
+            processing.backgrounds.clear()
+            processing.stones.clear()
+            processing.draw_board(board, 120)
+        scratch = (perf_counter() - start) / rounds
+
+        start = perf_counter()
+        for i in range(rounds):
+            img = processing.draw_board(board, 120)
+        templated = (perf_counter() - start) / rounds
+
+        # Patching needs a move that changes something, so play (and undo)
+        # one on an empty space each round
+        (row, col) = [(r, c) for r in range(size) for c in range(size)
+                      if board.get(r, c) == Empty][0]
+        patched = 0.0
+        for i in range(rounds):
+            board.addEvent((board.applied + 1000, events.move,
+                            ("Black", row, col)))
+            start = perf_counter()
+            processing.patch_board(img, board, 120, board.changed)
+            patched += perf_counter() - start
+            board.addEvent((board.applied + 1000, events.undo, None))
+            processing.patch_board(img, board, 120, board.changed)
+        patched /= rounds
+
+        start = perf_counter()
+        for i in range(rounds):
+            img.save(BytesIO(), 'PNG')
+        encoded = (perf_counter() - start) / rounds
+
+        print("%6d %14.2f %14.2f %14.2f %14.2f" % (size, scratch * 1e3,
+                                                   templated * 1e3,
+                                                   patched * 1e3,
+                                                   encoded * 1e3))
+
+# Saves moves of several games interleaved, as a worker would, to each
+# storage and reports moves saved per second. SQLite is timed committing
+# every move and committing batches of moves at once.
+def benchStorage (chats=20, moves=100, batch=32):
+    # Only needed here
+    import tempfile
+    import os
+    from storage import FileStorage, SQLiteStorage
+    games = [list(randomGame(9, moves, seed=chat)) for chat in range(chats)]
+    print("%-22s %12s" % ("storage", "moves/sec"))
+    for (name, commitEvery) in [('files', 1), ('sqlite', 1),
+                                ('sqlite', batch)]:
+        directory = tempfile.mkdtemp()
+        if name == 'files':
+            storage = FileStorage(directory + '/')
+        else:
+            storage = SQLiteStorage(os.path.join(directory, 'games.db'))
+        boards = [Board(9) for chat in range(chats)]
+        saved = 0
+        start = perf_counter()
+        for i in range(moves):
+            for chat in range(chats):
+                if i >= len(games[chat]):
+                    continue
+                evt = games[chat][i]
+                boards[chat].addEvent(evt)
+                storage.append(chat, boards[chat], [evt])
+                saved += 1
+                if saved % commitEvery == 0:
+                    storage.commit()
+        storage.commit()
+        spent = perf_counter() - start
+        label = name
+        if name == 'sqlite':
+            label += ' (commit/%d)' % commitEvery
+        print("%-22s %12.0f" % (label, saved / spent))
+
+# A fake update for the queue benchmark, stamped with when it was sent
+def fakeUpdate (i, chat):
+    return {'update_id': i,
+            'message': {'chat': {'id': chat}, 'text': '/ping'},
+            'sent': monotonic()}
+
+# Run in a worker process for benchQueue: handles count updates from queue
+# with a handler that does nothing but note how long each update took to
+# arrive, then sends back the latencies
+def queueConsumer (queue, results, count):
+    import worker
+    from bot import Bot
+    latencies = []
+    bot = Bot('')
+    bot.addHandler('ping', lambda bot, update, args: None)
+    # Let the sender know we've started, so it doesn't time our imports
+    results.put(None)
+    while len(latencies) < count:
+        for update in worker.getMessages(queue):
+            worker.handle(bot, update)
+            latencies.append(monotonic() - update['sent'])
+    results.put(latencies)
+
+# Sends count updates to a worker process over a multiprocessing queue, a
+# gap seconds apart (as fast as possible if 0). Returns how long it took
+# and the sorted latencies.
+def queueRun (count, gap):
+    from multiprocessing import Process, Queue
+    queue = Queue()
+    results = Queue()
+    consumer = Process(target=queueConsumer, args=(queue, results, count))
+    consumer.start()
+    results.get()
+    start = perf_counter()
+    for i in range(count):
+        queue.put(fakeUpdate(i, i % 50))
+        if gap > 0:
+            sleep(gap)
+    latencies = sorted(results.get())
+    spent = perf_counter() - start
+    consumer.join()
+    return (spent, latencies)
+
+# Hands updates from a poller to a worker process over a multiprocessing
+# queue. Throughput is measured by sending as fast as possible, and the
+# latency from being put on the queue to reaching the handler by sending
+# at a steady rate (flooding would only measure the backlog). For
+# comparison it also times the pickled file queues this replaced (in one
+# process, so without any waiting between the two sides), which cost
+# this much per hand-off whatever the transport.
+def benchQueue (count=20000, paced=2000, gap=0.0005):
+    import tempfile
+    import os
+    import fcntl
+    from collections import deque
+    print("%-16s %14s %14s %14s" % ("queue", "updates/sec", "p50 (us)",
+                                    "p99 (us)"))
+    (spent, latencies) = queueRun(count, 0)
+    (paceSpent, latencies) = queueRun(paced, gap)
+    print("%-16s %14.0f %14.1f %14.1f" % ("multiprocessing", count / spent,
+                                          latencies[paced // 2] * 1e6,
+                                          latencies[paced * 99 // 100] * 1e6))
+
+    # The old way: the poller locks the file, unpickles the queue, appends
+    # and pickles it back, then the worker does the same to empty it
+    path = os.path.join(tempfile.mkdtemp(), '0_queue.p')
+    f = open(path, 'wb')
+    pickle.dump(deque(), f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+    rounds = count // 10
+    start = perf_counter()
+    for i in range(rounds):
+        f = open(path, 'r+b')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        pending = pickle.load(f)
+        pending.append(fakeUpdate(i, i % 50))
+        f.seek(0)
+        pickle.dump(pending, f, pickle.HIGHEST_PROTOCOL)
+        f.truncate()
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+        f = open(path, 'r+b')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        pending = pickle.load(f)
+        f.seek(0)
+        pickle.dump(deque(), f, pickle.HIGHEST_PROTOCOL)
+        f.truncate()
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+    spent = perf_counter() - start
+    print("%-16s %14.0f %14s %14s" % ("pickle files", rounds / spent, "-",
+                                      "-"))
+
+# Run in a worker process for benchIdle: waits for one update on queue and
+# sends back the CPU time it used while waiting and how long the update
+# took to arrive
+def idleConsumer (queue, results):
+    import worker
+    results.put(None)
+    start = process_time()
+    update = worker.getMessages(queue)[0]
+    results.put((process_time() - start, monotonic() - update['sent']))
+
+# Leaves a worker waiting on an empty queue for a while, then reports the
+# CPU it burned while idle and how quickly it woke up for an update
+def benchIdle (idle=2.0):
+    from multiprocessing import Process, Queue
+    queue = Queue()
+    results = Queue()
+    consumer = Process(target=idleConsumer, args=(queue, results))
+    consumer.start()
+    results.get()
+    sleep(idle)
+    queue.put(fakeUpdate(0, 0))
+    (cpu, woke) = results.get()
+    consumer.join()
+    print("idle worker for %.1fs: %.3fs CPU, woke up in %.1fus" %
+          (idle, cpu, woke * 1e6))
+
+# Sends photos to a local stand-in for the API (see fakegram.py) that takes
+# delay seconds to answer each, like a round trip to Telegram, and reports
+# sends per second: one at a time with a new connection each (as the Bot
+# used to) and through the Bot's pooled async client, spread over chats
+def benchSend (count=300, chats=30, delays=(0, 0.02), size=10000):
+    import requests
+    import bot
+    import fakegram
+    from io import BytesIO
+    photo = bytes(size)
+    print("%-14s %14s %14s" % ("delay (ms)", "blocking/sec", "async/sec"))
+    for delay in delays:
+        fake = fakegram.FakeTelegram(delay=delay)
+        fake.start()
+        url = fake.url() + '/botbench/sendPhoto'
+        start = perf_counter()
+        for i in range(count):
+            requests.post(url, data={'chat_id': str(i % chats)},
+                          files={'photo': ('board.png', BytesIO(photo))})
+        blocking = count / (perf_counter() - start)
+
+        bot.api_base = fake.url()
+        client = bot.Bot('bench')
+        start = perf_counter()
+        for i in range(count):
+            client.sendImage(chat_id=i % chats, photo=BytesIO(photo))
+        client.flush()
+        pooled = count / (perf_counter() - start)
+        client.close()
+        fake.stop()
+        print("%-14d %14.0f %14.0f" % (delay * 1000, blocking, pooled))
+
+# Sends rounds of replies to chats chats, one round every gap seconds,
+# through a local stand-in for the API that turns away more than Telegram
+# allows (30 sends a second, 3 to one chat) with a 429 and a retry_after of
+# a second. Every round is a board image to each chat, and every third a
+# message too. Reports how long until everything was sent, what was
+# uploaded and how many 429s came back, with and without the outbox.
+def benchOutbox (chats=20, rounds=8, gap=0.25, delay=0.02):
+    import bot
+    import fakegram
+    import outbox
+    from io import BytesIO
+    photo = bytes(10000)
+    limits = (outbox.global_rate, outbox.global_burst, outbox.chat_rate,
+              outbox.chat_burst, outbox.supersede)
+    print("%-10s %10s %10s %10s %10s %10s" % ("outbox", "seconds", "photos",
+                                              "messages", "429s", "replaced"))
+    for limited in [False, True]:
+        if limited:
+            (outbox.global_rate, outbox.global_burst, outbox.chat_rate,
+             outbox.chat_burst, outbox.supersede) = limits
+        else:
+            # As sends went before: as soon as a chat's last one is done
+            (outbox.global_rate, outbox.global_burst, outbox.chat_rate,
+             outbox.chat_burst, outbox.supersede) = (1e9, 1e9, 1e9, 1e9, False)
+        fake = fakegram.FakeTelegram(delay=delay, perSecond=30, perChat=3)
+        fake.start()
+        bot.api_base = fake.url()
+        client = bot.Bot('bench')
+        start = perf_counter()
+        for i in range(rounds):
+            for chat in range(chats):
+                if i % 3 == 0:
+                    client.sendMessage(chat_id=chat, text="Your move")
+                client.sendImage(chat_id=chat, photo=BytesIO(photo))
+            sleep(gap)
+        client.flush()
+        spent = perf_counter() - start
+        client.close()
+        fake.stop()
+        print("%-10s %10.1f %10d %10d %10d %10d" % (
+            ['off', 'on'][limited], spent, sum(fake.photos.values()),
+            sum(fake.messages.values()), fake.limited, client.outbox.replaced))
+    (outbox.global_rate, outbox.global_burst, outbox.chat_rate,
+     outbox.chat_burst, outbox.supersede) = limits
+
+# Plays random games in chats chats, sending the board after each move. Now
+# and then a chat asks for the board again (/game) or undoes a move and
+# plays it again, which sends boards that have been sent before. Each
+# image goes to a local stand-in for the API that answers after delay
+# seconds, and takes uploads at bandwidth bytes a second. Reports the bytes
+# uploaded and the time to send each image, with and without reusing the
+# file_ids of images sent before.
+def benchFileIDs (chats=10, steps=30, delay=0.02, bandwidth=1000000):
+    import bot
+    import fakegram
+    import outbox
+    import processing
+    from io import BytesIO
+    # Without the rate limits, which would make every send wait its turn
+    limits = (outbox.global_rate, outbox.global_burst, outbox.chat_rate,
+              outbox.chat_burst)
+    (outbox.global_rate, outbox.global_burst, outbox.chat_rate,
+     outbox.chat_burst) = (1e9, 1e9, 1e9, 1e9)
+    rng = random.Random(0)
+    sends = []
+    for chat in range(chats):
+        hue = processing.background_hue(chat)
+        board = Board(processing.default_board_size)
+        shown = []
+        for evt in randomGame(board.size, steps, seed=chat):
+            board.addEvent(evt)
+            shown.append(((1,) + processing.image_key(board, hue),
+                          processing.board_image(board, hue)[0]))
+            sends.append((chat, shown[-1]))
+            roll = rng.random()
+            if roll < 0.15:
+                sends.append((chat, shown[-1]))
+            elif roll < 0.3 and len(shown) > 1:
+                sends.append((chat, shown[-2]))
+                sends.append((chat, shown[-1]))
+    print("%d images, %d different" % (len(sends),
+                                       len(set(key for (chat, (key, data))
+                                               in sends))))
+    print("%-10s %12s %10s %12s %12s" % ("file_ids", "uploaded", "reused",
+                                         "mean (ms)", "repeat (ms)"))
+    for reuse in [False, True]:
+        fake = fakegram.FakeTelegram(delay=delay, bandwidth=bandwidth)
+        fake.start()
+        bot.api_base = fake.url()
+        client = bot.Bot('bench')
+        # The time to send every image, and those sent before
+        spent = 0.0
+        repeats = []
+        seen = set()
+        for (chat, (key, data)) in sends:
+            start = perf_counter()
+            client.sendImage(chat_id=chat, photo=BytesIO(data),
+                             key=key if reuse else None)
+            client.flush()
+            spent += perf_counter() - start
+            if key in seen:
+                repeats.append(perf_counter() - start)
+            seen.add(key)
+        client.close()
+        fake.stop()
+        print("%-10s %12d %10d %12.1f %12.1f" % (
+            ['off', 'on'][reuse], fake.photoBytes, fake.reused,
+            spent / len(sends) * 1000, sum(repeats) / len(repeats) * 1000))
+        if not reuse:
+            before = fake.photoBytes
+    saved = (before - fake.photoBytes) / len(sends)
+    print("%.1f MB an hour fewer uploaded at one image a second" %
+          (saved * 3600 / 1e6))
+    (outbox.global_rate, outbox.global_burst, outbox.chat_rate,
+     outbox.chat_burst) = limits
+
+# Times scoring a board part way through a game (half its spaces played)
+# for the common board sizes, labelling the empty regions with NumPy and
+# SciPy and by flood filling them in Python
+def benchScore (sizes=(9, 13, 19), rounds=1000):
+    import scoring
+    print("%-8s %14s %14s" % ("size", "labelled (us)", "filled (us)"))
+    for size in sizes:
+        board = Board(size)
+        for evt in randomGame(size, size * size // 2):
+            board.addEvent(evt)
+        times = []
+        for territory in [scoring.label_territory, scoring.fill_territory]:
+            if territory == scoring.label_territory and scoring.numpy == None:
+                times.append(float('nan'))
+                continue
+            start = perf_counter()
+            for i in range(rounds):
+                territory(board)
+            times.append((perf_counter() - start) / rounds * 1e6)
+        print("%-8s %14.1f %14.1f" % (("%dx%d" % (size, size),) +
+                                      tuple(times)))
+
+# Times each image encoding on a half full 19x19 board, with the size of
+# what it produces
+def benchEncode (size=19, rounds=10):
+    import processing
+    board = Board(size)
+    for evt in randomGame(size, size * size // 2):
+        board.addEvent(evt)
+    img = processing.draw_board(board, 120)
+    print("%-22s %12s %12s" % ("encoding", "encode (ms)", "bytes"))
+    settings = [('png', 6, None), ('png', 1, None), ('png', 0, None),
+                ('paletted', 6, 16), ('paletted', 1, 32), ('paletted', 6, 32),
+                ('jpeg', None, 85), ('jpeg', None, 70)]
+    for (format, level, extra) in settings:
+        processing.image_format = format
+        if level != None:
+            processing.png_compress_level = level
+        if format == 'paletted':
+            processing.palette_colors = extra
+        if format == 'jpeg':
+            processing.jpeg_quality = extra
+        start = perf_counter()
+        for i in range(rounds):
+            data = processing.encode_image(img)[0]
+        spent = (perf_counter() - start) / rounds
+        print("%-22s %12.2f %12d" % (str(processing.encoding()), spent * 1e3,
+                                     len(data)))
+
+# Times what recording metrics (see metrics.py) costs: each kind of record
+# on its own, and handling moves through the real handlers (with sends
+# stubbed out) with metrics on and off. The overhead is also worked out
+# from the records an update makes and what each costs, as it's smaller
+# than the noise in handling one.
+def benchMetrics (chats=10, moves=40, rounds=100000, runs=3):
+    import tempfile
+    import metrics
+    import processing
+    import worker
+    from bot import Bot
+    from storage import FileStorage
+    times = metrics.Histogram()
+    start = perf_counter()
+    for i in range(rounds):
+        times.record(0.0042)
+    recorded = (perf_counter() - start) / rounds
+    start = perf_counter()
+    for i in range(rounds):
+        metrics.histogram('bench_seconds', command='move').record(0.0042)
+    looked = (perf_counter() - start) / rounds
+    start = perf_counter()
+    for i in range(rounds):
+        metrics.count('bench_total', command='move')
+    counted = (perf_counter() - start) / rounds
+    print("%-28s %10s" % ("record", "cost (us)"))
+    for (name, spent) in [("Histogram.record", recorded),
+                          ("histogram(...).record", looked),
+                          ("count", counted)]:
+        print("%-28s %10.2f" % (name, spent * 1e6))
+
+    client = Bot('')
+    processing.load(client)
+    client.sendImage = lambda **kwargs: None
+    client.sendMessage = lambda **kwargs: None
+    updates = []
+    for chat in range(chats):
+        for (date, evt, (player, row, col)) in randomGame(9, moves,
+                                                          seed=chat):
+            updates.append({'update_id': len(updates),
+                            'message': {'chat': {'id': chat},
+                                        'text': '/%s %s%d' % (
+                                            player[0].lower(),
+                                            chr(ord('a') + col), row + 1)}})
+    storage = processing.storage
+    best = {True: None, False: None}
+    for i in range(runs):
+        for enabled in [True, False]:
+            metrics.enabled = enabled
+            processing.storage = FileStorage(tempfile.mkdtemp() + '/')
+            for cache in [processing.board_cache, processing.image_cache,
+                          processing.frames]:
+                cache.clear()
+            records = (sum(h.count for h in metrics.histograms.values()) +
+                       sum(metrics.counters.values()))
+            start = perf_counter()
+            for update in updates:
+                worker.handle(client, update)
+            spent = (perf_counter() - start) / len(updates)
+            if enabled:
+                records = (sum(h.count for h in metrics.histograms.values()) +
+                           sum(metrics.counters.values()) - records)
+                perUpdate = records / len(updates)
+            if best[enabled] == None or spent < best[enabled]:
+                best[enabled] = spent
+    metrics.enabled = True
+    processing.storage = storage
+    estimate = perUpdate * looked / best[False]
+    print("%d moves: %.2fms an update with metrics, %.2fms without "
+          "(%+.1f%%)" % (len(updates), best[True] * 1e3, best[False] * 1e3,
+                         (best[True] / best[False] - 1) * 100))
+    print("%.1f records an update, about %.2fus or %.3f%% of handling it" %
+          (perUpdate, perUpdate * looked * 1e6, estimate * 100))
+
+# Times the hot paths over a synthetic game (see syntheticGame) of each
+# size, and the hand-off of updates to a worker, returning the results as
+# a dict (for --json). Per size, in the order the events arrive:
+#   addEvent  - the cost of each event added to the board, in microseconds
+#   insert    - the cost of adding each to a journal (Store.insert)
+#   rebuild   - rebuilding the whole game from its journal, in milliseconds
+#   render    - drawing and encoding the final board, in milliseconds
+#               (with the templates already drawn)
+#   save/load - pickling and unpickling the board, in microseconds
+def suite (sizes=sizes, seed=0, rounds=20, updates=5000):
+    import processing
+    results = {}
+    print("%6s %7s %9s %9s %12s %13s %12s %10s %10s" % (
+        "size", "events", "captures", "add (us)", "insert (us)",
+        "rebuild (ms)", "render (ms)", "save (us)", "load (us)"))
+    for size in sizes:
+        evts = syntheticGame(size, size * size, seed)
+        board = Board(size)
+        start = perf_counter()
+        for evt in evts:
+            board.addEvent(evt)
+        added = (perf_counter() - start) / len(evts)
+
+        store = Store(key=moveKey)
+        start = perf_counter()
+        for evt in evts:
+            store.insert(evt)
+        inserted = (perf_counter() - start) / len(evts)
+
+        journal = board.store.log()
+        rebuilt = Board(size)
+        start = perf_counter()
+        for i in range(rounds):
+            rebuilt.buildGame(journal)
+        rebuilt = (perf_counter() - start) / rounds
+
+        # Once first, so the templates are drawn
+        processing.render_board(board, 120)
+        start = perf_counter()
+        for i in range(rounds):
+            processing.render_board(board, 120)
+        rendered = (perf_counter() - start) / rounds
+
+        start = perf_counter()
+        for i in range(rounds):
+            data = pickle.dumps(board, pickle.HIGHEST_PROTOCOL)
+        saved = (perf_counter() - start) / rounds
+        start = perf_counter()
+        for i in range(rounds):
+            pickle.loads(data)
+        loaded = (perf_counter() - start) / rounds
+
+        stones = sum(1 for cell in board.cells if cell != codes[Empty])
+        results[str(size)] = {
+            'events': len(evts),
+            'moves': sum(1 for evt in evts if evt[1] == events.move),
+            'undos': sum(1 for evt in evts if evt[1] == events.undo),
+            'captures': len(board.moves) - stones,
+            'addEvent_us': added * 1e6,
+            'insert_us': inserted * 1e6,
+            'rebuild_ms': rebuilt * 1e3,
+            'render_ms': rendered * 1e3,
+            'save_us': saved * 1e6,
+            'load_us': loaded * 1e6,
+            'pickle_bytes': len(data)}
+        r = results[str(size)]
+        print("%6d %7d %9d %9.2f %12.2f %13.2f %12.2f %10.1f %10.1f" % (
+            size, r['events'], r['captures'], r['addEvent_us'],
+            r['insert_us'], r['rebuild_ms'], r['render_ms'], r['save_us'],
+            r['load_us']))
+
+    # Flooded, so only the throughput means anything (see benchQueue)
+    (spent, latencies) = queueRun(updates, 0)
+    results['queue'] = {'updates_per_sec': updates / spent}
+    print("queue: %.0f updates/sec" % results['queue']['updates_per_sec'])
+    return results
+
+# What a run of the suite was on, so runs can be told apart
+def machine (seed):
+    import processing
+    return {'time': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'seed': seed,
+            'encoding': str(processing.encoding())}
+
+# Runs the suite and writes its results to path as JSON
+def writeSuite (path, seed=0):
+    results = {'machine': machine(seed), 'results': suite(seed=seed)}
+    f = open(path, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.write('\n')
+    f.close()
+    print("Wrote " + path)
+
+# Prints every timing in two files written by writeSuite side by side, with
+# how much faster (above 1) or slower the second run was
+def compare (oldPath, newPath):
+    f = open(oldPath)
+    old = json.load(f)['results']
+    f.close()
+    f = open(newPath)
+    new = json.load(f)['results']
+    f.close()
+    print("%-24s %12s %12s %8s" % ("", "old", "new", "speedup"))
+    for group in sorted(new, key=lambda g: (not g.isdigit(), g.zfill(3))):
+        for (name, value) in sorted(new[group].items()):
+            if group not in old or name not in old[group]:
+                continue
+            was = old[group][name]
+            # For rates more is better, for times less
+            if name.endswith('_per_sec'):
+                ratio = value / max(was, 1e-12)
+            elif name.endswith('_us') or name.endswith('_ms'):
+                ratio = was / max(value, 1e-12)
+            else:
+                continue
+            print("%-24s %12.2f %12.2f %7.2fx" % (group + " " + name, was,
+                                                  value, ratio))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--json':
+        writeSuite(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) > 3 and sys.argv[1] == '--compare':
+        compare(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    benchAddEvent()
+    print()
+    benchUndo()
+    print()
+    benchInsert()
+    print()
+    benchSizes()
+    print()
+    benchStorage()
+    print()
+    benchQueue()
+    print()
+    benchIdle()
+    print()
+    benchSend()
+    print()
+    benchOutbox()
+    print()
+    benchFileIDs()
+    print()
+    benchScore()
+    print()
+    benchRender()
+    print()
+    benchEncode()
+    print()
+    benchMetrics()
+    print()
+    suite()
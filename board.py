@@ -3,144 +3,384 @@
 # Get the journal store
 from store import Store
 
-# Double-ended queue for the flooding mechanism
-from collections import deque
-
 # Our events declarations
 import events
 
-# The way we will handle representing the game board is in two ways - 
-# a graph of piece spaces which are linked to the adjacent spaces, and a 
-# two dimensional list which allows direct numerical 
-# indexing (hopefully shortcuts)
-# Note that the convention is for the edge of the board to have left/up/right/down
-# values of None (as appropriate, a corner will only have two Nones, for example)
-# and the board will be initialized for all self.player values to be Empty but with
-# the adjacent spaces linked up correctly.
+# Compact integer arrays for the group bookkeeping
+from array import array
+
+# For the Zobrist keys
+import random
+
+# The game board is a flat bytearray of size * size spaces, row by row, so
+# space (row, col) lives at index row * size + col. Each byte is the code of
+# the player owning the space (see codes below). Which spaces neighbour
+# which only depends on the board size, so that is worked out once per size
+# and shared by every board of that size (see neighbours).
+# Stones of the same player that touch form a group (a chain), and the
+# board keeps track of the chains as stones are played: every stone knows
+# the head of its chain (chains) and the next stone of the chain, with the
+# last linking back to the first (nexts), and every head knows how many
+# stones are in the chain (counts). These are only meaningful for spaces
+# that have a stone on them.
+# Every position also has a 64 bit Zobrist hash: the XOR of a fixed random
+# key for each (space, player) on the board. Placing or removing a stone
+# just XORs its key in or out, so the hash is kept up to date for free and
+# two boards of the same size are (for all practical purposes) in the same
+# position exactly when their hashes are equal.
 # A class (using it like a type) to represent a space where no piece has gone
 # Could be a string, but this is a little nicer
 class Empty:
     pass
 
+# The old graph representation of a space. No longer used, but boards
+# pickled before the switch to the flat representation refer to it, so it's
+# kept around to let them load (see Board.__setstate__).
 class Node:
 
     def __init__ (self, player=Empty):
         self.player = player
         self.adjacent = []
 
+# The byte stored for each player, and the player for each byte
+codes = { Empty : 0, "Black" : 1, "White" : 2 }
+players = [Empty, "Black", "White"]
+
+# Neighbour tables that have been built, keyed by board size
+neighbourTables = {}
+
+# Returns a tuple with, for each space, a tuple of the indices of the spaces
+# left/up/right/down of it (fewer at the edges). Built once per board size.
+def neighbours (size):
+    if size not in neighbourTables:
+        table = []
+        for i in range(size):
+            for j in range(size):
+                adjacent = []
+                if j > 0:
+                    adjacent.append(i * size + j - 1)
+                if i > 0:
+                    adjacent.append((i - 1) * size + j)
+                if j < size - 1:
+                    adjacent.append(i * size + j + 1)
+                if i < size - 1:
+                    adjacent.append((i + 1) * size + j)
+                table.append(tuple(adjacent))
+        neighbourTables[size] = tuple(table)
+    return neighbourTables[size]
+
+# Zobrist key tables that have been built, keyed by board size
+zobristTables = {}
+
+# Returns a tuple with, for each space, the Zobrist keys indexed by player
+# code (the key for Empty is 0). The keys come from a generator seeded with
+# the board size, so they're the same in every process and hashes can be
+# saved and compared across runs.
+def zobrist (size):
+    if size not in zobristTables:
+        rng = random.Random(size)
+        zobristTables[size] = tuple((0, rng.getrandbits(64), rng.getrandbits(64))
+                                    for i in range(size * size))
+    return zobristTables[size]
+
 # A class to represent a whole board
 # Defining it with a field for size to allow for alteration of the board size later
 class Board:
 
-    # Initializes a board with Empty nodes
+    # Initializes a board with Empty spaces
     # First dimension is the row, second is the column
-    def __init__ (self, size):
+    # With superko, a move that would bring back any earlier position of
+    # the game is rejected (which covers ko)
+    def __init__ (self, size, superko=False):
         self.size = size
-        self.store = Store(orderMoves)
+        self.superko = superko
+        self.adjacent = neighbours(size)
+        self.keys = zobrist(size)
+        self.store = Store(key=moveKey)
         self.buildGame(self.store.log())
 
     # Clears a board
     # Reallocates a Store and rebuilds the game
     def clear (self):
-        self.store = Store(orderMoves)
+        self.store = Store(key=moveKey)
         self.buildGame(self.store.log())
 
-    # Scores a board
+    # Scores a board under rules ('area' or 'territory', see scoring.py)
     # Returns a dict with all of the player's scores
-    # For now, just counts the stones, and apparently empty classes can act an an index. Weird, but okay
-    def score (self):
-        scores = {}
-        for i in range(size):
-            for j in range(size):
-                scores[self.shortcut[i][j].player] += 1
-        return scores
+    def score (self, rules=None):
+        # Imported here, as scoring needs the codes from this module
+        import scoring
+        return scoring.score(self, rules).totals()
 
     # Sets a space to be owned by a player
+    # This bypasses the rules (nothing gets captured), so the chains are
+    # worked out again from scratch
     def set (self, player, row, col):
         if row >= 0 and row < self.size and col >= 0 and col < self.size:
-            self.shortcut[row][col].player = player
+            index = row * self.size + col
+            self.hash ^= self.keys[index][self.cells[index]]
+            self.cells[index] = codes[player]
+            self.hash ^= self.keys[index][self.cells[index]]
+            self.relink()
         return
 
+    # A key identifying the position on the board, for caches of anything
+    # that only depends on what the board looks like
+    def position (self):
+        return (self.size, self.hash)
+
     # Gets the owner of a space
     def get (self, row, col):
         if row >= 0 and row < self.size and col >= 0 and col < self.size:
-            return self.shortcut[row][col].player
+            return players[self.cells[row * self.size + col]]
         else:
             return None
 
-    # Returns if a space can be flooded for a given player
-    def can_flood (self, player, row, col):
-        if row >= 0 and row < self.size and col >= 0 and col < self.size:
-            # Checks to see if an area can be flooded (is surrounded by nothing but None and the given player)
-            # Flooding means removing the pieces from the board, as per the rules of Go
-            # Approach is to iteratively flood out from our starting point, using
-            # a deque to track items to check and a set to track visited items
-            # This is breadth-first.
-
-            # Check on the first entry
-            if self.shortcut[row][col].player == player:
+    # Joins the chains headed by first and second into one, relabelling
+    # the stones of the smaller one. Returns the head of the joined chain.
+    def join (self, first, second):
+        chains, nexts, counts = self.chains, self.nexts, self.counts
+        if counts[first] < counts[second]:
+            first, second = second, first
+        cur = second
+        while True:
+            chains[cur] = first
+            cur = nexts[cur]
+            if cur == second:
+                break
+        # Swapping the successors of one stone from each cycle splices the
+        # two cycles into one
+        nexts[first], nexts[second] = nexts[second], nexts[first]
+        counts[first] += counts[second]
+        return first
+
+    # Returns if any stone of the chain headed by head has an empty neighbour
+    def hasLiberty (self, head):
+        cells, nexts, adjacent = self.cells, self.nexts, self.adjacent
+        cur = head
+        while True:
+            for adj in adjacent[cur]:
+                if cells[adj] == 0:
+                    return True
+            cur = nexts[cur]
+            if cur == head:
                 return False
 
-            # Keep track of the Nodes we have yet to visit
-            nexts = deque()
-            # Keep track of the Nodes we've visited so as not to revisit them
-            visited = set()
-
-            # Add ourself to start
-            nexts.appendleft((row,col))
-            # Also append None to the visited list, which is a really nice way to
-            # just pass on the None values
-            visited.add(None)
-
-            # Note that len(Set) has constant time complexity, as it does with a
-            # list
-            while len(nexts) != 0:
-                (ci, cj) = nexts.pop()
-                cur = self.shortcut[ci][cj]
-                if cur not in visited:
-                    visited.add(cur)
-                    if cur.player != player and cur.player != Empty:
-                        nexts.extendleft(cur.adjacent)
-                    elif cur.player == Empty:
-                        return False
-                    else: # cur.player == player
-                        pass
-                else:
-                    pass
-            
-            # If we make it all the way, then we didn't encounter an empty space in
-            # a region surrounded by the given player's pieces and the edge
+    # Takes the chain headed by head off the board, adding its spaces to
+    # captured
+    def capture (self, head, captured):
+        cells, nexts, keys = self.cells, self.nexts, self.keys
+        cur = head
+        while True:
+            self.hash ^= keys[cur][cells[cur]]
+            cells[cur] = 0
+            captured.append(cur)
+            cur = nexts[cur]
+            if cur == head:
+                break
+
+    # Puts a stone of the player with the given code on space index, joins
+    # it with the player's neighbouring chains and takes the other player's
+    # neighbouring chains that are left without liberties, as per the rules
+    # of Go. Only the (up to four) neighbouring chains are looked at, each
+    # at most once, and a chain with a liberty is given up on as soon as one
+    # is found. A stone that leaves its own chain without liberties stays,
+    # as it always has. Returns the indices of the captured spaces.
+    def place (self, index, code):
+        captured = []
+        if code == codes[Empty]:
+            return captured
+        cells, chains = self.cells, self.chains
+        cells[index] = code
+        self.hash ^= self.keys[index][code]
+        chains[index] = index
+        self.nexts[index] = index
+        self.counts[index] = 1
+
+        head = index
+        checked = []
+        for adj in self.adjacent[index]:
+            other = cells[adj]
+            if other == code:
+                if chains[adj] != head:
+                    head = self.join(head, chains[adj])
+            elif other != codes[Empty] and chains[adj] not in checked:
+                checked.append(chains[adj])
+                if not self.hasLiberty(chains[adj]):
+                    self.capture(chains[adj], captured)
+        return captured
+
+    # Returns the hash the board would have after place(index, code),
+    # without changing anything
+    def hashAfter (self, index, code):
+        cells, chains, nexts, keys = self.cells, self.chains, self.nexts, self.keys
+        after = self.hash ^ keys[index][code]
+        if code == codes[Empty]:
+            return after
+        # The stone has to be there for the liberty checks
+        cells[index] = code
+        checked = []
+        for adj in self.adjacent[index]:
+            other = cells[adj]
+            if (other != code and other != codes[Empty] and
+                    chains[adj] not in checked):
+                checked.append(chains[adj])
+                if not self.hasLiberty(chains[adj]):
+                    cur = chains[adj]
+                    while True:
+                        after ^= keys[cur][other]
+                        cur = nexts[cur]
+                        if cur == chains[adj]:
+                            break
+        cells[index] = codes[Empty]
+        return after
+
+    # Plays a move on the board and records the position it leads to
+    # Returns the indices of the spaces captured by it, which are also kept
+    # in self.captured
+    def play (self, move):
+        captured = self.makeMove(move)
+        self.captured = captured
+        self.moves.append(move)
+        self.history.append(self.hash)
+        self.seen[self.hash] = self.seen.get(self.hash, 0) + 1
+        return captured
+
+    # Returns if a move would bring back a position from earlier in the
+    # game, which superko forbids
+    def repeats (self, move):
+        name, row, col = move[0], move[1], move[2]
+        return self.hashAfter(row * self.size + col, codes[name]) in self.seen
+
+    # Works out the chains from scratch for whatever is in cells
+    def relink (self):
+        count = self.size * self.size
+        cells, adjacent = self.cells, self.adjacent
+        self.chains = array('h', range(count))
+        self.nexts = array('h', range(count))
+        self.counts = array('h', [1]) * count
+        for i in range(count):
+            if cells[i] != codes[Empty]:
+                for adj in adjacent[i]:
+                    if (adj < i and cells[adj] == cells[i] and
+                            self.chains[adj] != self.chains[i]):
+                        self.join(self.chains[adj], self.chains[i])
+
+    # Returns if a move can go on a space: it has to be on the board and
+    # there can't already be something there
+    def isOpen (self, row, col):
+        return (row >= 0 and row < self.size and col >= 0 and col < self.size
+                and self.cells[row * self.size + col] == codes[Empty])
+
+    # Empty the board
+    def empty (self):
+        count = self.size * self.size
+        self.cells = bytearray(count)
+        self.hash = 0
+        # place sets these up for each stone, so they can start as anything
+        self.chains = array('h', [0]) * count
+        self.nexts = array('h', [0]) * count
+        self.counts = array('h', [0]) * count
+
+    # Add a single move to the board
+    # Returns the indices of the spaces captured by it
+    def makeMove (self, move):
+        name, row, col = move[0], move[1], move[2]
+        # We already checked to make sure the space is empty, so we can
+        # apply
+        return self.place(row * self.size + col, codes[name])
+
+    # Applies a single event on top of the current board and move list.
+    # Returns whether the event was valid (and so changed anything).
+    def applyEvent (self, evt):
+        (date, evt, args) = evt
+        if (evt == events.undo):
+            # Undoing with nothing to undo is harmless
+            if len(self.moves) > 0:
+                self.moves.pop()
+                self.rollback()
             return True
-        else:
+        elif (evt == events.move):
+            name, row, col = args[0], args[1], args[2]
+            # If there isn't already something there and it's within
+            # bounds (and it doesn't repeat a position, if we care)
+            if (self.isOpen(row, col) and
+                    not (self.superko and self.repeats(args))):
+                self.play(args)
+                return True
+            return False
+        elif (len(self.moves) == 0):
+            return True
+        else: # Something went wrong
+            print("Unsupported event in buildGame")
             return False
 
-    # Floods a space for a player
-    def flood (self, player, row, col):
-        if row >= 0 and row < self.size and col >= 0 and col < self.size:
-            # Keep track of the Nodes we have yet to visit
-            nexts = deque()
-            # Keep track of the Nodes we've visited so as not to revisit them
-            visited = set()
-
-            # Add ourself to start
-            nexts.appendleft((row,col))
-            # Also append None to the visited list, which is a really nice way to
-            # just pass on the None values
-            visited.add(None)
-
-            # Note that len(Set) has constant time complexity, as it does with a
-            # list
-            while len(nexts) != 0:
-                (ci, cj) = nexts.pop()
-                cur = self.shortcut[ci][cj]
-                if cur not in visited:
-                    visited.add(cur)
-                    if cur.player != player and cur.player != Empty:
-                        nexts.extendleft(cur.adjacent)
-                        cur.player = Empty
-
-    # The buildGame function which builds the game out of an ordered list of 
-    # Events. Updates the shortcut array in place.
+    # A compact copy of the game state for the Store to cache: the moves,
+    # the board, its chains, its hash and the hashes of the positions so far
+    def snapshot (self):
+        return (tuple(self.moves), bytes(self.cells), array('h', self.chains),
+                array('h', self.nexts), array('h', self.counts), self.hash,
+                tuple(self.history))
+
+    # Puts the game back to a snapshot, or to an empty board for None
+    def restore (self, snap):
+        if snap == None:
+            self.empty()
+            self.moves = []
+            # The positions after each move, starting with the empty board
+            self.history = [self.hash]
+        else:
+            (moves, cells, chains, nexts, counts, current, history) = snap
+            self.moves = list(moves)
+            self.cells = bytearray(cells)
+            self.chains = array('h', chains)
+            self.nexts = array('h', nexts)
+            self.counts = array('h', counts)
+            self.hash = current
+            self.history = list(history)
+        self.recount()
+
+    # Works out how many times each position has come up from the history
+    def recount (self):
+        self.seen = {}
+        for position in self.history:
+            self.seen[position] = self.seen.get(position, 0) + 1
+
+    # Hands the Store a snapshot if one is due at this point of the journal
+    def checkpoint (self):
+        if self.store.due(self.applied):
+            self.store.checkpoint(self.applied, self.snapshot())
+
+    # Rebuilds the board for the current move list after an undo.
+    # Rather than starting from an empty board we start from the latest
+    # checkpoint whose moves are a prefix of ours, so undoes near the end of
+    # a long game only replay a handful of moves.
+    def rollback (self):
+        moves = self.moves
+        def isPrefix (snap):
+            return (len(snap[0]) <= len(moves) and
+                    snap[0] == tuple(moves[:len(snap[0])]))
+        (pos, snap) = self.store.nearest(self.applied, isPrefix)
+        self.restore(snap)
+        for move in moves[len(self.moves):]:
+            self.play(move)
+
+    # Replays the journal from the latest checkpoint the Store still has.
+    # Returns whether the last event was valid.
+    def replay (self, evts):
+        (pos, snap) = self.store.nearest(len(evts))
+        self.restore(snap)
+        sendImage = True
+        for i in range(pos, len(evts)):
+            # How much of the journal the board reflects
+            self.applied = i + 1
+            sendImage = self.applyEvent(evts[i])
+            self.checkpoint()
+        self.applied = len(evts)
+        return sendImage
+
+    # The buildGame function which builds the game out of an ordered list of
+    # Events. Updates the board in place.
     # Also returns a value that indicates if the last move (of this log)
     # is a duplicate move.
     def buildGame (self,evts):
@@ -155,91 +395,119 @@ class Board:
         # Disadvantages:
         #   - Building the board multiple times, which is especially expensive
         #       for undoes near the end of the game.
-        # Other approach:
-        #   - Save all copies of the game board as you build, so an undo only
-        #       rolls back one board. This seemingly comes with a lower
-        #       complexity, but each copy of the board comes with the burden
-        #       of allocating the space for a whole board. So, it consumes
-        #       dramatically more memory and the speed benefits are not clear.
-        
-        # Empty the shortcut array
-        def empty ():
-            # We should return a shortcut array here with interlinked nodes
-            # Empty array
-            self.shortcut = [[Node() for x in range(self.size)] for x in range(self.size)]
-            for i in range(self.size):
-                for j in range(self.size):
-                    if j > 0:
-                        self.shortcut[i][j].adjacent.append((i,j-1))
-                    if i > 0:
-                        self.shortcut[i][j].adjacent.append((i-1,j))
-                    if j < self.size - 1:
-                        self.shortcut[i][j].adjacent.append((i,j+1))
-                    if i < self.size - 1:
-                        self.shortcut[i][j].adjacent.append((i+1,j))
-        
-        # Add a single move to the shortcut array
-        def makeMove (move):
-            name, row, col = move[0], move[1], move[2]
-            # We already checked to make sure the space is empty, so we can
-            # apply
-            self.set(name,row,col)
-            # If we went there, take any zones that are now surrounded 
-            # by the player
-            # can_flood handles out of bounds indices nicely, so don't 
-            # need to filter them here
-            for roff in range(-1,2):
-                for coff in range(-1,2):
-                    if self.can_flood(name, row + roff, col + coff):
-                        self.flood(name, row + roff, col + coff)
-
-        # Applies the moves, assuming there are no undoes
-        def build (evtList):
-            # Applying the moves
-            # Note that all events here are now moves (3-tuples)
-            for i in range(len(evtList)):
-                makeMove(evtList[i])
-
-        empty()
-        evtList = []
-        sendImage = True
-        for i in range(len(evts)):
-            (date, evt, args) = evts[i]
-            if (evt == events.undo and len(evtList) > 0):
-                evtList.pop()
-                empty()
-                build(evtList)
-            elif (evt == events.move):
-                name, row, col = args[0], args[1], args[2]
-                # If there isn't already something there and it's within
-                # bounds
-                if (self.shortcut[row][col].player == Empty and
-                    row < self.size and col < self.size and
-                    row >= 0 and col >= 0):
-                    evtList.append(args)
-                    makeMove(args)
-                elif (i == len(evts) - 1):
-                    # If the last event is invalid, say so
-                    sendImage = False
-                else: # Just ignore
-                    pass
-            elif (len(evtList) == 0):
-                pass
-            else: # Something went wrong
-                print("Unsupported event in buildGame")
-                sendImage = False
-        
+        # To soften the disadvantage, the Store keeps a bounded number of
+        # snapshots along the journal (see Store.checkpoint), and undoes and
+        # out of order events resume from the nearest one instead of from an
+        # empty board. The Store's interval and maxCheckpoints trade memory
+        # for speed here.
+        self.store.invalidate(0)
+        sendImage = self.replay(evts)
+        # There's nothing to compare with, see addEvent
+        self.previous = self.hash
+        self.changed = set()
         # Report if we should respond
         return sendImage
-        
-    # Adds an event to the journal and rebuilds the shortcut array
+
+    # Returns the (row, col) of every space that differs from before, a
+    # copy of the cells from earlier
+    def changedSince (self, before):
+        cells = self.cells
+        return set(divmod(i, self.size) for i in range(len(cells))
+                   if cells[i] != before[i])
+
+    # Adds an event to the journal and updates the board
     # This is the method that should be used to add events, not get/set
     # Returns whether or not a board image should be sent
+    # Afterwards, self.previous is the hash of the position before the event
+    # and self.changed is the set of (row, col) spaces the event changed,
+    # so that whoever has a picture of the old position can patch it.
     def addEvent (self, evt):
+        self.previous = self.hash
+        before = bytes(self.cells)
         self.store.insert(evt)
-        return self.buildGame(self.store.log())
+        journal = self.store.log()
+        # The usual case is that the event lands at the end of the journal,
+        # right after everything we've already applied, so we only need to
+        # apply that one event
+        if len(journal) == self.applied + 1 and journal[-1] is evt:
+            self.applied += 1
+            sendImage = self.applyEvent(evt)
+            self.checkpoint()
+            if evt[1] == events.move:
+                # A move only changes its own space and what it captured
+                self.changed = set()
+                if sendImage:
+                    self.changed.add((evt[2][1], evt[2][2]))
+                    for index in self.captured:
+                        self.changed.add(divmod(index, self.size))
+            else:
+                self.changed = self.changedSince(before)
+            return sendImage
+        # Otherwise it arrived out of order. The Store has already dropped
+        # the checkpoints after it, so we replay from the one before it.
+        sendImage = self.replay(journal)
+        self.changed = self.changedSince(before)
+        return sendImage
+
+    # Adds a batch of events at once (like a game's log being loaded, or
+    # late updates), in whatever order they come. They're merged into the
+    # journal together and applied with at most one replay, from where the
+    # first of them landed, rather than one replay for each that's out of
+    # order. Returns whether the last event of the journal was valid, and
+    # leaves self.previous and self.changed as addEvent does for the batch
+    # as a whole.
+    def addEvents (self, evts):
+        self.previous = self.hash
+        before = bytes(self.cells)
+        start = self.store.bulk_insert(evts)
+        journal = self.store.log()
+        if start >= self.applied:
+            # They all went after everything we've applied
+            sendImage = True
+            for i in range(self.applied, len(journal)):
+                self.applied = i + 1
+                sendImage = self.applyEvent(journal[i])
+                self.checkpoint()
+        else:
+            sendImage = self.replay(journal)
+        self.changed = self.changedSince(before)
+        return sendImage
+
+    # The neighbour and key tables are shared between boards and the chains
+    # and position counts can be worked out from the rest, so none of them
+    # are pickled
+    def __getstate__ (self):
+        state = self.__dict__.copy()
+        for name in ['adjacent', 'keys', 'chains', 'nexts', 'counts', 'seen']:
+            del state[name]
+        return state
+
+    # Boards pickled before the flat representation (or before the move list
+    # or position history were tracked) need a replay to pick them up
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+        self.adjacent = neighbours(self.size)
+        self.keys = zobrist(self.size)
+        if 'superko' not in state:
+            self.superko = False
+        if 'history' not in state:
+            self.__dict__.pop('shortcut', None)
+            self.buildGame(self.store.log())
+        else:
+            self.relink()
+            self.recount()
+        if 'changed' not in state:
+            self.previous = self.hash
+            self.changed = set()
+        # Older Stores ordered moves by comparing them
+        if self.store.key == None and self.store.orderFunc is orderMoves:
+            self.store.setKey(moveKey)
 
 # Orders moves by Telegram-ordered ID
 # Arguments are like (date1, evt1, args1), (date2, evt2, args2) 
 def orderMoves (m1, m2):
-    return m1[0] < m2[0]
\ No newline at end of file
+    return m1[0] < m2[0]
+
+# The key moves are ordered by: their Telegram-ordered ID
+def moveKey (m):
+    return m[0]
\ No newline at end of file
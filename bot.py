@@ -1,40 +1,345 @@
 # Simply the class definitions for the bot and worker declarations
 
-# Nice way to make HTTP get requests
-import requests
+# The client we talk to the Bot API with, which runs on its own event loop
+import asyncio
+import aiohttp
+
+# The loop runs on a thread of its own, which the handlers hand sends to
+import threading
+
+# For the backoff between retries
+import random
+
+# For saving the file_ids of images sent
+import os
+import pickle
+from collections import deque
+from cache import LRUCache
+
+# Where sends wait for Telegram's limits
+from outbox import Outbox, image_priority, text_priority
+
+# To time the calls
+from time import perf_counter
+import metrics
+
+# Where the Bot API is. Can be pointed at a stand-in for testing, such as
+# fakegram.py.
+api_base = 'https://api.telegram.org'
+
+# The most connections to the API a Bot keeps open at once
+max_connections = 16
+
+# The most sends a Bot has in flight (including waiting to be retried)
+# before sending more waits for one to finish
+max_in_flight = 64
+
+# How many times a send is retried after a failure before giving up, and
+# the backoff before the first retry (in seconds), which doubles after
+# each one up to max_backoff
+max_retries = 5
+base_backoff = 0.5
+max_backoff = 30
+
+# The most file_ids of sent images kept for sending the same image again,
+# and how many new ones are learned between saving them
+file_id_cache_size = 4096
+file_id_save_every = 100
 
 # A nice holder for information we need between function calls
+#
+# Sends go out on an asyncio event loop on a background thread, through one
+# aiohttp session that keeps its connections to the API open. sendMessage
+# and sendImage only queue the send and return, so a worker carries on with
+# other chats while uploads are in flight. They wait in an outbox (see
+# outbox.py) until Telegram's rate limits let them go, and a chat's sends
+# still go out in the order they were made, one after another.
+#
+# Telegram answers a photo with the file_id it's keeping it under, and
+# sending that file_id instead of the photo shows the same photo again
+# without uploading it. Images sent with a key (see sendImage) have their
+# file_id kept under it, so sending the same image again doesn't upload it.
 class Bot:
     double_resets = {}
 
     def __init__ (self, token):
         self.token = token
-        handlers = {}
+        self.handlers = {}
+        # Started the first time something is sent
+        self.loop = None
+        self.session = None
+        self.outbox = None
+        self.running = None
+        # How many workers share the bot's rate limit
+        self.workers = 1
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        # The file_id and size of sent images by key, and those learned on
+        # the loop (as (key, file_id, size)) that have yet to be added
+        self.fileIDs = LRUCache(maxItems=file_id_cache_size)
+        self.learned = deque()
+        self.fileIDsFile = None
+        self.unsaved = 0
+        # How the sends have gone
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.uploaded = 0
+        self.uploadedBytes = 0
+        self.reused = 0
+        self.savedBytes = 0
 
     # Adds a single event handler
     def addHandler (self, text, func):
-        handlers[text] = func
-    
+        self.handlers[text] = func
+
+    # Starts the event loop thread
+    def start (self):
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.daemon = True
+        thread.start()
+        asyncio.run_coroutine_threadsafe(self.makeOutbox(), self.loop).result()
+        self.running = asyncio.run_coroutine_threadsafe(self.outbox.run(),
+                                                        self.loop)
+
+    async def makeOutbox (self):
+        self.outbox = Outbox(self.call, self.slots.release)
+        self.outbox.share(self.workers)
+
+    # Tells the bot how many workers are sending for it, so it sends its
+    # share of the limit
+    def share (self, workers):
+        self.workers = workers
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.outbox.share, workers)
+
     # Sends a text message to the specified chat_id
     def sendMessage (self, chat_id = None, text = None):
         if (chat_id != None and text != None):
-            r = requests.post('https://api.telegram.org/bot' + self.token +
-                              '/sendMessage' +
-                              '?chat_id=' + str(chat_id) +
-                              '&text='    + text)
-            while r.status_code != requests.codes.ok:
-                r = requests.post('https://api.telegram.org/bot' + self.token +
-                                  '/sendMessage' +
-                                  '?chat_id=' + str(chat_id) +
-                                  '&text='    + text)
-    
-    # Sends as photo using multipart-formdata
-    # Note that photo is a file-like object (like a StringIO object)
-    def sendImage (self, chat_id = None, photo = None):
+            self.submit(chat_id, 'sendMessage',
+                        lambda: {'chat_id': str(chat_id), 'text': text},
+                        text_priority)
+
+    # Sends as photo using multipart-formdata, replacing any image for the
+    # chat that's still waiting to go. Given a key that identifies the
+    # image, an image already sent under the same key is sent by its
+    # file_id instead (and uploaded after all if Telegram won't have it).
+    # The caption, if any, goes under it and isn't part of what the key
+    # identifies. filename and content_type say what kind of image it is.
+    # Note that photo is a file-like object (like a BytesIO object)
+    def sendImage (self, chat_id = None, photo = None,
+                   filename = 'board-image.png', key = None, caption = None,
+                   content_type = 'image/png'):
         if (chat_id != None and photo != None):
-            data = { 'chat_id' : str(chat_id) }
-            files = { 'photo' : ('board-image.png', photo) }
-            requests.post('https://api.telegram.org/bot' + self.token +
-                          '/sendPhoto', data = data, files = files)
-    
-    
\ No newline at end of file
+            data = photo.read()
+            known = None
+            if key != None:
+                self.learn()
+                known = self.fileIDs.get(key)
+            uploaded = known == None
+            def upload ():
+                nonlocal uploaded
+                uploaded = True
+                form = aiohttp.FormData()
+                form.add_field('chat_id', str(chat_id))
+                if caption != None:
+                    form.add_field('caption', caption)
+                form.add_field('photo', data, filename=filename,
+                               content_type=content_type)
+                return form
+            def sent (result):
+                self.noteSent(key, result, uploaded, len(data))
+            if known == None:
+                self.submit(chat_id, 'sendPhoto', upload, image_priority,
+                            True, then=sent)
+            else:
+                def byID ():
+                    fields = {'chat_id': str(chat_id), 'photo': known}
+                    if caption != None:
+                        fields['caption'] = caption
+                    return fields
+                self.submit(chat_id, 'sendPhoto', byID, image_priority, True,
+                            upload, sent)
+
+    # Runs on the loop: counts a photo of size bytes that was sent (uploaded
+    # or not), and notes the file_id Telegram gave it under key for the
+    # worker's thread to pick up
+    def noteSent (self, key, result, uploaded, size):
+        if result == None or not result.get('photo'):
+            return
+        if uploaded:
+            self.uploaded += 1
+            self.uploadedBytes += size
+        else:
+            self.reused += 1
+            self.savedBytes += size
+        if key != None:
+            # Telegram sends every size it made of the photo, biggest last
+            self.learned.append((key, result['photo'][-1]['file_id']))
+
+    # Adds the file_ids learned since last time, saving them now and then
+    def learn (self):
+        while len(self.learned) > 0:
+            (key, fileID) = self.learned.popleft()
+            if self.fileIDs.entries.get(key) != fileID:
+                self.unsaved += 1
+            self.fileIDs.put(key, fileID)
+        if self.unsaved >= file_id_save_every:
+            self.saveFileIDs()
+
+    # Loads the file_ids saved in path, where they'll be saved from now on,
+    # after those saved in any of the paths in others (by other workers,
+    # whose images can be sent by their file_ids just the same). Ours are
+    # loaded last, so they're the last to be forgotten. file_ids only work
+    # for the bot that was given them, so any saved by another bot are left
+    # out.
+    def loadFileIDs (self, path, others=()):
+        self.fileIDsFile = path
+        for other in others:
+            if other != path:
+                self.readFileIDs(other)
+        self.readFileIDs(path)
+
+    def readFileIDs (self, path):
+        try:
+            with open(path, 'rb') as f:
+                saved = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as ex:
+            print("Error loading file_ids!")
+            print("exception: " + str(ex))
+            return
+        if saved['bot'] == self.botID():
+            for (key, fileID) in saved['fileIDs']:
+                self.fileIDs.put(key, fileID)
+
+    # Saves the file_ids (least recently used first, so they load in the
+    # same order), if loadFileIDs said where
+    def saveFileIDs (self):
+        self.unsaved = 0
+        if self.fileIDsFile == None:
+            return
+        saved = {'bot': self.botID(),
+                 'fileIDs': [(key, self.fileIDs.entries[key])
+                             for key in self.fileIDs.keys()]}
+        try:
+            with open(self.fileIDsFile + '.tmp', 'wb') as f:
+                pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(self.fileIDsFile + '.tmp', self.fileIDsFile)
+        except Exception as ex:
+            print("Error saving file_ids!")
+            print("exception: " + str(ex))
+
+    # The bot's own ID, the part of the token before the colon
+    def botID (self):
+        return self.token.split(':')[0]
+
+    # Queues a call of method for chat_id, with the data makeData makes (a
+    # new one for every try, as a form can only be sent once). Waits if
+    # there are already max_in_flight sends. If the call fails, it's made
+    # with the data fallback makes, if given. then is called on the loop
+    # with the result (None if the send failed or was replaced).
+    def submit (self, chat_id, method, makeData, priority, replaceable=False,
+                fallback=None, then=None):
+        if self.loop == None:
+            self.start()
+        self.slots.acquire()
+        self.loop.call_soon_threadsafe(self.put, str(chat_id), method,
+                                       makeData, priority, replaceable,
+                                       fallback, then)
+
+    # Runs on the loop: puts a send in the outbox
+    def put (self, chat, method, makeData, priority, replaceable, fallback,
+             then):
+        result = self.outbox.put(chat, method, makeData, priority,
+                                 replaceable, fallback)
+        if then != None:
+            result.add_done_callback(lambda done: then(done.result()))
+
+    # Runs on the loop: makes the call, retrying when Telegram says to (after
+    # the retry_after it asks for) or the request fails (after an
+    # exponential backoff with jitter). Returns the result, or None if it
+    # gave up.
+    async def call (self, method, makeData):
+        if self.session == None:
+            connector = aiohttp.TCPConnector(limit=max_connections)
+            self.session = aiohttp.ClientSession(connector=connector)
+        url = api_base + '/bot' + self.token + '/' + method
+        backoff = base_backoff
+        start = perf_counter()
+        for attempt in range(max_retries + 1):
+            wait = None
+            try:
+                async with self.session.post(url, data=makeData()) as r:
+                    reply = await r.json(content_type=None)
+                if reply.get('ok'):
+                    self.sent += 1
+                    metrics.histogram('api_seconds', method=method).record(
+                        perf_counter() - start)
+                    metrics.count('api_calls_total', method=method,
+                                  outcome='sent')
+                    return reply.get('result')
+                parameters = reply.get('parameters') or {}
+                if 'retry_after' in parameters:
+                    wait = parameters['retry_after'] + random.uniform(0, 1)
+                    metrics.count('api_calls_total', method=method,
+                                  outcome='limited')
+                elif r.status < 500:
+                    # Retrying won't make a bad request good
+                    print("Error sending " + method + ": " +
+                          str(reply.get('description')))
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+                print("Error sending " + method + ": " + str(ex))
+            if attempt == max_retries:
+                break
+            if wait == None:
+                wait = random.uniform(0, backoff)
+                backoff = min(backoff * 2, max_backoff)
+            self.retries += 1
+            await asyncio.sleep(wait)
+        self.failed += 1
+        metrics.histogram('api_seconds', method=method).record(
+            perf_counter() - start)
+        metrics.count('api_calls_total', method=method, outcome='failed')
+        return None
+
+    # Waits until everything sent so far is done (sent or given up on)
+    def flush (self):
+        if self.loop == None:
+            return
+        asyncio.run_coroutine_threadsafe(self.outbox.drain(),
+                                         self.loop).result()
+
+    # Finishes what's been sent and stops the loop
+    def close (self):
+        if self.loop == None:
+            return
+        self.flush()
+        self.learn()
+        self.saveFileIDs()
+        self.running.cancel()
+        if self.session != None:
+            asyncio.run_coroutine_threadsafe(self.session.close(),
+                                             self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop = None
+        self.session = None
+
+# A message from an update, as the handlers see it
+class Message:
+
+    def __init__ (self, message):
+        self.chat_id = message['chat']['id']
+        self.text = message.get('text', '')
+
+# An update as it comes from getUpdates (a dict decoded from the JSON),
+# wrapped so the handlers can use update.update_id and
+# update.message.chat_id. The poller passes the dicts to the workers as
+# they are, which are cheaper to send between processes.
+class Update:
+
+    def __init__ (self, update):
+        self.update_id = update['update_id']
+        self.message = Message(update['message'])
@@ -0,0 +1,78 @@
+# Contains a small least-recently-used cache, shared by the things that
+# cache (rendered images, boards and so on).
+
+# Keeps its keys in the order they were used
+from collections import OrderedDict
+
+# A least-recently-used cache, bounded by a number of entries, a total size
+# or both. The size of an entry is whatever sizeOf says it is (by default
+# every entry has size 1). When adding an entry goes over a bound, the
+# least recently used entries are evicted until it doesn't.
+class LRUCache:
+
+    # Initializes an empty cache. None means no bound.
+    def __init__ (self, maxItems=None, maxBytes=None, sizeOf=None):
+        self.entries = OrderedDict()
+        self.maxItems = maxItems
+        self.maxBytes = maxBytes
+        if sizeOf == None:
+            sizeOf = lambda value: 1
+        self.sizeOf = sizeOf
+        self.bytes = 0
+
+        # Some statistics, to see if the cache is pulling its weight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Gets the value for key (marking it as recently used), or default if
+    # it isn't cached
+    def get (self, key, default=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    # Caches value for key, evicting what has to go to make room. A value
+    # bigger than the whole byte budget isn't cached at all.
+    def put (self, key, value):
+        size = self.sizeOf(value)
+        if self.maxBytes != None and size > self.maxBytes:
+            self.discard(key)
+            return
+        self.discard(key)
+        self.entries[key] = value
+        self.bytes += size
+        while ((self.maxItems != None and len(self.entries) > self.maxItems) or
+               (self.maxBytes != None and self.bytes > self.maxBytes)):
+            (old, oldValue) = self.entries.popitem(last=False)
+            self.bytes -= self.sizeOf(oldValue)
+            self.evictions += 1
+
+    # Removes key from the cache, if it's there
+    def discard (self, key):
+        if key in self.entries:
+            self.bytes -= self.sizeOf(self.entries.pop(key))
+
+    # Empties the cache
+    def clear (self):
+        self.entries.clear()
+        self.bytes = 0
+
+    # The fraction of lookups that were hits
+    def hitRatio (self):
+        if self.hits + self.misses == 0:
+            return 0.0
+        return self.hits / (self.hits + self.misses)
+
+    # The keys, least recently used first
+    def keys (self):
+        return list(self.entries)
+
+    def __contains__ (self, key):
+        return key in self.entries
+
+    def __len__ (self):
+        return len(self.entries)
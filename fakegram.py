@@ -0,0 +1,357 @@
+#!venv/bin/python3
+
+# A stand-in for the Telegram Bot API, to run the bot against locally, and
+# a load test that does so. It understands just what the bot uses:
+#   getUpdates  - hands out the updates it's been given, long polling like
+#                 the real thing
+#   sendMessage - and sendPhoto, which it counts and answers with success,
+#                 after delay seconds (like a round trip to the real thing).
+#                 If limitEvery is set, every limitEvery-th send is turned
+#                 away with a 429 and retry_after, like Telegram's flood
+#                 control. So is any send beyond perSecond in a second, or
+#                 perChat in a second to one chat, if they're set. Photos
+#                 can be uploaded (taking as long as they would at
+#                 bandwidth bytes a second, if set) or sent again by the
+#                 file_id they were given.
+# Run with
+#   python3 fakegram.py [chats] [moves] [workers ...]
+# to play moves moves in each of chats games at once through the whole bot
+# (poller, queues, workers, drawing and sending) for each number of
+# workers, with and without coalescing, and report how many moves per
+# second it managed and what it sent. Nothing is sent anywhere; games are
+# saved to a temporary directory.
+
+# So we can get our arguments
+import sys
+
+# For the server
+import json
+import re
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# To run the bot in its own process, and stop it
+import subprocess
+import signal
+import tempfile
+
+# For timing
+from time import monotonic, sleep
+
+# The fake API
+class FakeTelegram:
+
+    def __init__ (self, port=0, delay=0, limitEvery=0, retryAfter=1,
+                  perSecond=0, perChat=0, bandwidth=0):
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.limitEvery = limitEvery
+        self.retryAfter = retryAfter
+        self.perSecond = perSecond
+        self.perChat = perChat
+        self.attempts = 0
+        self.limited = 0
+        # When the sends of the last second were made, in all and by chat
+        self.recent = deque()
+        self.recentByChat = {}
+        self.updates = []
+        self.nextUpdate = 1
+        # How many messages and photos have been sent to each chat
+        self.messages = {}
+        self.photos = {}
+        self.photoBytes = 0
+        # The file_ids given out, and how many photos were sent by them
+        self.fileIDs = set()
+        self.reused = 0
+        self.replies = 0
+        # When the last one was sent
+        self.lastReply = None
+        self.polls = 0
+        # The last update the bot has confirmed getting, by asking for the
+        # ones after it
+        self.confirmed = 0
+        self.changed = threading.Condition()
+
+        fake = self
+        class Handler (BaseHTTPRequestHandler):
+            # Keep connections open, as the real thing does
+            protocol_version = 'HTTP/1.1'
+            # Don't hold the body back until the headers are acknowledged
+            disable_nagle_algorithm = True
+            def log_message (self, format, *args):
+                pass
+            def do_GET (self):
+                fake.handle(self)
+            def do_POST (self):
+                fake.handle(self)
+        class Server (ThreadingHTTPServer):
+            daemon_threads = True
+            # Room for every connection the bot opens at once
+            request_queue_size = 64
+        self.server = Server(('127.0.0.1', port), Handler)
+        self.port = self.server.server_port
+
+    # Where the bot should find us, for bot.api_base
+    def url (self):
+        return 'http://127.0.0.1:' + str(self.port)
+
+    # Serves requests on a background thread
+    def start (self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop (self):
+        self.server.shutdown()
+
+    # Adds a text message to chat as the next update
+    def addUpdate (self, chat, text):
+        with self.changed:
+            self.updates.append({'update_id': self.nextUpdate,
+                                 'message': {'chat': {'id': chat},
+                                             'text': text}})
+            self.nextUpdate += 1
+            self.changed.notify_all()
+
+    # Waits until the bot has sent count replies in all, returning whether
+    # it did within timeout seconds
+    def waitForReplies (self, count, timeout):
+        deadline = monotonic() + timeout
+        with self.changed:
+            while self.replies < count:
+                if monotonic() >= deadline:
+                    return False
+                self.changed.wait(deadline - monotonic())
+        return True
+
+    # Waits until the bot has confirmed getting every update so far,
+    # returning whether it did within timeout seconds
+    def waitForConfirmed (self, timeout):
+        deadline = monotonic() + timeout
+        with self.changed:
+            while self.confirmed < self.nextUpdate - 1:
+                if monotonic() >= deadline:
+                    return False
+                self.changed.wait(deadline - monotonic())
+        return True
+
+    # Waits until the bot has asked for updates at least once
+    def waitForPoll (self, timeout):
+        deadline = monotonic() + timeout
+        with self.changed:
+            while self.polls == 0 and monotonic() < deadline:
+                self.changed.wait(deadline - monotonic())
+        return self.polls > 0
+
+    # Answers a request to /bot<token>/<method>
+    def handle (self, request):
+        url = urlparse(request.path)
+        query = parse_qs(url.query)
+        method = url.path.split('/')[-1]
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length)
+        if method == 'getUpdates':
+            result = self.getUpdates(query)
+        elif method in ['sendMessage', 'sendPhoto']:
+            sleep(self.delay)
+            chat = self.field('chat_id', query, body)
+            if self.limit(chat):
+                self.reply(request, 429, {'ok': False, 'error_code': 429,
+                                          'description': 'Too Many Requests',
+                                          'parameters': {'retry_after':
+                                                         self.retryAfter}})
+                return
+            if method == 'sendMessage':
+                result = self.sent(self.messages, chat)
+            elif request.headers.get('Content-Type', '').startswith(
+                    'multipart/'):
+                if self.bandwidth > 0:
+                    sleep(length / self.bandwidth)
+                self.photoBytes += length
+                result = self.sent(self.photos, chat)
+                fileID = 'photo-' + str(result['message_id'])
+                with self.changed:
+                    self.fileIDs.add(fileID)
+                result['photo'] = [{'file_id': fileID}]
+            else:
+                fileID = self.field('photo', query, body)
+                if fileID not in self.fileIDs:
+                    self.reply(request, 400, {'ok': False, 'error_code': 400,
+                                              'description': 'Bad Request: '
+                                              'wrong file identifier'})
+                    return
+                result = self.sent(self.photos, chat)
+                with self.changed:
+                    self.reused += 1
+                result['photo'] = [{'file_id': fileID}]
+        else:
+            self.reply(request, 404, {'ok': False, 'error_code': 404,
+                                      'description': 'Not Found'})
+            return
+        self.reply(request, 200, {'ok': True, 'result': result})
+
+    # Whether to turn this send to chat away
+    def limit (self, chat):
+        with self.changed:
+            self.attempts += 1
+            now = monotonic()
+            recent = self.recentByChat.setdefault(chat, deque())
+            for times in [self.recent, recent]:
+                while len(times) > 0 and times[0] <= now - 1:
+                    times.popleft()
+            every = self.limitEvery > 0 and self.attempts % self.limitEvery == 0
+            tooMany = self.perSecond > 0 and len(self.recent) >= self.perSecond
+            tooManyHere = self.perChat > 0 and len(recent) >= self.perChat
+            if every or tooMany or tooManyHere:
+                self.limited += 1
+                return True
+            self.recent.append(now)
+            recent.append(now)
+        return False
+
+    # A field of a request, from the query string or either kind of form.
+    # Multipart forms are searched rather than parsed.
+    def field (self, name, query, body):
+        if name in query:
+            return query[name][0]
+        found = re.search(rb'name="' + name.encode() +
+                          rb'"[^\r]*\r\n(?:[^\r]+\r\n)*\r\n([^\r]*)', body)
+        if found != None:
+            return found.group(1).decode()
+        return parse_qs(body.decode(errors='replace'))[name][0]
+
+    def reply (self, request, status, answer):
+        data = json.dumps(answer).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        try:
+            request.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The bot gave up on a long poll, which it does when stopping
+            pass
+
+    # The updates from offset on, waiting up to timeout seconds for some
+    def getUpdates (self, query):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['100'])[0])
+        timeout = float(query.get('timeout', ['0'])[0])
+        deadline = monotonic() + timeout
+        with self.changed:
+            self.polls += 1
+            self.confirmed = max(self.confirmed, offset - 1)
+            self.changed.notify_all()
+            while True:
+                # Update ids are handed out in order from 1
+                waiting = self.updates[max(offset - 1, 0):]
+                if len(waiting) > 0 or monotonic() >= deadline:
+                    return waiting[:limit]
+                self.changed.wait(deadline - monotonic())
+
+    # Counts something sent to chat
+    def sent (self, counts, chat):
+        with self.changed:
+            chat = int(chat)
+            counts[chat] = counts.get(chat, 0) + 1
+            self.replies += 1
+            self.lastReply = monotonic()
+            self.changed.notify_all()
+            return {'message_id': self.replies, 'chat': {'id': chat}}
+
+# Runs the bot (in this process) against the fake API at url, saving games
+# under directory. Used by loadTest, in a process of its own.
+def runBot (url, numWorkers, directory, window):
+    import bot
+    import metrics
+    import poller
+    import processing
+    import supervisor
+    import worker
+    if window < 0:
+        worker.coalesce = False
+        window = 0
+    worker.coalesce_window = window
+    bot.api_base = url
+    poller.offset_file = directory + '/offset.txt'
+    worker.file_ids_file = directory + '/file_ids-%d.p'
+    metrics.stats_file = directory + '/metrics-%s.prom'
+    processing.storage = processing.open_storage('files', directory + '/',
+                                                 None)
+    supervisor.run(numWorkers, 'fake')
+
+# The text of a move command
+def moveText (player, row, col):
+    return '/' + player[0].lower() + ' ' + chr(ord('a') + col) + str(row + 1)
+
+# Plays moves moves in each of chats games through the bot running with
+# numWorkers workers coalescing over window seconds (a negative window
+# turns coalescing off). Each round of moves, one per chat, arrives gap
+# seconds after the last, and the bot is stopped once it has them all,
+# which it does after handling them. The clock stops when the bot has
+# confirmed getting the last update, or at its last reply if that comes
+# later, so stopping the bot and its processes exiting aren't counted.
+# Returns the moves handled per second and the number of photos and
+# messages sent.
+def loadTest (chats, moves, numWorkers, window=0.05, gap=0.0, size=9):
+    # Only needed here
+    from bench import randomGame
+
+    fake = FakeTelegram()
+    fake.start()
+    directory = tempfile.mkdtemp()
+    process = subprocess.Popen([sys.executable, __file__, '--bot', fake.url(),
+                                str(numWorkers), directory, str(window)],
+                               stdout=subprocess.DEVNULL)
+    if not fake.waitForPoll(30):
+        process.kill()
+        raise RuntimeError("The bot never asked for updates")
+
+    games = [list(randomGame(size, moves, seed=chat)) for chat in range(chats)]
+    start = monotonic()
+    for i in range(moves):
+        for chat in range(chats):
+            if i < len(games[chat]):
+                (player, row, col) = games[chat][i][2]
+                fake.addUpdate(chat + 1, moveText(player, row, col))
+        sleep(gap)
+    if not fake.waitForConfirmed(600):
+        process.kill()
+        raise RuntimeError("The bot didn't get every update")
+    confirmed = monotonic()
+    process.send_signal(signal.SIGTERM)
+    process.wait()
+    spent = max(confirmed, fake.lastReply or confirmed) - start
+    fake.stop()
+    return ((fake.nextUpdate - 1) / spent, sum(fake.photos.values()),
+            sum(fake.messages.values()))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--bot':
+        runBot(sys.argv[2], int(sys.argv[3]), sys.argv[4], float(sys.argv[5]))
+        sys.exit(0)
+
+    chats = 16
+    moves = 40
+    counts = [1, 2, 4]
+    gap = 0.02
+    if len(sys.argv) > 1:
+        chats = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        moves = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        counts = [int(arg) for arg in sys.argv[3:]]
+    print("%d chats, %d moves each, a round every %.2fs" % (chats, moves, gap))
+    print("%8s %10s %12s %10s %10s" % ("workers", "window", "moves/sec",
+                                       "photos", "messages"))
+    for numWorkers in counts:
+        for window in [-1, 0, 0.05, 0.2]:
+            (rate, photos, messages) = loadTest(chats, moves, numWorkers,
+                                                window, gap)
+            label = 'off'
+            if window >= 0:
+                label = '%.2f' % window
+            print("%8d %10s %12.1f %10d %10d" % (numWorkers, label, rate,
+                                                 photos, messages))
@@ -7,23 +7,10 @@ import sys
 
 # So we can save the board
 import os.path
-from os import mkdir, fork
-import pickle
+from os import mkdir
 
-# To lock and unlock files
-import fcntl
-
-# The queues
-from collections import deque
-
-# The worker functions
-import worker
-
-# The poller functions
-import poller
-
-# Size of the board
-default_board_size = 9
+# Runs the poller and the workers
+import supervisor
 
 # Directory for save files
 save_dir = 'games/'
@@ -31,22 +18,11 @@ save_dir = 'games/'
 if not os.path.isdir(save_dir):
     mkdir(save_dir)
 
-# Process our arguments
-numWorkers = sys.argv[1]
-
-# Initialize the worker queues
-if not os.path.isdir('queues/'):
-    mkdir('queues')
-for i in range(numWorkers):
-    f = open('queues/' + str(i) + '_queue.p')
-    pickle.dump(deque(), f, pickle.HIGHEST_PROTOCOL)
-    f.close()
-
-# Start the poller and workers
-val = os.fork()
+# Process our arguments: the number of workers, which defaults to one per
+# core
+numWorkers = None
+if len(sys.argv) > 1:
+    numWorkers = int(sys.argv[1])
 
-# If the child
-if val == 0:
-    worker.run()
-else: # The parent, and we should run the poller
-    poller.run()
\ No newline at end of file
+# Run until we're told to stop
+supervisor.run(numWorkers)
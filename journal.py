@@ -0,0 +1,205 @@
+# Contains the on-disk format for saved games. Rather than pickling the
+# whole Board after every event, each chat has
+#   * a snapshot: the pickled Board as of some point, tagged with a
+#     generation number
+#   * an append-only log of the events since that snapshot, one fixed-width
+#     record per event, named after the snapshot's generation
+# Saving an event is a single small append. Every snapshot_every events the
+# board is snapshotted again under the next generation, which starts a new
+# (empty) log, and the old log is removed. Loading reads the snapshot and
+# replays whatever is in its log.
+
+# To find, replace and remove files
+import os
+
+# For the records and the snapshot header
+import struct
+import zlib
+
+# To save the snapshots
+import pickle
+
+# To lock and unlock files
+import fcntl
+
+# Players are saved by their board code
+from board import codes, players
+
+# Events names
+import events
+
+# One record per event: the update_id, event type, player code, row and
+# column, followed by a CRC32 of all of that so that a record torn by a
+# crash in the middle of a write can be told apart from a real one
+body = struct.Struct('<qBBbb')
+checksum = struct.Struct('<I')
+record_size = body.size + checksum.size
+
+# Snapshots start with their generation, followed by the pickled Board
+header = struct.Struct('<Q')
+
+# How many events a log can get to before the board is snapshotted again
+snapshot_every = 64
+
+# Whether to fsync the log after every append. Without it an event is only
+# as safe as the OS's write cache, which is usually good enough for a game.
+sync_appends = False
+
+# Packs an event into a record
+def encode_event(evt):
+    (date, kind, args) = evt
+    if args == None:
+        (player, row, col) = (0, 0, 0)
+    else:
+        (player, row, col) = (codes[args[0]], args[1], args[2])
+    data = body.pack(date, kind, player, row, col)
+    return data + checksum.pack(zlib.crc32(data))
+
+# Unpacks as many whole, intact records as there are at the start of data.
+# Returns the events and how many bytes of data they took up, so anything
+# after that is a torn or corrupt tail.
+def decode_events(data):
+    evts = []
+    end = len(data) - len(data) % record_size
+    for start in range(0, end, record_size):
+        raw = data[start:start + body.size]
+        (crc,) = checksum.unpack_from(data, start + body.size)
+        if zlib.crc32(raw) != crc:
+            return (evts, start)
+        (date, kind, player, row, col) = body.unpack(raw)
+        if kind == events.undo:
+            evts.append((date, kind, None))
+        else:
+            evts.append((date, kind, (players[player], row, col)))
+    return (evts, end)
+
+# The files of one chat's game
+class GameLog:
+
+    def __init__ (self, directory, chat_id):
+        self.prefix = directory + str(chat_id)
+        # The generation of the current snapshot (0 if there isn't one),
+        # None until we've looked
+        self.generation = None
+        # How many events are in the current log
+        self.records = 0
+
+    def snapshotPath (self):
+        return self.prefix + '.snap'
+
+    def logPath (self):
+        return self.prefix + '.' + str(self.generation) + '.log'
+
+    # Where games were saved before there were logs: a pickled Board
+    def legacyPath (self):
+        return self.prefix + '.p'
+
+    # Reads the current snapshot, returning the Board (or None if the game
+    # has never been saved) and sets the generation
+    def readSnapshot (self):
+        if os.path.isfile(self.snapshotPath()):
+            f = open(self.snapshotPath(), 'rb')
+            (self.generation,) = header.unpack(f.read(header.size))
+            board = pickle.load(f)
+            f.close()
+            return board
+        # An old pickled game counts as generation 0, which has no log yet
+        self.generation = 0
+        if os.path.isfile(self.legacyPath()):
+            f = open(self.legacyPath(), 'rb')
+            board = pickle.load(f)
+            f.close()
+            return board
+        return None
+
+    # Loads the game: the latest snapshot with the events of its log
+    # replayed on top. A torn record at the end of the log (from a crash
+    # part way through an append) is cut off, unless repair is False, when
+    # the files are only read. Either way, self.torn is how many bytes of
+    # it there were. Returns None if the game has never been saved.
+    def load (self, repair=True):
+        board = self.readSnapshot()
+        self.records = 0
+        self.torn = 0
+        if not os.path.isfile(self.logPath()):
+            return board
+        if repair:
+            f = open(self.logPath(), 'r+b')
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f = open(self.logPath(), 'rb')
+            fcntl.flock(f, fcntl.LOCK_SH)
+        data = f.read()
+        (evts, good) = decode_events(data)
+        self.torn = len(data) - good
+        if self.torn > 0 and repair:
+            print("Dropping " + str(self.torn) + " torn bytes from " +
+                  self.logPath())
+            f.truncate(good)
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+        board.addEvents(evts)
+        self.records = len(evts)
+        return board
+
+    # Appends events that have been applied to board to the log, and
+    # snapshots the board if the log has grown long enough
+    def append (self, board, evts):
+        if self.generation == None:
+            self.readGeneration()
+        # A log needs something to be replayed on top of, so a game that has
+        # never been saved starts with a snapshot (which has the events)
+        if self.generation == 0 and not os.path.isfile(self.legacyPath()):
+            self.snapshot(board)
+            return
+        f = open(self.logPath(), 'ab')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(b''.join([encode_event(evt) for evt in evts]))
+        f.flush()
+        if sync_appends:
+            os.fsync(f.fileno())
+        self.records = f.tell() // record_size
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+        if self.records >= snapshot_every:
+            self.snapshot(board)
+
+    # Writes board out as the next generation's snapshot, and removes what
+    # it replaces. The snapshot is written to the side and renamed into
+    # place, so a crash leaves either the old snapshot and log or the new
+    # snapshot (with a log that doesn't exist yet).
+    def snapshot (self, board):
+        if self.generation == None:
+            self.readGeneration()
+        old = self.logPath()
+        temp = self.snapshotPath() + '.tmp'
+        f = open(temp, 'wb')
+        f.write(header.pack(self.generation + 1))
+        pickle.dump(board, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        # A log for the new generation can only be left over from a snapshot
+        # that couldn't be read (and so whose generation was wrong), and
+        # mustn't be replayed on top of this one
+        stale = self.prefix + '.' + str(self.generation + 1) + '.log'
+        if os.path.isfile(stale):
+            os.remove(stale)
+        os.replace(temp, self.snapshotPath())
+        self.generation += 1
+        self.records = 0
+        for path in [old, self.legacyPath()]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    # Finds out the current generation without reading the whole snapshot.
+    # A snapshot too short to have one counts as generation 0, so it can be
+    # replaced.
+    def readGeneration (self):
+        self.generation = 0
+        if os.path.isfile(self.snapshotPath()):
+            f = open(self.snapshotPath(), 'rb')
+            data = f.read(header.size)
+            f.close()
+            if len(data) == header.size:
+                (self.generation,) = header.unpack(data)
@@ -0,0 +1,319 @@
+# Counts and times what a process does, and writes it out for Prometheus.
+#
+# Each process (the poller and every worker) keeps its own metrics and
+# every write_every seconds writes them to its own stats file in the
+# Prometheus text format, for node_exporter's textfile collector (point it
+# at the directory the files are in). Every series in a file is labelled
+# with the process it came from (see setProcess), so they don't clash.
+#
+# Timings go into histograms that keep a count for every value to within
+# an eighth (as HdrHistogram does, with three significant bits): a value
+# of v microseconds goes in a bucket 1/8 of a power of two wide, so a
+# record is a shift and an add, however many values there are. They're
+# exported with the bucket bounds in export_buckets, and percentiles can
+# be read from them directly.
+#
+# Recording is meant to happen in the middle of handling updates, and costs
+# about a microsecond (see benchMetrics in bench.py). Histograms for a
+# fixed name are best looked up once and kept, as processing.py does.
+
+# For timing
+from time import perf_counter, monotonic
+
+# For writing the stats file
+import os
+
+# Whether anything is recorded at all
+enabled = True
+
+# Where each process writes its stats, by its name (see setProcess), and
+# how often (in seconds). None doesn't write them.
+stats_file = 'metrics-%s.prom'
+write_every = 15
+
+# Every metric's name starts with this
+prefix = 'gobot_'
+
+# The bucket bounds (in seconds) histograms are exported with
+export_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                  0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# What the metrics are, for the HELP lines
+descriptions = {
+    'handler_seconds': 'Time to handle an update, by command',
+    'handler_errors_total': 'Updates whose handler raised, by command',
+    'updates_total': 'Updates handled, by command',
+    'batch_seconds': 'Time to handle a batch of updates, save and send it',
+    'board_load_seconds': 'Time to get a board (cached or from storage)',
+    'board_save_seconds': 'Time to save a board',
+    'render_seconds': 'Time to draw (or patch) a board image',
+    'encode_seconds': 'Time to encode a board image',
+    'api_seconds': 'Time for a call to the Bot API, with its retries',
+    'api_calls_total': 'Calls to the Bot API, by method and outcome',
+    'poll_seconds': 'Time for a getUpdates request',
+    'updates_polled_total': 'Updates received from getUpdates',
+    'queue_depth': 'Updates waiting on a worker\'s queue',
+    'outbox_waiting': 'Sends queued or in flight in a worker\'s outbox',
+    'cache_hits_total': 'Cache lookups that found what they were after',
+    'cache_misses_total': 'Cache lookups that didn\'t',
+    'cache_hit_ratio': 'Fraction of cache lookups that were hits',
+    'cache_entries': 'Entries in a cache',
+}
+
+# Our metrics, by (name, labels), where labels is a tuple of (name, value)
+# pairs in order
+counters = {}
+histograms = {}
+gauges = {}
+
+# Called before every write, to set gauges and counters kept elsewhere
+collectors = []
+
+# What this process is called, and the labels that say so
+process = None
+process_labels = ()
+
+# When the stats were last written
+last_write = None
+
+# The key of a metric
+def seriesKey (name, labels):
+    return (name, tuple(sorted((key, str(value))
+                               for (key, value) in labels.items())))
+
+# Counts of values in buckets of about an eighth of their size. Values are
+# recorded in seconds and kept in whole microseconds.
+class Histogram:
+
+    def __init__ (self):
+        self.counts = []
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # The bucket of a value in microseconds: values up to 15 have one each,
+    # then each power of two is split into 8
+    @staticmethod
+    def bucket (micros):
+        shift = micros.bit_length() - 4
+        if shift <= 0:
+            return micros
+        return shift * 8 + (micros >> shift)
+
+    # The smallest value (in microseconds) in a bucket, and the smallest
+    # in the next one
+    @staticmethod
+    def bounds (index):
+        if index < 16:
+            return (index, index + 1)
+        shift = index // 8 - 1
+        low = index - shift * 8
+        return (low << shift, (low + 1) << shift)
+
+    def record (self, seconds):
+        if not enabled:
+            return
+        i = self.bucket(int(seconds * 1e6))
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # The value (in seconds) a fraction q of the values are below, to
+    # within the width of its bucket
+    def percentile (self, q):
+        if self.count == 0:
+            return 0.0
+        wanted = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count > 0:
+                return min(self.bounds(i)[1] / 1e6, self.max)
+        return self.max
+
+    # Forgets every value recorded
+    def reset (self):
+        self.counts = []
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # How many values are at most each bound (in seconds). A bucket only
+    # counts once all of it is, so this is low by up to an eighth.
+    def cumulative (self, bounds):
+        counts = []
+        seen = 0
+        i = 0
+        for bound in bounds:
+            while (i < len(self.counts) and
+                   self.bounds(i)[1] <= bound * 1e6 + 1e-9):
+                seen += self.counts[i]
+                i += 1
+            counts.append(seen)
+        return counts
+
+# The histogram name with labels, made the first time it's asked for
+def histogram (name, **labels):
+    key = seriesKey(name, labels)
+    if key not in histograms:
+        histograms[key] = Histogram()
+    return histograms[key]
+
+# Adds amount to a counter
+def count (name, amount=1, **labels):
+    if not enabled:
+        return
+    key = seriesKey(name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+# Sets a counter kept somewhere else (like a cache's hits)
+def setCount (name, value, **labels):
+    counters[seriesKey(name, labels)] = value
+
+def setGauge (name, value, **labels):
+    gauges[seriesKey(name, labels)] = value
+
+# Forgets every gauge called name, for a collector that sets them afresh
+def clearGauges (name):
+    for key in [key for key in gauges if key[0] == name]:
+        del gauges[key]
+
+# Wraps a function so every call of it is recorded in the histogram name
+def timed (name, **labels):
+    times = histogram(name, **labels)
+    def wrap (func):
+        def timedFunc (*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times.record(perf_counter() - start)
+        timedFunc.__name__ = func.__name__
+        timedFunc.__wrapped__ = func
+        return timedFunc
+    return wrap
+
+# Exports an LRUCache's (see cache.py) statistics under the label cache=name
+def watchCache (name, cache):
+    def collect ():
+        setCount('cache_hits_total', cache.hits, cache=name)
+        setCount('cache_misses_total', cache.misses, cache=name)
+        setGauge('cache_hit_ratio', cache.hitRatio(), cache=name)
+        setGauge('cache_entries', len(cache), cache=name)
+    collectors.append(collect)
+
+# Names this process, for its stats file and the labels on its series. A
+# process forked from another (as a worker the supervisor starts after the
+# poller is running is) starts with a copy of the other's metrics and
+# collectors, which aren't its own, so they're forgotten. Histograms are
+# emptied rather than dropped, as modules keep hold of theirs.
+def setProcess (name, **labels):
+    global process, process_labels, last_write
+    counters.clear()
+    gauges.clear()
+    for times in histograms.values():
+        times.reset()
+    del collectors[:]
+    last_write = None
+    process = name
+    process_labels = tuple(sorted((key, str(value))
+                                  for (key, value) in labels.items()))
+
+# A series' name and labels as Prometheus writes them. A label can only
+# appear once, so the process's labels replace any of the series' own with
+# the same name.
+def series (name, labels, extra=()):
+    taken = set(key for (key, value) in process_labels)
+    labels = process_labels + tuple((key, value)
+                                    for (key, value) in labels + extra
+                                    if key not in taken)
+    if len(labels) == 0:
+        return prefix + name
+    return (prefix + name + '{' +
+            ','.join(key + '="' + value.replace('\\', '\\\\')
+                     .replace('"', '\\"') + '"'
+                     for (key, value) in labels) + '}')
+
+# All our metrics in the Prometheus text format
+def export ():
+    for collect in collectors:
+        try:
+            collect()
+        except Exception as ex:
+            print("Error collecting metrics!")
+            print("exception: " + str(ex))
+    lines = []
+    # The dicts can gain series on the Bot's thread while we go through
+    # them, so go through copies
+    families = {}
+    for (kind, kept) in [('counter', counters), ('gauge', gauges),
+                         ('histogram', histograms)]:
+        for ((name, labels), value) in list(kept.items()):
+            # Histograms made by modules this process only imports (like
+            # processing.py's, in the poller) have nothing to say
+            if kind == 'histogram' and value.count == 0:
+                continue
+            families.setdefault((name, kind), []).append((labels, value))
+    for ((name, kind), members) in sorted(families.items()):
+        if name in descriptions:
+            lines.append('# HELP ' + prefix + name + ' ' + descriptions[name])
+        lines.append('# TYPE ' + prefix + name + ' ' + kind)
+        for (labels, value) in sorted(members, key=lambda m: m[0]):
+            if kind != 'histogram':
+                lines.append(series(name, labels) + ' ' + repr(float(value)))
+                continue
+            for (bound, seen) in zip(export_buckets,
+                                     value.cumulative(export_buckets)):
+                lines.append(series(name + '_bucket', labels,
+                                    (('le', repr(float(bound))),)) +
+                             ' ' + str(seen))
+            lines.append(series(name + '_bucket', labels, (('le', '+Inf'),)) +
+                         ' ' + str(value.count))
+            lines.append(series(name + '_sum', labels) + ' ' +
+                         repr(value.sum))
+            lines.append(series(name + '_count', labels) + ' ' +
+                         str(value.count))
+    return '\n'.join(lines) + '\n'
+
+# Writes our metrics to path, replacing what was there in one go so the
+# collector never reads half a file
+def write (path):
+    temporary = path + '.tmp'
+    f = open(temporary, 'w')
+    f.write(export())
+    f.close()
+    os.replace(temporary, path)
+
+# Writes our stats file if it's been write_every seconds since the last
+# time (or always, if force)
+def writeIfDue (force=False):
+    global last_write
+    if stats_file == None or process == None:
+        return
+    now = monotonic()
+    if not force and last_write != None and now - last_write < write_every:
+        return
+    last_write = now
+    try:
+        write(stats_file % process)
+    except Exception as ex:
+        print("Error writing metrics!")
+        print("exception: " + str(ex))
+
+# A line for each histogram with its count and percentiles, for printing
+# when a process stops
+def summary ():
+    lines = []
+    for ((name, labels), times) in sorted(list(histograms.items())):
+        if times.count == 0:
+            continue
+        label = ','.join(value for (key, value) in labels)
+        lines.append("%-28s %8d  p50 %8.2fms  p99 %8.2fms  max %8.2fms" % (
+            name + ('[' + label + ']' if label else ''), times.count,
+            times.percentile(0.5) * 1e3, times.percentile(0.99) * 1e3,
+            times.max * 1e3))
+    return lines
@@ -0,0 +1,57 @@
+#!venv/bin/python3
+
+# Copies saved games from files (old pickled boards, or snapshots and logs)
+# into a SQLite database. Run with
+#   python3 migrate.py [games directory] [database]
+# which default to games/ and games.db. The files are left where they are,
+# so nothing is lost if it goes wrong; a chat that's already in the
+# database is overwritten with what's in the files.
+
+# So we can get our arguments
+import sys
+
+# To find the saved games
+import os
+
+# Where games come from and go to
+from storage import FileStorage, SQLiteStorage
+
+# Returns the chats with a game saved in directory
+def savedChats (directory):
+    chats = set()
+    for name in os.listdir(directory):
+        if name.endswith('.p') or name.endswith('.snap'):
+            chats.add(name.split('.')[0])
+    return sorted(chats)
+
+def migrate (directory, database):
+    files = FileStorage(directory)
+    db = SQLiteStorage(database)
+    moved = 0
+    for chat in savedChats(directory):
+        try:
+            board = files.load(chat)
+        except Exception as ex:
+            print("Couldn't load " + chat + ": " + str(ex))
+            continue
+        files.discard(chat)
+        if board == None:
+            continue
+        db.snapshot(int(chat), board)
+        moved += 1
+        # Commit as we go so a big migration isn't one huge transaction
+        if moved % 1000 == 0:
+            db.commit()
+    db.commit()
+    print("Migrated " + str(moved) + " games into " + database)
+
+if __name__ == '__main__':
+    directory = 'games/'
+    database = 'games.db'
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    if len(sys.argv) > 2:
+        database = sys.argv[2]
+    if not directory.endswith('/'):
+        directory += '/'
+    migrate(directory, database)
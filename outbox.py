@@ -0,0 +1,206 @@
+# The queue a Bot's sends wait in until Telegram's limits let them go out.
+#
+# Telegram lets a bot send about 30 messages a second in all, and about one
+# a second to any one chat, and answers anything more with a 429. Each send
+# waits here for a token from a bucket for all chats and one from its own
+# chat's bucket. A chat's sends go out in the order they were made, one at
+# a time, but when several chats have one ready the images go first, as the
+# board is what players are waiting for. An image queued behind another for
+# the same chat replaces it, since only the newest board is worth sending.
+
+# The sends run on the Bot's event loop
+import asyncio
+
+# Sends a second for the bot as a whole, and how many can go at once after
+# a quiet spell. Shared between the workers (see Outbox.share). A burst
+# and a second's worth together stay within Telegram's limit.
+global_rate = 25
+global_burst = 5
+
+# Sends a second to any one chat, and how many can go at once (enough for
+# a message and the board that goes with it)
+chat_rate = 1
+chat_burst = 2
+
+# Whether a newer image replaces one still queued for the same chat
+supersede = True
+
+# The priority of each kind of send (lower goes first)
+image_priority = 0
+text_priority = 1
+
+# Tokens that build up at rate a second, up to burst of them
+class TokenBucket:
+
+    def __init__ (self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill (self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # How long until there's a token (0 if there's one now)
+    def wait (self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take (self):
+        self.tokens -= 1
+
+    # Whether it's as if it had never been used
+    def full (self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+# A send waiting in the outbox. If the call fails, it's made again with the
+# data fallback makes, if there is one. result is a future for what the call
+# returns (None if it failed or was replaced).
+class Send:
+
+    def __init__ (self, chat, method, makeData, priority, replaceable,
+                  fallback, sequence, result):
+        self.chat = chat
+        self.method = method
+        self.makeData = makeData
+        self.priority = priority
+        self.replaceable = replaceable
+        self.fallback = fallback
+        self.sequence = sequence
+        self.result = result
+
+# Must be made and used on the event loop. send is the coroutine that makes
+# a call (given its method and makeData), and finished is called once for
+# every send when it's done with, whether sent, given up on or replaced.
+class Outbox:
+
+    def __init__ (self, send, finished):
+        self.send = send
+        self.finished = finished
+        self.loop = asyncio.get_running_loop()
+        self.everyone = TokenBucket(global_rate, global_burst,
+                                    self.loop.time())
+        # The sends waiting for each chat, in order, and the chats with one
+        # being sent
+        self.queued = {}
+        self.busy = set()
+        self.buckets = {}
+        # The results of everything not yet done with
+        self.waiting = set()
+        self.sequence = 0
+        self.changed = asyncio.Event()
+        # Images replaced before they were sent
+        self.replaced = 0
+
+    # Telegram's limit is for the bot as a whole, so when there are workers
+    # workers each gets its share of it, and of the burst (though always
+    # enough for one send, or nothing would ever go)
+    def share (self, workers):
+        workers = max(workers, 1)
+        self.everyone.rate = global_rate / workers
+        self.everyone.burst = max(global_burst / workers, 1)
+        self.everyone.tokens = min(self.everyone.tokens, self.everyone.burst)
+
+    # Queues a call of method for chat, returning the future for its result
+    def put (self, chat, method, makeData, priority=text_priority,
+             replaceable=False, fallback=None):
+        queue = self.queued.setdefault(chat, [])
+        if replaceable and supersede:
+            for old in [s for s in queue if s.replaceable]:
+                queue.remove(old)
+                self.replaced += 1
+                self.done(old, None)
+        self.sequence += 1
+        send = Send(chat, method, makeData, priority, replaceable, fallback,
+                    self.sequence, self.loop.create_future())
+        queue.append(send)
+        self.waiting.add(send.result)
+        self.changed.set()
+        return send.result
+
+    def done (self, send, result):
+        self.waiting.discard(send.result)
+        if not send.result.done():
+            send.result.set_result(result)
+        self.finished()
+
+    # Starts sends as the buckets allow, for as long as it's running
+    async def run (self):
+        while True:
+            self.changed.clear()
+            wait = self.startReady()
+            try:
+                await asyncio.wait_for(self.changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    # Starts every send that can go now. Returns how long until another
+    # could, or None if nothing's waiting.
+    def startReady (self):
+        while True:
+            now = self.loop.time()
+            ready = [chat for chat in self.queued if chat not in self.busy]
+            if len(ready) == 0:
+                if len(self.queued) == 0 and len(self.busy) == 0:
+                    self.prune(now)
+                return None
+            wait = self.everyone.wait(now)
+            if wait > 0:
+                return wait
+            best = None
+            soonest = None
+            for chat in ready:
+                wait = self.bucket(chat, now).wait(now)
+                if wait > 0:
+                    if soonest == None or wait < soonest:
+                        soonest = wait
+                    continue
+                head = self.queued[chat][0]
+                if best == None or ((head.priority, head.sequence) <
+                                    (best.priority, best.sequence)):
+                    best = head
+            if best == None:
+                return soonest
+            self.start(best)
+
+    def bucket (self, chat, now):
+        if chat not in self.buckets:
+            self.buckets[chat] = TokenBucket(chat_rate, chat_burst, now)
+        return self.buckets[chat]
+
+    # Forgets the buckets of chats that have been quiet long enough to have
+    # filled up again
+    def prune (self, now):
+        self.buckets = {chat: bucket for (chat, bucket) in self.buckets.items()
+                        if not bucket.full(now)}
+
+    def start (self, send):
+        queue = self.queued[send.chat]
+        queue.pop(0)
+        if len(queue) == 0:
+            del self.queued[send.chat]
+        self.busy.add(send.chat)
+        self.everyone.take()
+        self.buckets[send.chat].take()
+        self.loop.create_task(self.deliver(send))
+
+    async def deliver (self, send):
+        result = None
+        try:
+            result = await self.send(send.method, send.makeData)
+            if result == None and send.fallback != None:
+                result = await self.send(send.method, send.fallback)
+        finally:
+            self.busy.discard(send.chat)
+            self.done(send, result)
+            self.changed.set()
+
+    # Waits until everything queued so far is done with
+    async def drain (self):
+        while len(self.waiting) > 0:
+            await asyncio.wait(list(self.waiting))
@@ -1,102 +1,191 @@
 # The poller that queries Telegram for bot updates.
-# Assumes it's the only poller enqueueing elements onto a number of queues.
+# Assumes it's the only poller enqueueing updates onto a number of queues,
+# one per worker.
 
 # Nice way to make HTTP get requests
 import requests
 
-# To read arguments
-import sys
-
-# For our queues
-from collections import deque
-
-# To lock and unlock files
-import fcntl
+# Where the Bot API is
+import bot
 
 # To read/write files
 import os
 
-# To serialize/deserialize objects
-import pickle
+# To be told to stop
+import signal
 
-# To yield
-from time import sleep
+# To wait after a failed request, and time the requests
+from time import sleep, perf_counter
 
-# Package as a function for go-lite-bot to run
-def run ():
-    # For ease of configuration, we pull our token from a text file located in the same directory
-    f = open('token.txt', 'r')
-    token = f.readline().strip()
-    f.close()
+# What we've been doing, for Prometheus
+import metrics
 
-    # Get the last update number so we don't do duplicates
-    f = open('offset.txt', 'r')
-    offset = int(f.readline.strip())
-    f.close()
+# How long (in seconds) Telegram may hold a getUpdates request open waiting
+# for an update before answering with none. Longer means fewer idle
+# requests.
+poll_timeout = 25
 
-    # Process our arguments, which should be safe since they're passed by start
-    queueDir = sys.argv[1]
-    numQueues = int(sys.argv[2])
+# While updates are being held back for a chat moving between workers, we
+# wait up to this long (in seconds) for the old worker to catch up and
+# then poll without waiting, so they're passed on soon after it does
+handoff_wait = 0.1
 
-    # Initialize our internal buffers to hold pending writes
-    writeBuffers = []
-    for i in range(numQueues):
-        writeBuffers.append(deque())
+# How long (in seconds) to wait before asking again after a failed
+# request, so we don't hammer the API while it's unreachable
+retry_delay = 1
 
-    # Continually request updates and pass them to the queues
-    while not canceled():
-        updates = getUpdates()
-        # If there's no updates, yield
-        if len(updates) == 0:
-            sleep(0)
-        else: # Apply them to the queues and write
-            for i in range(updates):
-                if  'message' in updates[i] and 'text' in updates[i].message:
-                    writeBuffers[hash(updates[i].message.chat.id) % numQueues].append(updates[i])
-            writeOut()
-
-# Gives the queue file name for queue i
-def queueName (i):
-    return queueDir + '/' + str(i) + '_queue.p'
+# Set once we've been told to stop
+stopping = False
+
+# Whether we're waiting on getUpdates, which is safe to give up on part
+# way as the offset hasn't moved
+waiting = False
+
+# Set when we're woken up to go around the loop early
+woken = False
+
+# Where the offset is kept between runs
+offset_file = 'offset.txt'
+
+# Raised out of a getUpdates we gave up on. Not an Exception, so it isn't
+# caught as a failed request.
+class Interrupted (BaseException):
+    pass
+
+# Handles SIGTERM and SIGINT: we stop taking updates, and if we're only
+# waiting for some we stop waiting
+def stop (signum=None, frame=None):
+    global stopping
+    stopping = True
+    if waiting:
+        raise Interrupted()
+
+# A signal handler that gives up waiting on getUpdates (if we are), so that
+# whatever run does between polls happens now. The supervisor uses it for
+# SIGCHLD, to restart a worker as soon as it dies.
+def wake (signum=None, frame=None):
+    global woken
+    woken = True
+    if waiting:
+        raise Interrupted()
 
 # Write out the new offset number
 def writeOffset (num):
-    f = open('offset.txt', 'w')
+    f = open(offset_file, 'w')
     f.write(str(num))
     f.close()
 
-# Check to see if we've been canceled
-def canceled ():
-    f = open('cancel.txt', 'r')
-    done = f.readline.strip()
+# Read the offset number, so we don't do duplicates after a restart
+def readOffset ():
+    if not os.path.isfile(offset_file):
+        return 0
+    f = open(offset_file, 'r')
+    offset = int(f.readline().strip() or 0)
     f.close()
-    return done == 'Yes'
-
-# Write out all buffers, appending elements to the appropriate queues
-def writeOut ():
-    for i in range(len(writeBuffers)):
-        f = open(queueName(i), 'r+')
-        fcntl.flock(f, fcntl.LOCK_EX)
-        workingQueue = pickle.load(f)
-        # Recall that later messages are at higher indices
-        # Workers read messages off the left, so we should add to the right
-        # in ascending order
-        for j in range(len(writeBuffers[i])):
-            workingQueue.append(writeBuffers[i].popLeft())
-        pickle.dump(writeBuffers[i], f, pickle.HIGHEST_PROTOCOL)
-        fcntl.flock(f, fcntl.LOCK_UN)
+    return offset
+
+# Get all updates from the server for our bot after offset, waiting up to
+# poll_timeout seconds for one if there aren't any. Returns the updates
+# (decoded JSON dicts, in order) or an empty list if the request failed.
+def getUpdates (token, offset, timeout=None):
+    if timeout == None:
+        timeout = poll_timeout
+    try:
+        r = requests.get(bot.api_base + '/bot' + token +
+                         '/getUpdates' +
+                         '?offset=' + str(offset) +
+                         '&limit=100' +
+                         '&timeout=' + str(timeout),
+                         timeout=timeout + 10)
+        reply = r.json()
+    except Exception as ex:
+        print("Error getting updates!")
+        print("exception: " + str(ex))
+        sleep(retry_delay)
+        return []
+    if not reply.get('ok'):
+        print("Error getting updates: " + str(reply.get('description')))
+        sleep(retry_delay)
+        return []
+    return reply['result']
+
+# Has our metrics export how many updates are waiting on each worker's
+# queue
+def watchQueues (router):
+    def collect ():
+        metrics.clearGauges('queue_depth')
+        for (node, queue) in list(router.queues.items()):
+            try:
+                depth = queue.qsize()
+            except NotImplementedError:
+                # Not on macOS
+                continue
+            metrics.setGauge('queue_depth', depth, worker=node)
+    metrics.collectors.append(collect)
+
+# Hands the text messages among updates to the router (see ring.py), which
+# puts each on the queue of the worker that owns its chat. Every update of
+# a chat goes to the same worker, so a chat's updates are handled in order
+# and only one worker ever has its game cached.
+def dispatch (updates, router):
+    for update in updates:
+        if 'message' in update and 'text' in update['message']:
+            router.dispatch(update)
+
+# Package as a function for the supervisor to run, with the router of the
+# workers. Runs until SIGTERM or SIGINT, then tells the workers to finish
+# what they have by putting None on their queues. If given, between is
+# called before every poll.
+def run (router, token=None, between=None):
+    global waiting, woken, stopping
+    stopping = False
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # For ease of configuration, we pull our token from a text file located in the same directory
+    if token == None:
+        f = open('token.txt', 'r')
+        token = f.readline().strip()
         f.close()
 
-# Get all updates from the server for our bot
-def getUpdates ():
-    r = requests.get('https://api.telegram.org/bot' + token + '/getUpdates' + 
-                     '?offset=' + str(offset) +
-                     '&limit=100')
-    # Updates are returned sequentially, update the offset
-    updates = r.json()
-    if (len(updates) > 0):
-        offset = updates[len(updates) - 1].update_id + 1
-        # Write out offset counter
-        writeOffset(offset)
-    return updates
+    # Get the last update number so we don't do duplicates
+    offset = readOffset()
+
+    metrics.setProcess('poller', process='poller')
+    watchQueues(router)
+    pollTime = metrics.histogram('poll_seconds')
 
+    # Continually request updates and pass them to the queues
+    while not stopping:
+        woken = False
+        if between != None:
+            between()
+        # While the router is holding updates back for a worker to catch
+        # up, come back soon to pass them on
+        timeout = poll_timeout
+        if router.holding():
+            router.collect(handoff_wait)
+            timeout = 0
+        try:
+            waiting = True
+            # If we were woken since between was called, go around again
+            # rather than waiting
+            updates = []
+            if not woken and not stopping:
+                start = perf_counter()
+                updates = getUpdates(token, offset, timeout)
+                pollTime.record(perf_counter() - start)
+        except Interrupted:
+            updates = []
+        finally:
+            waiting = False
+        metrics.writeIfDue()
+        if len(updates) > 0:
+            metrics.count('updates_polled_total', len(updates))
+            dispatch(updates, router)
+            # Updates are returned sequentially, update the offset
+            offset = updates[-1]['update_id'] + 1
+            writeOffset(offset)
+
+    router.stop()
+    metrics.writeIfDue(force=True)
@@ -7,17 +7,30 @@
 # instead, but that's not necessary for now.
 
 # Our game-board abstraction
-from board import Node, Empty, Board
+from board import Empty, Board
+
+# For the score
+import scoring
 
 # So we can draw the board
 from PIL import Image, ImageDraw, ImageFont
-from io import StringIO
+from io import BytesIO
 from math import ceil
 
+# So we don't draw the same board twice
+from cache import LRUCache
+
+# To time loading, saving and drawing boards
+from time import perf_counter
+import metrics
+
+# To give each chat its own background color
+import zlib
+
 # So we can save the board
 import os.path
 from os import mkdir
-import pickle
+from storage import open_storage
 
 # So we can pick random colors
 import random 
@@ -25,9 +38,6 @@ import random
 # Events names
 import events
 
-# To lock and unlock files
-import fcntl
-
 # Things to put our definitions into
 from bot import Bot
 
@@ -40,42 +50,292 @@ save_dir = 'games/'
 if not os.path.isdir(save_dir):
     mkdir(save_dir)
 
+# Whether every image of a board gets a random background color. Random
+# colors mean no two images are alike, so rendered images are only cached
+# when this is off and each chat gets its own fixed color instead.
+random_backgrounds = False
+
+# Rendered board images (encoded bytes, with the format they ended up in)
+# keyed by board position, background color and encoding, so that sending
+# an unchanged board again doesn't redraw it
+image_cache = LRUCache(maxBytes=16 * 1024 * 1024,
+                       sizeOf=lambda image: len(image[0]))
+
+# Whether each board image is sent with the score under it
+score_captions = True
+
+# Part of the key images are sent under, so that Telegram's copies of them
+# are reused (see Bot.sendImage). Change it when boards are drawn
+# differently, so the old images aren't.
+image_version = 1
+
+# How board images are encoded for sending:
+#   'png'      - a full color PNG, compressed at png_compress_level (0-9,
+#                lower is faster but bigger)
+#   'paletted' - a PNG with a palette of palette_colors colors, which is
+#                about all a board uses, for much smaller files
+#   'jpeg'     - a JPEG at jpeg_quality (Telegram recompresses photos to
+#                JPEG anyway)
+image_format = 'paletted'
+png_compress_level = 6
+palette_colors = 32
+jpeg_quality = 85
+
+# Telegram won't take photos over 10MB, so anything bigger is sent as a
+# JPEG of whatever quality fits
+max_image_bytes = 10 * 1024 * 1024
+
+# Images are encoded into this buffer, which is reused rather than
+# allocating a new one every time
+encode_buffer = BytesIO()
+
+# Boards this process has loaded or saved lately, keyed by chat, so that a
+# busy chat isn't read back from disk for every message. Saving writes
+# through to disk, so the cache never has anything the files don't. This
+# relies on each chat only being handled by one process at a time, which
+# the poller makes sure of; anything else changing a game's file should
+# call invalidate_board.
+board_cache = LRUCache(maxItems=256)
+
+# Where games are saved (see storage.py): 'files' keeps each chat's game
+# in its own files under save_dir, 'sqlite' keeps them all in the database
+# at database_path. Old pickled games can be moved into the database with
+# migrate.py. To change it, replace storage with open_storage(...) before
+# handling anything.
+storage_kind = 'files'
+database_path = 'games.db'
+storage = open_storage(storage_kind, save_dir, database_path)
+
+# Whether saves are left for commit_saves to make durable, so a whole batch
+# of updates can be committed at once. Otherwise every save is committed
+# as it's made.
+batch_commits = False
+
+# How long drawing and encoding board images takes
+render_time = metrics.histogram('render_seconds')
+encode_time = metrics.histogram('encode_seconds')
+
+# Chats whose saved game couldn't be loaded, and was replaced with a new
+# board. Nothing can be added to what's saved for them, as it would only be
+# replayed on top of what can't be read, so they're snapshotted the first
+# time they're saved (see BoardContext.get).
+unreadable = set()
+
 # Represents the game state, which can be loaded from a file
+@metrics.timed('board_load_seconds')
 def get_board(filename):
-    if os.path.isfile(save_dir + str(filename) + '.p'):
-        f = open(save_dir + str(filename) + '.p', 'rb')
-        fcntl.flock(f, fcntl.LOCK_EX)
-        try:
-            out = pickle.load(f)
-        except:
-            print("Error loading!")
-            return Board(default_board_size)
-        board = out
-    else:
+    board = board_cache.get(filename)
+    if board != None:
+        return board
+    try:
+        board = storage.load(filename)
+    except Exception as ex:
+        print("Error loading!")
+        print("exception: " + str(ex))
+        board = None
+        storage.discard(filename)
+        unreadable.add(filename)
+    if board == None:
         board = Board(default_board_size)
-        f = open(save_dir + str(filename) + '.p', 'wb')
-        pickle.dump(board, f, pickle.HIGHEST_PROTOCOL)
-    fcntl.flock(f, fcntl.LOCK_UN)
-    f.close()
+    board_cache.put(filename, board)
     return board
 
+# Forgets the cached board for a chat, so it's loaded from disk next time
+def invalidate_board(filename):
+    board_cache.discard(filename)
+    storage.discard(filename)
+
+# Forgets the cached board and image of every chat that owns(chat) is False
+# for, when this process stops handling them. If it gets them back later
+# they'll be read afresh, with whatever another process did to them.
+def forget_chats(owns):
+    for chat in board_cache.keys():
+        if not owns(chat):
+            invalidate_board(chat)
+    for chat in frames.keys():
+        if not owns(chat):
+            frames.discard(chat)
+
+# Makes every save since the last commit durable. If that fails they're
+# all lost, along with the cached boards that had them.
+def commit_saves():
+    try:
+        storage.commit()
+    except Exception as ex:
+        print("Error saving!")
+        print("exception: " + str(ex))
+        storage.rollback()
+        board_cache.clear()
+
 # Helper fuctions
 # Note that these contain White/Black game specific stuff, and so are not rolled into the generic class
-def score_str(board):
-  scores = board.score()
-  return "Black: " + str(scores["Black"]) + " White: " + str(scores["White"])
-
-def save_board(board, filename):
-    f = open(save_dir + str(filename) + '.p', 'wb')
-    fcntl.flock(f, fcntl.LOCK_EX)
+def score_str(board, rules=None):
+  result = scoring.score(board, rules)
+  return ("Black: " + str(result.total("Black")) + " White: " +
+          str(result.total("White")) + " (" + result.rules + " scoring)")
+
+# Sends the score, under the rules asked for or both
+def send_score(bot, update, args=None):
+    if args and args[0].lower() not in ['area', 'territory']:
+        bot.sendMessage(chat_id=update.message.chat_id,
+                        text="Please ask for area or territory scoring.")
+        return
+    board = context(update.message.chat_id).get()
+    if args:
+        text = score_str(board, args[0].lower())
+    else:
+        text = (score_str(board, 'area') + "\n" +
+                score_str(board, 'territory'))
+    bot.sendMessage(chat_id=update.message.chat_id, text=text)
+
+# Saves a board. Given the events that were just added to it, they're
+# appended to the game's log; otherwise the whole board is snapshotted
+# (which is needed when it was replaced or cleared).
+@metrics.timed('board_save_seconds')
+def save_board(board, filename, evts=None):
     try:
-        pickle.dump(board, f, pickle.HIGHEST_PROTOCOL)
+        if evts == None:
+            storage.snapshot(filename, board)
+            unreadable.discard(filename)
+        else:
+            storage.append(filename, board, evts)
+        if not batch_commits:
+            storage.commit()
+        board_cache.put(filename, board)
     except Exception as ex:
         print("Error saving!")
         print("exception: " + str(ex))
-    fcntl.flock(f, fcntl.LOCK_UN)
-    f.close()
+        invalidate_board(filename)
+
+# A chat's board for the length of one command: loaded at most once, saved
+# at most once and handed straight to whatever draws it. A deferred context
+# lasts for a whole batch of commands instead (see start_batch), and only
+# saves and sends its image when the batch is finished.
+class BoardContext:
+
+    def __init__ (self, chat_id, deferred=False):
+        self.chat_id = chat_id
+        self.board = None
+        # Events added since loading, which is all that needs saving unless
+        # the board was replaced or cleared
+        self.pending = []
+        self.dirty = False
+        self.deferred = deferred
+        # For a deferred context, whether an image was asked for, and the
+        # position (hash and cells) before its first event, so the image
+        # can be patched from the one sent before the batch
+        self.imageWanted = False
+        self.before = None
+
+    # The board, loaded the first time it's asked for
+    def get (self):
+        if self.board == None:
+            self.board = get_board(self.chat_id)
+            if self.chat_id in unreadable:
+                self.touch()
+        return self.board
+
+    # Adds an event to the board, returning whether an image should be sent
+    def add (self, evt):
+        board = self.get()
+        if self.deferred and self.before == None:
+            self.before = (board.hash, bytes(board.cells))
+        sendImage = board.addEvent(evt)
+        self.pending.append(evt)
+        return sendImage
+
+    # Swaps in a different board, such as a new game
+    def replace (self, board):
+        self.board = board
+        self.dirty = True
+
+    # Notes that the board has changed other than by adding events, so the
+    # whole of it needs saving
+    def touch (self):
+        self.dirty = True
+
+    # Saves the board if anything changed since it was loaded (unless it's
+    # deferred, when that waits for flush)
+    def save (self):
+        coalescing['saves asked'] += 1
+        if not self.deferred:
+            self.flush()
+
+    def flush (self):
+        if self.dirty:
+            coalescing['saves made'] += 1
+            save_board(self.board, self.chat_id)
+        elif len(self.pending) > 0:
+            coalescing['saves made'] += 1
+            save_board(self.board, self.chat_id, self.pending)
+        self.pending = []
+        self.dirty = False
  
+# While a worker is coalescing a batch of updates, the deferred contexts of
+# the chats in it so far, by chat. None when there's no batch.
+batch = None
+
+# How much coalescing saves: the saves and images the commands asked for
+# against the ones actually made (each image not sent is a render and an
+# upload saved)
+coalescing = {'saves asked': 0, 'saves made': 0,
+              'images asked': 0, 'images sent': 0}
+
+# Returns the context a command for a chat should use: its own, or the
+# chat's deferred context if there's a batch
+def context(chat_id):
+    if batch == None:
+        return BoardContext(chat_id)
+    if chat_id not in batch:
+        batch[chat_id] = BoardContext(chat_id, deferred=True)
+    return batch[chat_id]
+
+# Starts a batch. Until finish_batch, every chat's commands share a board
+# that's saved once, and at most one image is sent per chat, showing where
+# the batch left the board.
+def start_batch():
+    global batch
+    batch = {}
+
+# Saves every chat in the batch and sends the images that were asked for
+# The saves are committed before any image is drawn, so a database isn't
+# kept locked while they are.
+def finish_batch(bot):
+    contexts = flush_batch()
+    commit_saves()
+    send_batch(bot, contexts)
+
+# Ends the batch and saves every chat in it, returning the contexts of the
+# chats that want an image
+def flush_batch():
+    global batch
+    contexts = batch
+    batch = None
+    if contexts == None:
+        return []
+    wanted = []
+    for ctx in contexts.values():
+        if ctx.imageWanted:
+            # Span the whole batch with previous and changed, so the image
+            # can be patched from the one sent before it
+            board = ctx.get()
+            if ctx.before != None and not ctx.dirty:
+                board.previous = ctx.before[0]
+                board.changed = board.changedSince(ctx.before[1])
+            wanted.append(ctx)
+        ctx.flush()
+    return wanted
+
+# Sends the images of the contexts flush_batch returned
+def send_batch(bot, contexts):
+    for ctx in contexts:
+        coalescing['images sent'] += 1
+        try:
+            send_image(bot, ctx.chat_id, ctx)
+        except Exception as ex:
+            print("Error sending image!")
+            print("exception: " + str(ex))
+
 def are_indices(argList, size):
     if len(argList) != 3:
         return False
@@ -125,13 +385,14 @@ def to_name(name):
         else:
             return None
 
-def start(bot, update):
+def start(bot, update, args=None):
     bot.sendMessage(chat_id=update.message.chat_id, text="Hey there!")
 
 # Makes a move
 def make_move(bot, update, args):
     # Load the board
-    board = get_board(update.message.chat_id)
+    ctx = context(update.message.chat_id)
+    board = ctx.get()
 
     converted = convert_move(args)
     if ((len(args) != 3 and len(args) != 2) or 
@@ -153,12 +414,15 @@ def make_move(bot, update, args):
         return
 
     # Apply the move, noting whether or not to send an image
-    sendImage = board.addEvent((date, events.move, (name, row, col)))
+    sendImage = ctx.add((date, events.move, (name, row, col)))
 
     # Now that we've moved, save the board and send the new image if appropriate
-    save_board(board, update.message.chat_id)
+    ctx.save()
     if (sendImage):
-        send_board_image(bot, update)
+        send_board_image(bot, update, ctx=ctx)
+    else:
+        bot.sendMessage(chat_id=update.message.chat_id,
+                        text="That move isn't allowed.")
 
     # double_reset nonsense
     bot.double_resets[str(update.message.chat_id)] = False
@@ -171,141 +435,340 @@ def wmove(bot, update, args):
 # Undo the last action
 def undo (bot, update, args):
     # Load the board
-    board = get_board(update.message.chat_id)
+    ctx = context(update.message.chat_id)
+    board = ctx.get()
 
     # The date of the update for our journal
     # The update_id is an authoritative ordering like a date
     date = update.update_id
 
     # Apply the undo
-    board.addEvent((date, events.undo, None))
+    ctx.add((date, events.undo, None))
 
     # Now that we've undoed, save the board and send the new image
-    save_board(board, update.message.chat_id)
-    send_board_image(bot, update)
+    ctx.save()
+    send_board_image(bot, update, ctx=ctx)
 
     # double_reset nonsense
     bot.double_resets[str(update.message.chat_id)] = False
 
+# Picks the hue of the background color for a chat
+def background_hue(chat_id):
+    if random_backgrounds:
+        return random.randrange(0,361)
+    # crc32 rather than hash, which is salted differently in every process
+    return zlib.crc32(str(chat_id).encode()) % 361
+
+# Empirically determined, this seems to look fine with the JPG compression that Telegram does
+space_width = 60
+
+# Most of a board image is the same every time, so the pieces are drawn
+# once and reused:
+#   * the font for the labels
+#   * a template for each board size: the board with its grid and labels
+#     on a transparent margin
+#   * templates put on a background color, for the most recent few sizes
+#     and hues
+#   * a sprite for each color of stone, drawn with antialiasing
+# so drawing a board is copying the template and pasting the stones.
+label_font = None
+templates = {}
+backgrounds = LRUCache(maxItems=32)
+stones = {}
+
+# The last image drawn for each chat, as (position, hue, image), so that
+# the next one can be drawn by patching just the spaces that changed
+frames = LRUCache(maxBytes=64 * 1024 * 1024,
+                  sizeOf=lambda frame: frame[2].width * frame[2].height * 3)
+
+# How much bigger the stones are drawn before being scaled down, which
+# smooths their edges
+stone_scale = 4
+
+# Loads the label font the first time it's needed
+def get_font():
+    global label_font
+    if label_font == None:
+        label_font = ImageFont.truetype("Lato-Regular.ttf", int(0.5 * space_width))
+    return label_font
+
+# The width and height of some text in a font, as PIL's old getsize gave
+def text_size(font, text):
+    bbox = font.getbbox(text)
+    return (bbox[2], bbox[3])
+
+# Returns the template for a board size, drawing it the first time
+def get_template(size):
+    if size in templates:
+        return templates[size]
+
+    image_dim = (size + 3) * space_width
+    img  = Image.new("RGBA", (image_dim, image_dim), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    font = get_font()
+
+    # The board starts two spaces in from each side
+    x = space_width * 2
+    y = space_width * 2
+    wholelen = image_dim - space_width * 4
+    # Note that there are size - 1 boxes in each dimension to make the
+    # correct number of crossed spaces
+    numBoxes = size - 1
+    spacing = space_width
+
+    # We need a background to be able to see the white pieces
+    draw.rectangle([x - spacing * 1.5, y - spacing * 1.5, x + wholelen +
+        spacing * 1.5, y + wholelen + spacing * 1.5], fill = "burlywood",
+        outline = "#7B4A12")
+    for i in range(numBoxes):
+        for j in range(numBoxes):
+            draw.rectangle([ x + i * spacing, y + j * spacing
+                           , x + (i + 1) * spacing, y + (j + 1) * spacing ]
+                           , fill = None
+                           , outline = "black")
+
+    # Draw the labels
+    for i in range(size):
+        (w, h) = text_size(font, str(i + 1))
+        draw.text( ( x - 0.75 * spacing - w / 2, y - h / 2 + i * spacing )
+                 , str(i + 1)
+                 , fill = 'black'
+                 , font = font )
+        draw.text( ( x + wholelen + 0.75 * spacing - w / 2, y - h / 2 + i * spacing )
+                 , str(i + 1)
+                 , fill = 'black'
+                 , font = font )
+    letter_height = text_size(font, 'M')[1]
+    for i in range(size):
+        (w, h) = text_size(font, chr(i + 97).upper())
+        draw.text( ( x - w / 2 + i * spacing, y - spacing )
+                 , chr(i + 97).upper()
+                 , fill = 'black'
+                 , font = font )
+        draw.text( ( x - w / 2 + i * spacing, y + wholelen + spacing - letter_height )
+                 , chr(i + 97).upper()
+                 , fill = 'black'
+                 , font = font )
+
+    templates[size] = img
+    return img
+
+# Returns the template for a board size on a background of the given hue
+def get_background(size, hue):
+    img = backgrounds.get((size, hue))
+    if img == None:
+        template = get_template(size)
+        img = Image.new("RGB", template.size, color="hsl(" + str(hue) + ", 100%, 80%)")
+        img.paste(template, (0, 0), template)
+        backgrounds.put((size, hue), img)
+    return img
+
+# Returns the sprite for a player's stones, a space wide and transparent
+# around the stone
+def get_stone(player):
+    if player not in stones:
+        big = space_width * stone_scale
+        img = Image.new("RGBA", (big, big), (0, 0, 0, 0))
+        color = player.lower()
+        ImageDraw.Draw(img).ellipse([ (big / 10, big / 10)
+                                    , (9 * big / 10, 9 * big / 10) ],
+                                    outline = color, fill = color)
+        stones[player] = img.resize((space_width, space_width), Image.LANCZOS)
+    return stones[player]
+
+# The box of the image covering a space, centered on its crossing (the
+# crossings start two spaces in)
+def space_box(row, col):
+    corner = space_width * 2 - space_width // 2
+    return ( corner + col * space_width, corner + row * space_width
+           , corner + (col + 1) * space_width, corner + (row + 1) * space_width )
+
+# Draws the board on a background of the given hue and returns the image
+def draw_board(board, hue):
+    img = get_background(board.size, hue).copy()
+    for i in range(board.size):
+        for j in range(board.size):
+            player = board.get(i,j)
+            if player == "White" or player == "Black":
+                stone = get_stone(player)
+                img.paste(stone, space_box(i, j)[:2], stone)
+    return img
+
+# Redraws only the given (row, col) spaces of an image of the board: the
+# background under each one, and then its stone if it has one
+def patch_board(img, board, hue, spaces):
+    background = get_background(board.size, hue)
+    for (i, j) in spaces:
+        box = space_box(i, j)
+        img.paste(background.crop(box), box)
+        player = board.get(i,j)
+        if player == "White" or player == "Black":
+            stone = get_stone(player)
+            img.paste(stone, box[:2], stone)
+    return img
+
+# Returns an image of the board for a chat. If the last image drawn for the
+# chat shows the position the board was in before its last event, only the
+# spaces the event changed are redrawn on it.
+def chat_frame(board, hue, chat_id):
+    frame = frames.get(chat_id)
+    if frame != None and frame[1] == hue and frame[0] == board.position():
+        img = frame[2]
+    elif (frame != None and frame[1] == hue and
+          frame[0] == (board.size, board.previous)):
+        img = patch_board(frame[2], board, hue, board.changed)
+    else:
+        img = draw_board(board, hue)
+    frames.put(chat_id, (board.position(), hue, img))
+    return img
+
+# The encoding settings, which images are cached by
+def encoding():
+    if image_format == 'png':
+        return ('png', png_compress_level)
+    elif image_format == 'paletted':
+        return ('paletted', palette_colors, png_compress_level)
+    else:
+        return ('jpeg', jpeg_quality)
+
+# The file name and MIME type for sending an image encoded as used (as
+# encode_image returns it)
+def image_file(used):
+    if used == 'jpeg':
+        return ('board-image.jpg', 'image/jpeg')
+    return ('board-image.png', 'image/png')
+
+# Returns an image encoded as image_format says (or format, if given), and
+# the format it ended up in: 'png' or 'jpeg'. That's a JPEG whatever was
+# asked for if it was too big.
+def encode_image(img, format=None):
+    if format == None:
+        format = image_format
+    encode_buffer.seek(0)
+    encode_buffer.truncate()
+    if format == 'png':
+        img.save(encode_buffer, 'PNG', compress_level = png_compress_level)
+    elif format == 'paletted':
+        img.quantize(palette_colors, method = Image.FASTOCTREE).save(
+            encode_buffer, 'PNG', compress_level = png_compress_level)
+    elif format == 'jpeg':
+        img.save(encode_buffer, 'JPEG', quality = jpeg_quality)
+    else:
+        raise ValueError("Unknown image format: " + str(format))
+    used = 'png'
+    if format == 'jpeg':
+        used = 'jpeg'
+    if encode_buffer.tell() > max_image_bytes:
+        # Step the quality down until it fits
+        quality = jpeg_quality
+        while encode_buffer.tell() > max_image_bytes and quality > 10:
+            quality -= 10
+            encode_buffer.seek(0)
+            encode_buffer.truncate()
+            img.save(encode_buffer, 'JPEG', quality = quality)
+        used = 'jpeg'
+    return (encode_buffer.getvalue(), used)
+
+# Draws the board on a background of the given hue and returns it encoded
+# (with the format it's in, as encode_image does)
+def render_board(board, hue):
+    return encode_image(draw_board(board, hue))
+
+# What identifies an image of the board on a background of the given hue
+def image_key(board, hue):
+    return (board.position(), hue, encoding())
+
+# Returns the encoded image of the board on a background of the given hue,
+# with the format it's in (as encode_image does), only drawing it if it
+# isn't cached already. Given the chat, the chat's last image is patched
+# rather than drawing from scratch where possible.
+def board_image(board, hue, chat_id=None):
+    key = image_key(board, hue)
+    if not random_backgrounds:
+        image = image_cache.get(key)
+        if image != None:
+            return image
+    start = perf_counter()
+    if chat_id == None:
+        img = draw_board(board, hue)
+    else:
+        img = chat_frame(board, hue, chat_id)
+    drawn = perf_counter()
+    image = encode_image(img)
+    render_time.record(drawn - start)
+    encode_time.record(perf_counter() - drawn)
+    if not random_backgrounds:
+        image_cache.put(key, image)
+    return image
+
 # Sends an image of the game board
-def send_board_image(bot, update):
+# Commands that already have the board pass their context along, so it
+# isn't loaded again
+def send_board_image(bot, update, args=None, ctx=None):
     # Load the board
-    board = get_board(update.message.chat_id)
-    
-    # Empirically determined, this seems to look fine with the JPG compression that Telegram does
-    space_width = 60
-    
-    image_dim = (board.size + 3) * space_width
-    
-    width  = image_dim
-    height = image_dim
-
-    wholesize = width - space_width * 4
-
-    img    = Image.new("RGB", (width, height), color="hsl(" + str(random.randrange(0,361)) + ", 100%, 80%)")
-    draw   = ImageDraw.Draw(img)
-    font   = ImageFont.truetype("Lato-Regular.ttf", int(0.5 * (wholesize / (board.size - 1))))
-
-    def drawBoxAt(x, y, edgelen):
-        #Outline
-        linewd = int(board.size / 6) * 2
-        draw.rectangle([ x, y, x + edgelen, y + edgelen]
-                       , fill = None
-                       , outline = "black")
-
-    # Note that the circles are specified from their upper left corner
-    def drawWhiteAt(x, y, cellwidth):
-        draw.ellipse([ (x + cellwidth / 10, y + cellwidth / 10)
-                     , (x + 9 * cellwidth / 10, y + 9 * cellwidth / 10) ],
-                     outline = "white", fill = "white")
-    def drawBlackAt(x, y, cellwidth):
-        draw.ellipse([ (x + cellwidth / 10, y + cellwidth / 10)
-                     , (x + 9 * cellwidth / 10, y + 9 * cellwidth / 10) ],
-                     outline = "black", fill = "black")
-
-    def drawBoardAt(x, y, wholelen, board):
-        # We'll say the board starts/ends 10% in from each side
-        # Also, note that there are size - 2 boxes in each dimension to make the correct number
-        # of crossed spaces
-        numBoxes = board.size - 1
-        spacing = space_width
-
-        # We need a background to be able to see the white pieces
-        draw.rectangle([x - spacing * 1.5, y - spacing * 1.5, x + wholelen +
-            spacing * 1.5, y + wholelen + spacing * 1.5], fill = "burlywood",
-            outline = "#7B4A12")
-        for i in range(numBoxes):
-            for j in range(numBoxes):
-                drawBoxAt(x + i * spacing, y + j * spacing, spacing)
-
-        # Draw the labels
-        for i in range(board.size):
-            draw.text( ( x - 0.75 * spacing - font.getsize(str(i + 1))[0] / 2
-                       , y - font.getsize(str(i + 1))[1] / 2 + i * spacing )
-                     , str(i + 1)
-                     , fill = 'black'
-                     , font = font )
-            draw.text( ( x + wholelen + 0.75 * spacing -  font.getsize(str(i+1))[0] / 2
-                       , y - font.getsize(str(i + 1))[1] / 2 + i * spacing )
-                     , str(i + 1)
-                     , fill = 'black'
-                     , font = font )
-        for i in range(board.size):
-            draw.text( ( x - font.getsize(chr(i + 97).upper())[0] / 2 + i * spacing
-                       , y - spacing )
-                     , chr(i + 97).upper()
-                     , fill = 'black'
-                     , font = font )
-            draw.text( ( x - font.getsize(chr(i + 97).upper())[0] / 2 + i * spacing
-                       , y + wholelen + spacing - font.getsize('M')[1] )
-                     , chr(i + 97).upper()
-                     , fill = 'black'
-                     , font = font )
-        
-        # Now we step over the spaces and draw the pieces if need be
-        for i in range(board.size):
-            for j in range(board.size):
-                if board.get(i,j) == "White":
-                    drawWhiteAt(x - spacing / 2 + j * spacing, y - spacing / 2 + i * spacing, spacing)
-                elif board.get(i,j) == "Black":
-                    drawBlackAt(x - spacing / 2 + j * spacing, y - spacing / 2 + i * spacing, spacing) 
-                    
-    drawBoardAt(space_width * 2, space_width * 2, wholesize, board)
-
-    output = StringIO.StringIO()
-    img.save(output, 'PNG')
-    bot.sendImage(chat_id = str(update.message.chat_id), photo = output)
+    if ctx == None:
+        ctx = context(update.message.chat_id)
+
+    # In a batch, the image waits for the end of it
+    coalescing['images asked'] += 1
+    if ctx.deferred:
+        ctx.imageWanted = True
+    else:
+        coalescing['images sent'] += 1
+        # Not while the save is holding a database's lock
+        if batch_commits:
+            commit_saves()
+        send_image(bot, update.message.chat_id, ctx)
 
     # double_reset nonsense
     bot.double_resets[str(update.message.chat_id)] = False
 
+# Draws and sends the image of a chat's board
+def send_image(bot, chat_id, ctx):
+    board = ctx.get()
+    hue = background_hue(chat_id)
+    (data, used) = board_image(board, hue, chat_id)
+    (filename, content_type) = image_file(used)
+    # A random background makes every image different
+    key = None
+    if not random_backgrounds:
+        key = (image_version,) + image_key(board, hue)
+    caption = None
+    if score_captions:
+        caption = score_str(board)
+    bot.sendImage(chat_id = str(chat_id), photo = BytesIO(data),
+                  filename = filename, content_type = content_type,
+                  key = key, caption = caption)
+
 # Creates a new game, resizing the board possibly
 # Shares the double_reset variable with reset_all
-def new_game(bot, update):
+def new_game(bot, update, args=None):
     # Check our state
     double_reset = bot.double_resets[str(update.message.chat_id)]
 
     # Load the board
-    board = get_board(update.message.chat_id)
+    ctx = context(update.message.chat_id)
+    board = ctx.get()
 
     # If double_reset is a number
     if double_reset != True and double_reset != False:
         # Create a new board and save it
         # Otherwise just clear it
         if board.size != double_reset:
-            board = Board(double_reset)
+            ctx.replace(Board(double_reset))
         else:
             board.clear()
+            ctx.touch()
 
-        save_board(board, update.message.chat_id)
+        ctx.save()
         bot.double_resets[str(update.message.chat_id)] = False
-        send_board_image(bot, update)
+        send_board_image(bot, update, ctx=ctx)
 
 def confirm_resize(bot, update, args):
         # See if the number input was valid (or no number was input)
         # Only allow up to a 19 x 19 board (arbitrarily chosen)
         if (len(args) == 0): # Don't change the size
-            new_size = get_board(update.message.chat_id).size
+            new_size = context(update.message.chat_id).get().size
             bot.double_resets[str(update.message.chat_id)] = new_size
         elif (len(args) == 1):
             try:
@@ -356,6 +819,9 @@ def load (bot):
     # Send the board image
     bot.addHandler("game", send_board_image)
 
+    # Send the score
+    bot.addHandler("score", send_score)
+
     # Making new games
     bot.addHandler("new_game", confirm_resize)
     bot.addHandler("confirm_new", new_game)
\ No newline at end of file
@@ -0,0 +1,239 @@
+#!venv/bin/python3
+
+# Checks every saved game by rebuilding it from its journal, for when the
+# rules of the board or the way games are saved change. Run with
+#   python3 replay.py [games directory or database] [workers]
+# which default to games/ and one worker per core. A path ending in .db is
+# read as a SQLite database (see storage.py), anything else as a directory
+# of game files. Nothing is written to either.
+#
+# For each game, the board as it was saved (the cells of its snapshot, or
+# the spaces of an old pickled game) is compared with a board rebuilt from
+# scratch out of the snapshot's journal, and the game as it loads (the
+# snapshot with its log on top) with one rebuilt out of the whole journal.
+# Any space that differs is printed, followed by totals for the archive.
+#
+# The games are handed to a pool of processes as they're found, with only
+# a few per process waiting at a time, so the archive is never listed into
+# memory all at once.
+
+# So we can get our arguments
+import sys
+
+# To find the saved games
+import os
+
+# To unpickle games without loading them into a Board
+import pickle
+from io import BytesIO
+
+# For the workers
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# For timing the rebuilds
+from time import perf_counter
+
+# Our game-board abstraction
+from board import Board, Empty, codes
+
+# Events names
+import events
+
+# Where games are saved
+import journal
+from journal import GameLog
+from storage import SQLiteStorage
+
+# How many games each worker can have waiting for it
+backlog = 4
+
+# The databases each worker has opened, by path
+databases = {}
+
+# What's on a space, by its code
+names = ['empty', 'Black', 'White']
+
+# A Board as it was pickled, without anything Board.__setstate__ would do
+# to it (like rebuilding old games), so we see what was actually saved
+class SavedBoard:
+    pass
+
+class SavedBoardUnpickler (pickle.Unpickler):
+
+    def find_class (self, module, name):
+        if module == 'board' and name == 'Board':
+            return SavedBoard
+        return super().find_class(module, name)
+
+# Reads a pickled Board as it was saved
+def readSaved (data):
+    return SavedBoardUnpickler(BytesIO(data)).load()
+
+# The cells of a saved board, as Board keeps them
+def savedCells (saved):
+    if 'cells' in saved.__dict__:
+        return bytes(saved.cells)
+    # An old graph of spaces
+    return bytes(codes[node.player] for row in saved.shortcut for node in row)
+
+# Returns the saved games in source, as (source, chat) for check, without
+# listing them all first
+def savedGames (source):
+    if source.endswith('.db'):
+        # A second connection, so the cursor can be read while the workers
+        # use theirs
+        db = SQLiteStorage(source).connection()
+        for (chat,) in db.execute('SELECT chat_id FROM snapshots'):
+            yield (source, chat)
+        return
+    for entry in os.scandir(source):
+        (chat, extension) = os.path.splitext(entry.name)
+        # An old pickled game only counts if it was never snapshotted
+        if extension == '.snap' or (extension == '.p' and not
+                                    os.path.isfile(source + chat + '.snap')):
+            yield (source, chat)
+
+# The snapshot of a chat in source as it was saved, and the game as it loads
+# (the snapshot with its log on top). Also returns how many bytes of the
+# log were torn.
+def loadGame (source, chat):
+    if source.endswith('.db'):
+        if source not in databases:
+            databases[source] = SQLiteStorage(source)
+        storage = databases[source]
+        row = storage.connection().execute(
+            'SELECT board FROM snapshots WHERE chat_id = ?',
+            (chat,)).fetchone()
+        return (readSaved(row[0]), storage.load(chat), 0)
+    log = GameLog(source, chat)
+    if os.path.isfile(log.snapshotPath()):
+        f = open(log.snapshotPath(), 'rb')
+        f.read(journal.header.size)
+        saved = readSaved(f.read())
+        f.close()
+    else:
+        f = open(log.legacyPath(), 'rb')
+        saved = readSaved(f.read())
+        f.close()
+    board = log.load(repair=False)
+    return (saved, board, log.torn)
+
+# The spaces where two boards' cells differ, as (space, one, other)
+def differences (size, cells, others):
+    return [(spaceName(size, i), names[cells[i]], names[others[i]])
+            for i in range(len(cells)) if cells[i] != others[i]]
+
+# A space by the name players use for it, like c4
+def spaceName (size, index):
+    (row, col) = divmod(index, size)
+    return chr(ord('a') + col) + str(row + 1)
+
+# A board rebuilt from scratch out of evts, like the saved board
+def rebuild (like, evts):
+    board = Board(like.size, like.__dict__.get('superko', False))
+    board.buildGame(sorted(evts, key=lambda evt: evt[0]))
+    return board
+
+# Run by the workers: rebuilds a chat's game and compares it with what was
+# saved. Returns what was found, as a dict.
+def check (source, chat):
+    result = {'chat': chat, 'error': None, 'diffs': [], 'torn': 0,
+              'events': 0, 'moves': 0, 'undos': 0, 'captures': 0,
+              'seconds': 0.0}
+    try:
+        (saved, board, result['torn']) = loadGame(source, chat)
+        snapshotted = rebuild(saved, saved.store.journal)
+        for (space, was, now) in differences(saved.size, savedCells(saved),
+                                             snapshotted.cells):
+            result['diffs'].append(('snapshot', space, was, now))
+
+        evts = board.store.log()
+        start = perf_counter()
+        rebuilt = rebuild(board, evts)
+        result['seconds'] = perf_counter() - start
+        for (space, was, now) in differences(board.size, board.cells,
+                                             rebuilt.cells):
+            result['diffs'].append(('loaded', space, was, now))
+        if board.hash != rebuilt.hash and len(result['diffs']) == 0:
+            result['diffs'].append(('loaded', 'hash', board.hash,
+                                    rebuilt.hash))
+
+        result['events'] = len(evts)
+        result['moves'] = sum(1 for evt in evts if evt[1] == events.move)
+        result['undos'] = sum(1 for evt in evts if evt[1] == events.undo)
+        # Every stone that stands played but isn't on the board was taken
+        stones = sum(1 for cell in rebuilt.cells if cell != codes[Empty])
+        result['captures'] = len(rebuilt.moves) - stones
+    except Exception as ex:
+        result['error'] = str(ex)
+    return result
+
+# Checks every game in games (as savedGames returns them) on a pool of
+# workers, returning the results as they finish
+def checkAll (games, workers):
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        for (source, chat) in games:
+            pending.add(pool.submit(check, source, chat))
+            if len(pending) >= workers * backlog:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in pending:
+            yield future.result()
+
+# Prints what was wrong with a game, if anything
+def report (result):
+    chat = str(result['chat'])
+    if result['error'] != None:
+        print(chat + ": couldn't check: " + result['error'])
+    if result['torn'] > 0:
+        print(chat + ": " + str(result['torn']) + " torn bytes at the end " +
+              "of the log")
+    for (where, space, was, now) in result['diffs']:
+        print(chat + ": " + where + " " + space + " was " + str(was) +
+              ", rebuilt " + str(now))
+
+def main (source, workers):
+    start = perf_counter()
+    totals = {'games': 0, 'differ': 0, 'errors': 0, 'torn': 0, 'events': 0,
+              'moves': 0, 'undos': 0, 'captures': 0, 'seconds': 0.0}
+    slowest = 0.0
+    for result in checkAll(savedGames(source), workers):
+        report(result)
+        totals['games'] += 1
+        if len(result['diffs']) > 0:
+            totals['differ'] += 1
+        if result['error'] != None:
+            totals['errors'] += 1
+        if result['torn'] > 0:
+            totals['torn'] += 1
+        for name in ['events', 'moves', 'undos', 'captures', 'seconds']:
+            totals[name] += result[name]
+        slowest = max(slowest, result['seconds'])
+    spent = perf_counter() - start
+
+    games = max(totals['games'], 1)
+    print("Checked %d games in %.1fs (%.0f a second) with %d workers" %
+          (totals['games'], spent, totals['games'] / max(spent, 1e-9),
+           workers))
+    print("%d differ from their rebuilds, %d couldn't be checked, %d have "
+          "torn logs" % (totals['differ'], totals['errors'], totals['torn']))
+    print("%d events: %d moves, %d undos, %d stones captured" %
+          (totals['events'], totals['moves'], totals['undos'],
+           totals['captures']))
+    print("Rebuilding took %.2fms a game on average, %.2fms at most" %
+          (totals['seconds'] / games * 1000, slowest * 1000))
+    return totals['differ'] + totals['errors']
+
+if __name__ == '__main__':
+    source = 'games/'
+    workers = os.cpu_count()
+    if len(sys.argv) > 1:
+        source = sys.argv[1]
+    if len(sys.argv) > 2:
+        workers = int(sys.argv[2])
+    if not source.endswith('.db') and not source.endswith('/'):
+        source += '/'
+    # A non-zero exit if anything was wrong, for scripts
+    sys.exit(1 if main(source, workers) > 0 else 0)
@@ -0,0 +1,206 @@
+# Contains the consistent-hash ring that assigns chats to workers, and the
+# router the poller uses to hand updates to them.
+#
+# Each worker is put on the ring at vnodes points, and a chat belongs to the
+# worker at the first point at or after the chat's own. Adding or removing
+# a worker only moves the chats between its points and the ones before
+# them, about 1/N of all chats, so the other workers keep their cached
+# boards and images.
+
+# For the points on the ring, which have to be the same in every process
+import hashlib
+
+# To find a chat's point on the ring
+from bisect import bisect_left
+
+# For the acknowledgements from the workers
+from queue import Empty
+
+# The number of points each worker has on the ring. More spreads the chats
+# more evenly.
+default_vnodes = 64
+
+# Where a key goes on the ring: the first 8 bytes of its MD5. Unlike hash,
+# this is the same in every process and for any kind of key.
+def point (key):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+class Ring:
+
+    def __init__ (self, nodes=(), vnodes=default_vnodes):
+        self.vnodes = vnodes
+        self.nodes = []
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    # Puts node on the ring
+    def add (self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        self.rebuild()
+
+    # Takes node off the ring
+    def remove (self, node):
+        if node in self.nodes:
+            self.nodes.remove(node)
+            self.rebuild()
+
+    def rebuild (self):
+        ring = sorted((point(str(node) + '#' + str(i)), node)
+                      for node in self.nodes for i in range(self.vnodes))
+        self.points = [p for (p, node) in ring]
+        self.owners = [node for (p, node) in ring]
+
+    # The node that key belongs to, or None if the ring is empty
+    def nodeFor (self, key):
+        if len(self.points) == 0:
+            return None
+        i = bisect_left(self.points, point(key))
+        if i == len(self.points):
+            i = 0
+        return self.owners[i]
+
+    def copy (self):
+        ring = Ring(vnodes=self.vnodes)
+        ring.nodes = list(self.nodes)
+        ring.points = self.points
+        ring.owners = self.owners
+        return ring
+
+# Hands updates to the workers' queues by the ring, and moves chats between
+# workers in order when workers are added or removed.
+#
+# When the ring changes, every worker that was on it is sent a barrier: a
+# marker carrying the new list of workers. A worker that reaches it has
+# handled everything queued before it, so it commits its saves, forgets
+# the chats it no longer owns and acknowledges the barrier on acks. Until
+# the old owner of a chat that moved has acknowledged, the chat's updates
+# are held here, and then they're passed on to its new owner in the order
+# they came.
+class Router:
+
+    def __init__ (self, acks, vnodes=default_vnodes):
+        self.ring = Ring(vnodes=vnodes)
+        self.acks = acks
+        self.queues = {}
+        # Barriers sent but not yet acknowledged, as a list of (sequence
+        # number, ring before the change, workers yet to acknowledge)
+        self.transitions = []
+        self.sequence = 0
+        # Updates held back until a chat's old owner has caught up, in the
+        # order they arrived
+        self.held = []
+
+    # Adds a worker with its queue, and moves its share of the chats to it
+    def addWorker (self, node, queue):
+        old = self.ring.copy()
+        self.queues[node] = queue
+        self.ring.add(node)
+        self.rebalance(old)
+
+    # Takes a worker off the ring, moving its chats to the others. Once it's
+    # caught up it's told to stop. Its queue is kept (in case it has to be
+    # restarted to get there) until forget is called.
+    def removeWorker (self, node):
+        old = self.ring.copy()
+        self.ring.remove(node)
+        self.rebalance(old)
+        self.queues[node].put(None)
+
+    # Forgets a worker that was removed and has stopped
+    def forget (self, node):
+        if node not in self.ring.nodes:
+            self.queues.pop(node, None)
+
+    # Sends a barrier to every worker on the old ring
+    def rebalance (self, old):
+        if len(old.nodes) == 0:
+            return
+        self.sequence += 1
+        for node in old.nodes:
+            self.queues[node].put(self.barrier())
+        self.transitions.append((self.sequence, old, set(old.nodes)))
+
+    # The barrier for the latest change
+    def barrier (self):
+        return {'barrier': self.sequence, 'workers': list(self.ring.nodes),
+                'vnodes': self.ring.vnodes}
+
+    # A worker was restarted. It will get to any barrier still on its queue,
+    # but one it took off before dying is lost, so it's sent another.
+    def restarted (self, node):
+        for (sequence, old, waiting) in self.transitions:
+            if node in waiting:
+                self.queues[node].put(self.barrier())
+                return
+
+    # Whether any updates are being held back
+    def holding (self):
+        return len(self.held) > 0
+
+    # Whether an update for chat has to wait for its old owner to catch up
+    def mustHold (self, chat, heldChats):
+        if chat in heldChats:
+            return True
+        owner = self.ring.nodeFor(chat)
+        for (sequence, old, waiting) in self.transitions:
+            previous = old.nodeFor(chat)
+            if previous != owner and previous in waiting:
+                return True
+        return False
+
+    # Passes an update to the worker that owns its chat, or holds it back
+    def dispatch (self, update):
+        self.collect()
+        heldChats = set(u['message']['chat']['id'] for u in self.held)
+        chat = update['message']['chat']['id']
+        if self.mustHold(chat, heldChats):
+            self.held.append(update)
+        else:
+            self.queues[self.ring.nodeFor(chat)].put(update)
+
+    # Takes in any acknowledgements, and passes on the updates that no
+    # longer need holding (block says how long to wait for one, if any
+    # transitions are outstanding)
+    def collect (self, block=0):
+        while len(self.transitions) > 0:
+            try:
+                if block > 0:
+                    (node, sequence) = self.acks.get(timeout=block)
+                    block = 0
+                else:
+                    (node, sequence) = self.acks.get_nowait()
+            except Empty:
+                break
+            # A barrier stands for every change before it too
+            for (s, old, waiting) in self.transitions:
+                if s <= sequence:
+                    waiting.discard(node)
+            self.transitions = [t for t in self.transitions if len(t[2]) > 0]
+        held = self.held
+        self.held = []
+        heldChats = set()
+        for update in held:
+            chat = update['message']['chat']['id']
+            if self.mustHold(chat, heldChats):
+                self.held.append(update)
+                heldChats.add(chat)
+            else:
+                self.queues[self.ring.nodeFor(chat)].put(update)
+
+    # Hands over everything still held (waiting up to timeout seconds for
+    # the workers to catch up), then tells every worker to stop
+    def stop (self, timeout=30):
+        waited = 0
+        while self.holding() and waited < timeout:
+            self.collect(1)
+            waited += 1
+        for update in self.held:
+            chat = update['message']['chat']['id']
+            self.queues[self.ring.nodeFor(chat)].put(update)
+        self.held = []
+        for node in self.ring.nodes:
+            self.queues[node].put(None)
@@ -0,0 +1,141 @@
+# Scores a board: counts the stones on it, works out which empty spaces
+# are whose territory, and adds them up under area or territory rules.
+#
+# The empty spaces of the board split into regions of spaces that touch.
+# A region that only borders one player's stones is that player's
+# territory; one that borders both (or neither, on an empty board) is
+# neutral. Dead stones aren't worked out, so they count as alive: players
+# should capture them before scoring.
+#
+#   area      - stones on the board plus territory (Chinese rules)
+#   territory - territory plus prisoners, the other player's stones taken
+#               (Japanese rules)
+#
+# On big boards the regions are found with one pass of connected component
+# labelling over the whole board with NumPy and SciPy, which takes about
+# 55us on 19x19. Smaller boards (or any, without them) are flood filled in
+# Python, which is quicker there as it doesn't pay for setting up arrays.
+
+# The codes of the players on the board
+from board import Empty, codes
+
+# For labelling the regions, if they're installed
+try:
+    import numpy
+    from scipy import ndimage
+except ImportError:
+    numpy = None
+
+# The rules used when none are asked for
+default_rules = 'area'
+
+# The smallest board that's labelled with NumPy rather than flood filled
+label_from = 17
+
+# Points added to White's score, to make up for Black moving first
+komi = 0
+
+# A board's score, broken down
+class Score:
+
+    def __init__ (self, rules, stones, territory, prisoners, neutral):
+        self.rules = rules
+        # Each of these by player
+        self.stones = stones
+        self.territory = territory
+        self.prisoners = prisoners
+        # Empty spaces that are nobody's
+        self.neutral = neutral
+
+    # A player's score under the rules
+    def total (self, player):
+        if self.rules == 'area':
+            points = self.stones[player] + self.territory[player]
+        else:
+            points = self.territory[player] + self.prisoners[player]
+        if player == "White":
+            points += komi
+        return points
+
+    # Both players' scores, as a dict
+    def totals (self):
+        return {"Black": self.total("Black"), "White": self.total("White")}
+
+# Scores board under rules ('area' or 'territory')
+def score (board, rules=None):
+    if rules == None:
+        rules = default_rules
+    if rules not in ['area', 'territory']:
+        raise ValueError("Unknown rules: " + str(rules))
+    if numpy != None and board.size >= label_from:
+        (territory, neutral) = label_territory(board)
+    else:
+        (territory, neutral) = fill_territory(board)
+    stones = {"Black": board.cells.count(codes["Black"]),
+              "White": board.cells.count(codes["White"])}
+    # Every stone played that isn't on the board any more was captured. A
+    # move can also be played as Empty (see processing.to_name), which
+    # places no stone.
+    played = {"Black": 0, "White": 0}
+    for move in board.moves:
+        if move[0] in played:
+            played[move[0]] += 1
+    prisoners = {"Black": played["White"] - stones["White"],
+                 "White": played["Black"] - stones["Black"]}
+    return Score(rules, stones, territory, prisoners, neutral)
+
+# Works out each player's territory, and the neutral spaces, by labelling
+# the empty regions. Returns ({player: spaces}, neutral spaces).
+def label_territory (board):
+    grid = numpy.frombuffer(bytes(board.cells), dtype=numpy.uint8)
+    grid = grid.reshape(board.size, board.size)
+    (labels, count) = ndimage.label(grid == codes[Empty])
+    sizes = numpy.bincount(labels.ravel(), minlength=count + 1)
+    # Which regions each player's stones touch: the labels of the spaces
+    # next to their stones
+    touches = {}
+    for player in ["Black", "White"]:
+        stones = grid == codes[player]
+        near = numpy.zeros_like(stones)
+        near[1:, :] |= stones[:-1, :]
+        near[:-1, :] |= stones[1:, :]
+        near[:, 1:] |= stones[:, :-1]
+        near[:, :-1] |= stones[:, 1:]
+        touches[player] = numpy.bincount(labels[near],
+                                         minlength=count + 1) > 0
+    black = touches["Black"] & ~touches["White"]
+    white = touches["White"] & ~touches["Black"]
+    # Label 0 is the stones, which aren't a region
+    black[0] = white[0] = False
+    territory = {"Black": int(sizes[black].sum()),
+                 "White": int(sizes[white].sum())}
+    neutral = int(sizes[1:].sum()) - territory["Black"] - territory["White"]
+    return (territory, neutral)
+
+# The same as label_territory, by flood filling each region in turn
+def fill_territory (board):
+    cells, adjacent = board.cells, board.adjacent
+    empty = codes[Empty]
+    territory = {"Black": 0, "White": 0}
+    neutral = 0
+    seen = bytearray(len(cells))
+    for start in range(len(cells)):
+        if cells[start] != empty or seen[start]:
+            continue
+        seen[start] = 1
+        region = [start]
+        borders = set()
+        for i in region:
+            for adj in adjacent[i]:
+                if cells[adj] != empty:
+                    borders.add(cells[adj])
+                elif not seen[adj]:
+                    seen[adj] = 1
+                    region.append(adj)
+        if borders == {codes["Black"]}:
+            territory["Black"] += len(region)
+        elif borders == {codes["White"]}:
+            territory["White"] += len(region)
+        else:
+            neutral += len(region)
+    return (territory, neutral)
@@ -10,6 +10,9 @@ virtualenv --no-site-packages -p python3 venv
 source venv/bin/activate
 pip3 install pillow
 pip3 install requests
+pip3 install aiohttp
+# Optional, for faster scoring
+pip3 install numpy scipy
 
 # Installs the fonts needed
 apt-get install libfreetype6-dev
\ No newline at end of file
@@ -0,0 +1,213 @@
+# Contains the places saved games can be kept. Anything that keeps games
+# has the same few methods:
+#   load(chat_id)               - the chat's Board, or None if it has never
+#                                 been saved
+#   append(chat_id, board, evts) - saves events that were just added to
+#                                 board
+#   snapshot(chat_id, board)    - saves the whole board, which is needed
+#                                 when it was replaced or cleared
+#   commit()                    - makes everything saved so far durable
+#   rollback()                  - throws away everything saved since the
+#                                 last commit
+#   discard(chat_id)            - forgets anything remembered about the
+#                                 chat, so it's read afresh next time
+# There are two: FileStorage, which keeps each chat's game in its own files
+# (see journal.py), and SQLiteStorage, which keeps every game in one
+# SQLite database.
+
+# To find out which process we're in
+import os
+
+# For the database
+import sqlite3
+
+# To save the snapshots
+import pickle
+
+# To remember the logs of recent chats
+from cache import LRUCache
+
+# The file format, and how often to snapshot
+import journal
+from journal import GameLog
+
+# How long (in seconds) a SQLite connection waits for another process's
+# write to finish before giving up on its own
+busy_timeout = 10
+
+# Players are saved by their board code
+from board import codes, players
+
+# Events names
+import events
+
+# Keeps each chat's game in a snapshot file and a log file in directory.
+# Every save goes straight to its file, so there's nothing to commit.
+class FileStorage:
+
+    def __init__ (self, directory):
+        self.directory = directory
+        # The GameLogs of recent chats, which remember where each game's
+        # log is up to
+        self.logs = LRUCache(maxItems=256)
+
+    # Returns the GameLog for a chat
+    def log (self, chat_id):
+        log = self.logs.get(chat_id)
+        if log == None:
+            log = GameLog(self.directory, chat_id)
+            self.logs.put(chat_id, log)
+        return log
+
+    def load (self, chat_id):
+        return self.log(chat_id).load()
+
+    def append (self, chat_id, board, evts):
+        self.log(chat_id).append(board, evts)
+
+    def snapshot (self, chat_id, board):
+        self.log(chat_id).snapshot(board)
+
+    def commit (self):
+        pass
+
+    def rollback (self):
+        pass
+
+    def discard (self, chat_id):
+        self.logs.discard(chat_id)
+
+# Keeps every game in one SQLite database at path, in two tables
+#   snapshots - the latest pickled Board of each chat, with its generation
+#   events    - every event of every chat, keyed by (chat_id, update_id)
+#               and tagged with the generation it came after
+# Loading a game replays the events of its snapshot's generation on top of
+# it. Older events are kept, so the database has the whole history of
+# every game. Nothing is committed until commit() is called, so a worker
+# can save a whole batch of updates in one transaction.
+class SQLiteStorage:
+
+    def __init__ (self, path):
+        self.path = path
+        self.db = None
+        # The process the connection was opened in, as a connection can't
+        # be carried over a fork
+        self.pid = None
+        # The generation of each chat's snapshot, and how many events have
+        # been saved since it
+        self.generations = LRUCache(maxItems=4096)
+
+    # The connection, opened the first time it's needed in each process
+    def connection (self):
+        if self.db == None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, timeout=busy_timeout)
+            self.pid = os.getpid()
+            # Readers don't block the writer (or the other way around), and
+            # a commit only waits on the write-ahead log rather than the
+            # whole database
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                            'chat_id INTEGER PRIMARY KEY, '
+                            'generation INTEGER NOT NULL, '
+                            'board BLOB NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS events ('
+                            'chat_id INTEGER NOT NULL, '
+                            'update_id INTEGER NOT NULL, '
+                            'generation INTEGER NOT NULL, '
+                            'kind INTEGER NOT NULL, '
+                            'player INTEGER NOT NULL, '
+                            'row INTEGER NOT NULL, '
+                            'col INTEGER NOT NULL, '
+                            'PRIMARY KEY (chat_id, update_id)) '
+                            'WITHOUT ROWID')
+            self.db.execute('CREATE INDEX IF NOT EXISTS events_generation '
+                            'ON events (chat_id, generation)')
+            self.db.commit()
+            self.generations.clear()
+        return self.db
+
+    def load (self, chat_id):
+        db = self.connection()
+        row = db.execute('SELECT generation, board FROM snapshots '
+                         'WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row == None:
+            self.generations.discard(chat_id)
+            return None
+        (generation, data) = row
+        board = pickle.loads(data)
+        rows = db.execute('SELECT update_id, kind, player, row, col '
+                          'FROM events WHERE chat_id = ? AND generation = ? '
+                          'ORDER BY update_id', (chat_id, generation))
+        evts = []
+        for (date, kind, player, row, col) in rows:
+            if kind == events.undo:
+                evts.append((date, kind, None))
+            else:
+                evts.append((date, kind, (players[player], row, col)))
+        board.addEvents(evts)
+        self.generations.put(chat_id, [generation, len(evts)])
+        return board
+
+    def append (self, chat_id, board, evts):
+        db = self.connection()
+        entry = self.generations.get(chat_id)
+        if entry == None:
+            row = db.execute('SELECT generation FROM snapshots '
+                             'WHERE chat_id = ?', (chat_id,)).fetchone()
+            if row == None:
+                # Events need a snapshot to be replayed on top of, and the
+                # board already has them
+                self.snapshot(chat_id, board)
+                return
+            (count,) = db.execute('SELECT COUNT(*) FROM events '
+                                  'WHERE chat_id = ? AND generation = ?',
+                                  (chat_id, row[0])).fetchone()
+            entry = [row[0], count]
+            self.generations.put(chat_id, entry)
+        rows = []
+        for (date, kind, args) in evts:
+            if args == None:
+                rows.append((chat_id, date, entry[0], kind, 0, 0, 0))
+            else:
+                rows.append((chat_id, date, entry[0], kind, codes[args[0]],
+                             args[1], args[2]))
+        db.executemany('INSERT OR REPLACE INTO events VALUES '
+                       '(?, ?, ?, ?, ?, ?, ?)', rows)
+        entry[1] += len(rows)
+        # Same as the files, snapshot every so often so loading doesn't
+        # replay too much
+        if entry[1] >= journal.snapshot_every:
+            self.snapshot(chat_id, board)
+
+    def snapshot (self, chat_id, board):
+        db = self.connection()
+        row = db.execute('SELECT generation FROM snapshots '
+                         'WHERE chat_id = ?', (chat_id,)).fetchone()
+        generation = 1
+        if row != None:
+            generation = row[0] + 1
+        db.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)',
+                   (chat_id, generation,
+                    pickle.dumps(board, pickle.HIGHEST_PROTOCOL)))
+        self.generations.put(chat_id, [generation, 0])
+
+    def commit (self):
+        if self.db != None and self.pid == os.getpid():
+            self.db.commit()
+
+    def rollback (self):
+        if self.db != None and self.pid == os.getpid():
+            self.db.rollback()
+        self.generations.clear()
+
+    def discard (self, chat_id):
+        self.generations.discard(chat_id)
+
+# Returns the storage named by kind ('files' or 'sqlite')
+def open_storage (kind, directory, database):
+    if kind == 'sqlite':
+        return SQLiteStorage(database)
+    if kind == 'files':
+        return FileStorage(directory)
+    raise ValueError("Unknown storage: " + str(kind))
@@ -1,19 +1,30 @@
 # Contains the top-level class and interface declarations for the journal store.
 
+# To find where an event goes by its key
+from bisect import bisect_right
+
+# To merge a batch of events into the journal
+from heapq import merge
+
 # A journal store, which consists of
 #   * An ordered log of events
 #   * A function to generate output from event streams
-#   * Cached output at various event stream times (TODO)
+#   * Cached output at various event stream times
 class Store:
     
     ''' No class variables are needed. '''
 
     # Initializes an empty Store
-    def __init__ (self, orderFunc=None, builder=None, initList=[]):
+    def __init__ (self, orderFunc=None, builder=None, initList=None,
+                  interval=16, maxCheckpoints=32, key=None):
         # Order is important and the most frequently accessed items are at the
         # front, so we use a list here. We don't gain anything by using a deque
         # or a Dict according to 
         # https://wiki.python.org/moin/TimeComplexity
+        # A fresh list each time, a shared default would mean every Store
+        # (and so every Board) shares a journal
+        if initList == None:
+            initList = []
         self.journal = initList
 
         # It's okay if this is None, as we will assume that the caller just
@@ -24,19 +35,50 @@ class Store:
         # defined on the list elements
         self.orderFunc = orderFunc
 
+        # Better than orderFunc: a function giving each element a key to be
+        # ordered by (like its update_id). The keys are kept alongside the
+        # journal, so an element's place is found by bisecting them.
+        # Elements with the same key stay in the order they came.
+        self.key = None
+        self.keys = None
+        if key != None:
+            self.setKey(key)
+
+        # Cached output, keyed by how many journal events it reflects. We try
+        # to keep one every interval events, and when there are more than
+        # maxCheckpoints we double the interval and drop every other one, so
+        # the spacing grows with the journal while memory stays capped.
+        self.checkpoints = {}
+        self.baseInterval = interval
+        self.interval = interval
+        self.maxCheckpoints = maxCheckpoints
+
     # Insert an element to the journal
     def insert (self, elem):
-        if (self.orderFunc != None):
+        if (self.key != None):
+            k = self.key(elem)
+            # If we can add to the end, do so (constant time)
+            if len(self.keys) == 0 or self.keys[-1] <= k:
+                self.journal.append(elem)
+                self.keys.append(k)
+            else: # Bisect for the place (logarithmic time, then the insert)
+                i = bisect_right(self.keys, k)
+                self.journal.insert(i, elem)
+                self.keys.insert(i, k)
+                self.invalidate(i)
+            return True
+        elif (self.orderFunc != None):
             # If we can add to the end, do so (constant time)
             if (len(self.journal) == 0 or 
                 self.orderFunc(self.journal[len(self.journal)-1],elem)):
                 self.journal.append(elem)
             else: # Walk backwards until we can insert (linear time)
                 i = len(self.journal) - 2
-                while (self.orderFunc(elem, self.journal[i]) and
-                       i >= 0):
+                while (i >= 0 and
+                       self.orderFunc(elem, self.journal[i])):
                     i -= 1
                 self.journal.insert(i+1,elem)
+                self.invalidate(i+1)
             return True
         else: # Hope there's a < operation (should catch errors)
             if (len(self.journal) == 0 or
@@ -44,12 +86,37 @@ class Store:
                 self.journal.append(elem)
             else:
                 i = len(self.journal) - 2
-                while (elem < self.journal[i] and
-                       i >= 0):
+                while (i >= 0 and
+                       elem < self.journal[i]):
                     i -= 1
                 self.journal.insert(i+1,elem)
+                self.invalidate(i+1)
             return True
-                
+
+    # Inserts a batch of elements, merging them into the journal in one pass
+    # rather than inserting them one at a time. Returns the position of the
+    # first element of the journal that changed (its old length if they all
+    # went on the end). Only for Stores with a key.
+    def bulk_insert (self, elems):
+        batch = sorted(((self.key(elem), elem) for elem in elems),
+                       key=lambda keyed: keyed[0])
+        if len(batch) == 0:
+            return len(self.journal)
+        # Everything before where the first of the batch goes stays put
+        start = bisect_right(self.keys, batch[0][0])
+        if start == len(self.journal):
+            self.journal.extend(elem for (k, elem) in batch)
+            self.keys.extend(k for (k, elem) in batch)
+            return start
+        # Merging keeps the journal's elements before the batch's ones with
+        # the same key, as inserting them one by one would
+        tail = list(merge(zip(self.keys[start:], self.journal[start:]), batch,
+                          key=lambda keyed: keyed[0]))
+        self.journal[start:] = [elem for (k, elem) in tail]
+        self.keys[start:] = [k for (k, elem) in tail]
+        self.invalidate(start)
+        return start
+
     # Return the journal
     def log (self):
         return self.journal
@@ -66,10 +133,90 @@ class Store:
         else:
             return builder(self.journal)
 
+    # Whether output after pos journal events should be cached. A
+    # maxCheckpoints of 0 turns caching off.
+    def due (self, pos):
+        return (self.maxCheckpoints > 0 and pos > 0 and
+                pos % self.interval == 0 and
+                pos not in self.checkpoints)
+
+    # Cache output reflecting the first pos journal events
+    def checkpoint (self, pos, output):
+        self.checkpoints[pos] = output
+        if len(self.checkpoints) > self.maxCheckpoints:
+            # Thin out to the doubled spacing
+            self.interval *= 2
+            for p in list(self.checkpoints):
+                if p % self.interval != 0:
+                    del self.checkpoints[p]
+            # If they were out of step with the spacing, drop the oldest
+            while len(self.checkpoints) > self.maxCheckpoints:
+                del self.checkpoints[min(self.checkpoints)]
+
+    # Returns the latest checkpoint at or before pos as (pos, output),
+    # optionally only considering outputs that accept(output) is True for.
+    # If there isn't one, returns (0, None).
+    def nearest (self, pos, accept=None):
+        for p in sorted(self.checkpoints, reverse=True):
+            if p <= pos and (accept == None or accept(self.checkpoints[p])):
+                return (p, self.checkpoints[p])
+        return (0, None)
+
+    # Drops the checkpoints that reflect more than the first pos events,
+    # which is needed whenever the journal changes at pos
+    def invalidate (self, pos):
+        if pos == 0:
+            self.checkpoints = {}
+            self.interval = self.baseInterval
+        else:
+            for p in list(self.checkpoints):
+                if p > pos:
+                    del self.checkpoints[p]
+
+    # Change the checkpoint spacing and memory cap, dropping what we have
+    def setCheckpoints (self, interval, maxCheckpoints):
+        self.baseInterval = interval
+        self.maxCheckpoints = maxCheckpoints
+        self.invalidate(0)
+
+    # Checkpoints are only a cache and the keys can be worked out from the
+    # journal, so neither is pickled
+    def __getstate__ (self):
+        state = self.__dict__.copy()
+        state['checkpoints'] = {}
+        state['keys'] = None
+        return state
+
+    # Stores pickled before checkpoints or keys existed get the defaults
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+        if 'checkpoints' not in state:
+            self.checkpoints = {}
+            self.baseInterval = 16
+            self.interval = 16
+            self.maxCheckpoints = 32
+        if 'key' not in state:
+            self.key = None
+        if self.key != None:
+            self.keys = [self.key(elem) for elem in self.journal]
+        else:
+            self.keys = None
+
     # Set a new order function
     def setOrderFunc (self, orderFunc):
         self.orderFunc = orderFunc
 
+    # Set a new key function, which is used instead of the order function.
+    # The journal is put in order by it.
+    def setKey (self, key):
+        self.key = key
+        order = sorted(range(len(self.journal)),
+                       key=lambda i: key(self.journal[i]))
+        if order != list(range(len(self.journal))):
+            self.journal[:] = [self.journal[i] for i in order]
+            self.invalidate(0)
+        self.keys = [key(elem) for elem in self.journal]
+
     # Set a new builder
     def setBuilder (self, builder):
         self.builder = builder
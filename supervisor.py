@@ -0,0 +1,185 @@
+# The supervisor, which starts the workers, runs the poller and keeps the
+# workers going: a worker that dies is started again on a new queue, with
+# whatever could be saved from its old one, so its chats carry on where
+# they were. When the poller is told to stop, the
+# workers are given until shutdown_timeout to finish what they have.
+#
+# Workers can be added and removed while running: SIGUSR1 adds one and
+# SIGUSR2 drains the newest (if there's more than one). Chats are assigned
+# to workers by a consistent-hash ring (see ring.py), so only the chats
+# that have to move do, and in order.
+
+# To time restarts and the shutdown
+from time import monotonic, sleep
+
+# To hear about workers dying, and being asked to add or drain them
+import signal
+
+# The queues, and the processes of the workers
+from multiprocessing import Process, Queue, cpu_count
+from multiprocessing.connection import wait
+from queue import Empty
+
+# The worker functions
+import worker
+
+# The poller functions
+import poller
+
+# Assigns chats to workers
+from ring import Router
+
+# How long (in seconds) workers get to finish their queues when we stop
+# before they're killed
+shutdown_timeout = 30
+
+# A worker that dies within this many seconds of starting waits this long
+# before being started again, so one that can't start doesn't spin
+restart_delay = 1
+
+# How long (in seconds) to wait for each update left on a dead worker's
+# queue when moving them to its new one
+salvage_timeout = 0.1
+
+# Workers asked for by SIGUSR1 (positive) or SIGUSR2 (negative) that we
+# haven't got to yet
+resize = 0
+
+# The number of workers to run if we aren't told, one per core since drawing
+# the boards keeps a core busy
+def defaultWorkers ():
+    return cpu_count()
+
+# Handles SIGUSR1 and SIGUSR2, which are dealt with between polls
+def askToResize (signum, frame):
+    global resize
+    if signum == signal.SIGUSR1:
+        resize += 1
+    else:
+        resize -= 1
+    poller.wake()
+
+# The workers, and what they need to start
+class Pool:
+
+    def __init__ (self, token):
+        self.token = token
+        self.acks = Queue()
+        self.router = Router(self.acks)
+        # The worker processes by ID, including any that are draining
+        self.workers = {}
+        self.nextID = 0
+
+    # Starts the worker with ID i on its queue
+    def start (self, i):
+        p = Process(target=worker.run, args=(self.router.queues[i], i,
+                                             self.token, self.acks,
+                                             len(self.router.ring.nodes)))
+        p.start()
+        p.started = monotonic()
+        self.workers[i] = p
+
+    # Gives worker i a new queue, moving onto it whatever can still be taken
+    # off its old one. A worker killed while waiting on its queue dies
+    # holding the queue's lock, so nothing can take anything off it again,
+    # and a worker started on it would wait forever. Anything left on it
+    # then is lost.
+    def renew (self, i):
+        old = self.router.queues[i]
+        queue = Queue()
+        self.router.queues[i] = queue
+        moved = 0
+        while True:
+            try:
+                queue.put(old.get(timeout=salvage_timeout))
+            except Empty:
+                break
+            moved += 1
+        print("Moved " + str(moved) + " updates to worker " + str(i) +
+              "'s new queue")
+        # Don't wait at exit for what's on the old queue to be read, as it
+        # may never be
+        old.cancel_join_thread()
+        old.close()
+
+    # Starts a new worker and gives it its share of the chats
+    def add (self):
+        i = self.nextID
+        self.nextID += 1
+        self.router.addWorker(i, Queue())
+        self.start(i)
+
+    # Moves the newest worker's chats to the others and lets it stop
+    def drain (self):
+        running = self.router.ring.nodes
+        if len(running) <= 1:
+            print("Not draining the last worker")
+            return
+        self.router.removeWorker(max(running))
+
+    # Starts again any worker that died, as opposed to finishing after being
+    # told to stop (which it does with an exit code of 0), and forgets the
+    # ones that finished. When stopping, the None it was told to stop with
+    # may have died with it, so it's told again.
+    def tend (self, stopping=False):
+        for i in list(self.workers):
+            p = self.workers[i]
+            if p.is_alive():
+                continue
+            p.join()
+            if p.exitcode == 0:
+                del self.workers[i]
+                self.router.forget(i)
+                continue
+            print("Worker " + str(i) + " died (exit code " + str(p.exitcode) +
+                  "), restarting it")
+            if monotonic() - p.started < restart_delay:
+                sleep(restart_delay)
+            self.renew(i)
+            self.start(i)
+            self.router.restarted(i)
+            if stopping or i not in self.router.ring.nodes:
+                self.router.queues[i].put(None)
+
+    # Run between polls: restarts what died and adds or drains workers as
+    # asked
+    def between (self):
+        global resize
+        self.tend()
+        while resize > 0:
+            resize -= 1
+            self.add()
+        while resize < 0:
+            resize += 1
+            self.drain()
+
+# Runs numWorkers workers and the poller until the poller is told to stop
+def run (numWorkers=None, token=None):
+    if numWorkers == None:
+        numWorkers = defaultWorkers()
+
+    pool = Pool(token)
+    for i in range(numWorkers):
+        pool.add()
+
+    # A worker dying wakes the poller up, so it's restarted between polls
+    # rather than after the next one
+    signal.signal(signal.SIGCHLD, poller.wake)
+    signal.signal(signal.SIGUSR1, askToResize)
+    signal.signal(signal.SIGUSR2, askToResize)
+    poller.run(pool.router, token, pool.between)
+
+    # The router has put None on every queue. Keep restarting workers that
+    # die before they get to it, until they've all finished or time's up.
+    deadline = monotonic() + shutdown_timeout
+    while monotonic() < deadline:
+        pool.tend(True)
+        if len(pool.workers) == 0:
+            break
+        wait([p.sentinel for p in pool.workers.values()],
+             max(0, deadline - monotonic()))
+    for p in pool.workers.values():
+        if p.is_alive():
+            print("Worker didn't finish in time, killing it")
+            p.kill()
+        p.join()
@@ -0,0 +1,131 @@
+# Checks the chain-based capture engine in board.py against the flood fill
+# it replaced. Run with
+#   python3 -m unittest test_board
+# (or pytest).
+
+import random
+import unittest
+
+from board import Board, Empty, codes, neighbours
+import events
+
+# The old engine, kept here as the reference: after a stone is placed, each
+# of its orthogonal neighbours that is part of a region of the other
+# player's stones with no empty space next to it is flooded (emptied).
+def canFlood (cells, adjacent, code, start):
+    if cells[start] == code or cells[start] == codes[Empty]:
+        return False
+    nexts = [start]
+    visited = set(nexts)
+    while len(nexts) != 0:
+        cur = nexts.pop()
+        if cells[cur] == codes[Empty]:
+            return False
+        elif cells[cur] != code:
+            for adj in adjacent[cur]:
+                if adj not in visited:
+                    visited.add(adj)
+                    nexts.append(adj)
+    return True
+
+def flood (cells, adjacent, code, start):
+    nexts = [start]
+    while len(nexts) != 0:
+        cur = nexts.pop()
+        if cells[cur] != code and cells[cur] != codes[Empty]:
+            cells[cur] = codes[Empty]
+            nexts.extend(adjacent[cur])
+
+# The cells after playing moves on an empty board of size
+def referenceCells (size, moves):
+    adjacent = neighbours(size)
+    cells = bytearray(size * size)
+    for (player, row, col) in moves:
+        index = row * size + col
+        cells[index] = codes[player]
+        for adj in adjacent[index]:
+            if canFlood(cells, adjacent, codes[player], adj):
+                flood(cells, adjacent, codes[player], adj)
+    return cells
+
+# The events of a random game, in the order they arrive: moves (played on
+# open spaces, and next to the other player half the time so there are
+# captures), bursts of undos, and now and then an event that arrives a few
+# places late
+def randomEvents (size, count, seed):
+    rng = random.Random(seed)
+    board = Board(size)
+    evts = []
+    while len(evts) < count:
+        if len(board.moves) > 0 and rng.random() < 0.05:
+            for i in range(rng.randint(1, 4)):
+                evts.append((len(evts), events.undo, None))
+                board.addEvent(evts[-1])
+            continue
+        player = ["Black", "White"][len(board.moves) % 2]
+        other = codes[["White", "Black"][len(board.moves) % 2]]
+        spaces = [i for i in range(size * size)
+                  if board.cells[i] == codes[Empty]]
+        if len(spaces) == 0:
+            break
+        near = [i for i in spaces
+                if any(board.cells[adj] == other for adj in board.adjacent[i])]
+        if len(near) > 0 and rng.random() < 0.5:
+            index = rng.choice(near)
+        else:
+            index = rng.choice(spaces)
+        evts.append((len(evts), events.move,
+                     (player, index // size, index % size)))
+        board.addEvent(evts[-1])
+    for i in range(0, len(evts), 10):
+        j = min(len(evts) - 1, i + rng.randint(1, 5))
+        evts.insert(j, evts.pop(i))
+    return evts
+
+class TestCaptures (unittest.TestCase):
+
+    # After every event, the board matches the reference replaying the
+    # moves that stand
+    def testRandomGames (self):
+        for seed in range(40):
+            size = [5, 7, 9, 13][seed % 4]
+            board = Board(size)
+            for evt in randomEvents(size, size * size, seed):
+                board.addEvent(evt)
+                self.assertEqual(bytes(board.cells),
+                                 bytes(referenceCells(size, board.moves)),
+                                 "seed %d after update %d" % (seed, evt[0]))
+
+    # A rebuild from the journal gives the same board as adding the events
+    # one at a time, in whatever order they arrived
+    def testRebuild (self):
+        for seed in range(10):
+            board = Board(9)
+            for evt in randomEvents(9, 80, seed):
+                board.addEvent(evt)
+            rebuilt = Board(9)
+            rebuilt.buildGame(board.store.log())
+            self.assertEqual(bytes(rebuilt.cells), bytes(board.cells))
+            self.assertEqual(rebuilt.moves, board.moves)
+
+    def testCapture (self):
+        board = Board(9)
+        for (i, move) in enumerate([("Black", 0, 1), ("White", 0, 0),
+                                    ("Black", 1, 0)]):
+            board.addEvent((i, events.move, move))
+        self.assertEqual(board.get(0, 0), Empty)
+        self.assertEqual(board.get(0, 1), "Black")
+
+    # A suicidal stone stays on the board, and a stone played diagonally
+    # next to it doesn't take it (the old 3x3 sweep did)
+    def testSuicideIgnoresDiagonals (self):
+        board = Board(9)
+        for (i, move) in enumerate([("Black", 0, 1), ("Black", 1, 0),
+                                    ("White", 0, 0), ("Black", 1, 1)]):
+            board.addEvent((i, events.move, move))
+        self.assertEqual(board.get(0, 0), "White")
+        self.assertEqual(bytes(board.cells),
+                         bytes(referenceCells(9, board.moves)))
+
+if __name__ == '__main__':
+    unittest.main()
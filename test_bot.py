@@ -0,0 +1,58 @@
+# Checks that the file_ids of sent images are kept across restarts of the
+# workers, with the Bot sending to the fake API in fakegram.py. Run with
+#   python3 -m unittest test_bot
+# (or pytest).
+
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+import bot
+import worker
+from fakegram import FakeTelegram
+
+class TestFileIDs (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp()
+        self.fake = FakeTelegram()
+        self.fake.start()
+        self.saved = (bot.api_base, worker.file_ids_file)
+        bot.api_base = self.fake.url()
+        worker.file_ids_file = self.directory + '/file_ids-%d.p'
+
+    def tearDown (self):
+        self.fake.stop()
+        (bot.api_base, worker.file_ids_file) = self.saved
+        shutil.rmtree(self.directory)
+
+    # A Bot as worker ourID starts it
+    def workerBot (self, ourID):
+        client = bot.Bot('fake')
+        client.loadFileIDs(worker.file_ids_file % ourID,
+                           worker.fileIDsFiles())
+        return client
+
+    # Sends the image under key to chat, and stops the Bot (which saves
+    # its file_ids)
+    def send (self, client, chat, key):
+        client.sendImage(chat_id=chat, photo=BytesIO(b'board ' + key),
+                         key=key)
+        client.close()
+
+    # An image sent by one worker is sent by its file_id by the next one to
+    # start, whatever its ID
+    def testReusedAfterReload (self):
+        self.send(self.workerBot(0), 1, b'a')
+        self.assertEqual(self.fake.reused, 0)
+        for ourID in [0, 3]:
+            client = self.workerBot(ourID)
+            self.assertIsNotNone(client.fileIDs.get(b'a'))
+            self.send(client, 2, b'a')
+            self.assertEqual(client.reused, 1)
+        self.assertEqual(self.fake.reused, 2)
+        self.assertEqual(sum(self.fake.photos.values()), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# Checks that a game's log survives a crash part way through an append.
+# Run with
+#   python3 -m unittest test_journal
+# (or pytest).
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import journal
+from journal import GameLog
+from board import Board
+import events
+
+class TestTornLog (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp() + '/'
+        board = Board(9)
+        log = GameLog(self.directory, 5)
+        # The first save is a snapshot, and the rest go in its log
+        board.addEvent((1, events.move, ("Black", 0, 0)))
+        log.append(board, [(1, events.move, ("Black", 0, 0))])
+        self.evts = [(2, events.move, ("White", 4, 4)),
+                     (3, events.move, ("Black", 2, 3)),
+                     (4, events.undo, None)]
+        for evt in self.evts:
+            board.addEvent(evt)
+        log.append(board, self.evts)
+        self.path = log.logPath()
+        self.intact = os.path.getsize(self.path)
+
+        # A record with a bad CRC, followed by half a record
+        bad = bytearray(journal.encode_event((5, events.move,
+                                              ("White", 1, 1))))
+        bad[-1] ^= 0xff
+        torn = journal.encode_event((6, events.move, ("Black", 8, 8)))
+        f = open(self.path, 'ab')
+        f.write(bytes(bad) + torn[:journal.record_size // 2])
+        f.close()
+        self.spoilt = os.path.getsize(self.path)
+        self.expected = [("Black", 0, 0), ("White", 4, 4)]
+
+    def tearDown (self):
+        shutil.rmtree(self.directory)
+
+    def contents (self):
+        f = open(self.path, 'rb')
+        data = f.read()
+        f.close()
+        return data
+
+    def testRepair (self):
+        log = GameLog(self.directory, 5)
+        board = log.load()
+        self.assertEqual(board.moves, self.expected)
+        self.assertEqual(log.records, len(self.evts))
+        self.assertEqual(log.torn, self.spoilt - self.intact)
+        self.assertEqual(os.path.getsize(self.path), self.intact)
+
+        # Appends carry on from the intact records
+        board.addEvent((7, events.move, ("Black", 6, 6)))
+        log.append(board, [(7, events.move, ("Black", 6, 6))])
+        again = GameLog(self.directory, 5)
+        self.assertEqual(again.load().moves,
+                         self.expected + [("Black", 6, 6)])
+        self.assertEqual(again.torn, 0)
+        self.assertEqual(os.path.getsize(self.path),
+                         self.intact + journal.record_size)
+
+    def testReadOnly (self):
+        before = self.contents()
+        log = GameLog(self.directory, 5)
+        board = log.load(repair=False)
+        self.assertEqual(board.moves, self.expected)
+        self.assertEqual(log.torn, self.spoilt - self.intact)
+        self.assertEqual(self.contents(), before)
+
+if __name__ == '__main__':
+    unittest.main()
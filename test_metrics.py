@@ -0,0 +1,68 @@
+# Checks what metrics.py exports, and that a process forked from the poller
+# exports only its own metrics. Run with
+#   python3 -m unittest test_metrics
+# (or pytest).
+
+import re
+import unittest
+from multiprocessing import Pipe, Process, Queue
+
+import metrics
+import poller
+from ring import Router
+
+# The names of the labels on each series in an export, by line
+def labelNames (text):
+    return [(line, re.findall(r'([a-zA-Z_]\w*)="', line))
+            for line in text.splitlines() if not line.startswith('#')]
+
+class TestFork (unittest.TestCase):
+
+    def setUp (self):
+        # The poller's metrics, as it has them while running
+        metrics.setProcess('poller', process='poller')
+        self.router = Router(Queue())
+        for node in [0, 1]:
+            self.router.addWorker(node, Queue())
+        poller.watchQueues(self.router)
+        metrics.histogram('poll_seconds').record(0.02)
+        metrics.count('updates_polled_total', 5)
+
+    def tearDown (self):
+        metrics.setProcess(None)
+
+    # Starts a worker, as the supervisor does once the poller is running,
+    # and returns what it exports
+    def workerExport (self):
+        (ours, theirs) = Pipe()
+        def run ():
+            metrics.setProcess('worker-2', worker=2)
+            metrics.histogram('handler_seconds', command='b').record(0.003)
+            theirs.send(metrics.export())
+        p = Process(target=run)
+        p.start()
+        text = ours.recv()
+        p.join()
+        return text
+
+    def testOnlyOwnMetrics (self):
+        text = self.workerExport()
+        for name in ['poll_seconds', 'updates_polled_total', 'queue_depth']:
+            self.assertNotIn(name, text)
+        self.assertIn('gobot_handler_seconds_count{worker="2",command="b"} 1',
+                      text)
+
+    def testLabelsOnce (self):
+        for (line, names) in labelNames(self.workerExport()):
+            self.assertEqual(len(names), len(set(names)), line)
+
+    # The process's own label takes the place of a series' label with the
+    # same name
+    def testProcessLabelWins (self):
+        metrics.setProcess('worker-2', worker=2)
+        metrics.setGauge('queue_depth', 3, worker=0)
+        self.assertIn('gobot_queue_depth{worker="2"} 3.0',
+                      metrics.export().splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
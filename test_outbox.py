@@ -0,0 +1,113 @@
+# Checks the token buckets and the order sends leave the outbox in
+# (outbox.py). Nothing is sent anywhere. Run with
+#   python3 -m unittest test_outbox
+# (or pytest).
+
+import asyncio
+import unittest
+
+import outbox
+from outbox import Outbox, TokenBucket, image_priority, text_priority
+
+# An Outbox that notes the chats its sends are started for, in order
+class NotingOutbox (Outbox):
+
+    def __init__ (self):
+        self.finishedCount = 0
+        Outbox.__init__(self, self.call, self.finish)
+        self.started = []
+
+    async def call (self, method, makeData):
+        return {}
+
+    def finish (self):
+        self.finishedCount += 1
+
+    def start (self, send):
+        self.started.append(send.chat)
+        Outbox.start(self, send)
+
+# Runs test with a new NotingOutbox, on an event loop as it must be
+def withOutbox (test):
+    async def run ():
+        return test(NotingOutbox())
+    return asyncio.run(run())
+
+class TestTokenBucket (unittest.TestCase):
+
+    def testRefill (self):
+        bucket = TokenBucket(2, 3, 0)
+        for i in range(3):
+            self.assertEqual(bucket.wait(0), 0)
+            bucket.take()
+        self.assertEqual(bucket.wait(0), 0.5)
+        self.assertEqual(bucket.wait(0.25), 0.25)
+        self.assertEqual(bucket.wait(0.5), 0)
+        self.assertFalse(bucket.full(1))
+        # It never holds more than its burst
+        self.assertTrue(bucket.full(10))
+        self.assertEqual(bucket.tokens, 3)
+
+class TestOutbox (unittest.TestCase):
+
+    def tearDown (self):
+        outbox.supersede = True
+
+    # An image queued behind another for the same chat replaces it, and the
+    # one replaced is done with, with no result
+    def testSupersede (self):
+        def test (box):
+            first = box.put('1', 'sendPhoto', None, image_priority, True)
+            box.put('1', 'sendMessage', None, text_priority)
+            box.put('1', 'sendPhoto', None, image_priority, True)
+            box.put('2', 'sendPhoto', None, image_priority, True)
+            self.assertEqual(box.replaced, 1)
+            self.assertEqual(box.finishedCount, 1)
+            self.assertIsNone(first.result())
+            self.assertEqual([s.method for s in box.queued['1']],
+                             ['sendMessage', 'sendPhoto'])
+            self.assertEqual(len(box.waiting), 3)
+        withOutbox(test)
+
+    def testNoSupersede (self):
+        outbox.supersede = False
+        def test (box):
+            for i in range(3):
+                box.put('1', 'sendPhoto', None, image_priority, True)
+            self.assertEqual(box.replaced, 0)
+            self.assertEqual(len(box.queued['1']), 3)
+        withOutbox(test)
+
+    # Images go before text, and otherwise sends go in the order they were
+    # made. A chat only has one send going at a time.
+    def testPriority (self):
+        def test (box):
+            box.put('a', 'sendMessage', None, text_priority)
+            box.put('b', 'sendMessage', None, text_priority)
+            box.put('c', 'sendPhoto', None, image_priority, True)
+            box.put('a', 'sendPhoto', None, image_priority, True)
+            box.put('d', 'sendPhoto', None, image_priority, True)
+            self.assertIsNone(box.startReady())
+            self.assertEqual(box.started, ['c', 'd', 'a', 'b'])
+            self.assertEqual(len(box.queued['a']), 1)
+        withOutbox(test)
+
+    # The burst is shared between the workers like the rate, so with more
+    # workers fewer sends go at once
+    def testShare (self):
+        def test (box):
+            box.share(5)
+            self.assertEqual(box.everyone.rate, outbox.global_rate / 5)
+            self.assertEqual(box.everyone.burst, outbox.global_burst / 5)
+            for chat in ['a', 'b', 'c']:
+                box.put(chat, 'sendPhoto', None, image_priority, True)
+            self.assertAlmostEqual(box.startReady(), 5 / outbox.global_rate,
+                                   places=2)
+            self.assertEqual(box.started, ['a'])
+            # However many workers there are, one send can always go
+            box.share(50)
+            self.assertEqual(box.everyone.burst, 1)
+        withOutbox(test)
+
+if __name__ == '__main__':
+    unittest.main()
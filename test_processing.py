@@ -0,0 +1,177 @@
+# Checks the command handlers in processing.py end to end, through
+# worker.handle, with sends caught rather than made. Run with
+#   python3 -m unittest test_processing
+# (or pytest).
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import processing
+import worker
+from bot import Bot
+from storage import FileStorage, SQLiteStorage
+
+# A Bot that keeps what it's asked to send
+class CaughtBot (Bot):
+
+    def __init__ (self):
+        Bot.__init__(self, '')
+        self.images = []
+        # The first bytes, file name and type of every image
+        self.files = []
+        self.messages = []
+        processing.load(self)
+
+    def sendImage (self, chat_id=None, photo=None, **kwargs):
+        self.images.append((chat_id, kwargs.get('caption')))
+        self.files.append((photo.read(3), kwargs.get('filename'),
+                           kwargs.get('content_type')))
+
+    def sendMessage (self, chat_id=None, text=None):
+        self.messages.append((chat_id, text))
+
+class HandlerTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = processing.storage
+        self.bot = CaughtBot()
+        self.updates = 0
+        processing.board_cache.clear()
+        processing.image_cache.clear()
+        processing.frames.clear()
+
+    def tearDown (self):
+        processing.storage = self.storage
+        processing.board_cache.clear()
+        processing.unreadable.clear()
+        shutil.rmtree(self.directory)
+
+    def send (self, chat, text):
+        self.updates += 1
+        worker.handle(self.bot, {'update_id': self.updates,
+                                 'message': {'chat': {'id': chat},
+                                             'text': text}})
+
+    # The chat's game as it loads from storage
+    def reload (self, chat):
+        processing.invalidate_board(chat)
+        return processing.get_board(chat)
+
+class TestUnreadable (HandlerTest):
+
+    # Plays a move on top of a game whose snapshot has been spoiled by
+    # spoil, then checks the game starts again from that move and carries
+    # on from there
+    def recovers (self, spoil):
+        chat = 9
+        self.send(chat, '/b a1')
+        self.send(chat, '/w b2')
+        spoil(chat)
+        processing.invalidate_board(chat)
+        self.send(chat, '/b c3')
+        self.assertEqual(self.reload(chat).moves, [("Black", 2, 2)])
+        self.send(chat, '/w d4')
+        self.assertEqual(self.reload(chat).moves, [("Black", 2, 2),
+                                                   ("White", 3, 3)])
+        self.assertEqual(processing.unreadable, set())
+
+    def testFiles (self):
+        processing.storage = FileStorage(self.directory + '/')
+        def spoil (chat):
+            path = os.path.join(self.directory, str(chat) + '.snap')
+            f = open(path, 'r+b')
+            f.seek(12)
+            f.write(bytes(32))
+            f.close()
+        self.recovers(spoil)
+
+    def testTruncatedFiles (self):
+        processing.storage = FileStorage(self.directory + '/')
+        def spoil (chat):
+            path = os.path.join(self.directory, str(chat) + '.snap')
+            f = open(path, 'r+b')
+            f.truncate(3)
+            f.close()
+        self.recovers(spoil)
+
+    def testSQLite (self):
+        processing.storage = SQLiteStorage(os.path.join(self.directory,
+                                                        'games.db'))
+        def spoil (chat):
+            db = processing.storage.connection()
+            db.execute('UPDATE snapshots SET board = zeroblob(40) '
+                       'WHERE chat_id = ?', (chat,))
+            db.commit()
+        self.recovers(spoil)
+
+class TestScore (HandlerTest):
+
+    # A move played as empty places no stone, and doesn't stop the board
+    # being captioned and scored
+    def testEmptyMove (self):
+        processing.storage = FileStorage(self.directory + '/')
+        chat = 4
+        for text in ['/b a1', '/move o b2', '/game', '/w c3', '/score']:
+            self.send(chat, text)
+        self.assertEqual(self.bot.images, [
+            (str(chat), "Black: 81 White: 0 (area scoring)"),
+            (str(chat), "Black: 81 White: 0 (area scoring)"),
+            (str(chat), "Black: 81 White: 0 (area scoring)"),
+            (str(chat), "Black: 1 White: 1 (area scoring)")])
+        self.assertEqual(self.bot.messages, [
+            (chat, "Black: 1 White: 1 (area scoring)\n"
+                   "Black: 0 White: 0 (territory scoring)")])
+
+class TestCommitBeforeDrawing (HandlerTest):
+
+    # Every board image is drawn with the database unlocked, coalescing
+    # or not
+    def testSQLite (self):
+        processing.storage = SQLiteStorage(os.path.join(self.directory,
+                                                        'games.db'))
+        draw = processing.board_image
+        locked = []
+        def board_image (board, hue, chat_id=None):
+            locked.append(processing.storage.connection().in_transaction)
+            return draw(board, hue, chat_id)
+        processing.board_image = board_image
+        processing.batch_commits = True
+        try:
+            processing.start_batch()
+            for chat in range(3):
+                self.send(chat, '/b a1')
+                self.send(chat, '/w b2')
+            processing.finish_batch(self.bot)
+            self.send(0, '/b c3')
+            self.send(1, '/game')
+        finally:
+            processing.board_image = draw
+            processing.batch_commits = False
+        self.assertEqual(locked, [False] * 5)
+        self.assertEqual(len(self.bot.images), 5)
+        self.assertEqual(self.reload(0).moves, [("Black", 0, 0),
+                                                ("White", 1, 1),
+                                                ("Black", 2, 2)])
+
+class TestEncoding (HandlerTest):
+
+    # An image too big for Telegram is sent as the JPEG it was made into,
+    # and named as one
+    def testOversize (self):
+        processing.storage = FileStorage(self.directory + '/')
+        self.send(1, '/b a1')
+        limit = processing.max_image_bytes
+        processing.max_image_bytes = 100
+        try:
+            self.send(2, '/b a1')
+        finally:
+            processing.max_image_bytes = limit
+        self.assertEqual(self.bot.files, [
+            (b'\x89PN', 'board-image.png', 'image/png'),
+            (b'\xff\xd8\xff', 'board-image.jpg', 'image/jpeg')])
+
+if __name__ == '__main__':
+    unittest.main()
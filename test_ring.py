@@ -0,0 +1,143 @@
+# Checks that the router (ring.py) moves chats between workers in order as
+# workers come and go, with the workers played here and their
+# acknowledgements held back. Run with
+#   python3 -m unittest test_ring
+# (or pytest).
+
+import unittest
+from queue import Queue, Empty
+
+from ring import Router
+
+# Everything on a queue, in order
+def takeAll (queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            return items
+
+class TestRouter (unittest.TestCase):
+
+    def setUp (self):
+        self.acks = Queue()
+        self.router = Router(self.acks, vnodes=16)
+        self.chats = list(range(1, 61))
+        self.nextID = 1
+        # The update_ids each chat's updates were handled in, in the order
+        # they were handled
+        self.handled = {chat: [] for chat in self.chats}
+        # Acknowledgements the workers have made that haven't been sent yet
+        self.unsent = []
+        for node in [0, 1]:
+            self.router.addWorker(node, Queue())
+        self.work(0)
+        self.work(1)
+        self.sendAcks()
+
+    # Hands the router an update for every chat
+    def round (self):
+        for chat in self.chats:
+            self.router.dispatch({'update_id': self.nextID,
+                                  'message': {'chat': {'id': chat}}})
+            self.nextID += 1
+
+    # Worker node handles everything on its queue. Its acknowledgements of
+    # any barriers are kept back until sendAcks.
+    def work (self, node):
+        for update in takeAll(self.router.queues[node]):
+            if update == None:
+                continue
+            if 'barrier' in update:
+                self.unsent.append((node, update['barrier']))
+                continue
+            chat = update['message']['chat']['id']
+            self.handled[chat].append(update['update_id'])
+
+    def sendAcks (self):
+        for ack in self.unsent:
+            self.acks.put(ack)
+        self.unsent = []
+        self.router.collect()
+
+    # Every update so far has been handled once, and each chat's in order
+    def checkHandled (self):
+        for chat in self.chats:
+            self.assertEqual(self.handled[chat],
+                             list(range(chat, self.nextID, len(self.chats))),
+                             "chat %d" % chat)
+
+    def testAddWorker (self):
+        self.round()
+        self.router.addWorker(2, Queue())
+        moved = [chat for chat in self.chats
+                 if self.router.ring.nodeFor(chat) == 2]
+        self.assertTrue(len(moved) > 0)
+        self.round()
+        # The new worker gets there first, but has nothing of the chats that
+        # moved to it until their old owners have caught up
+        self.work(2)
+        self.assertEqual(sum(len(self.handled[chat]) for chat in moved), 0)
+        self.assertTrue(self.router.holding())
+        self.work(0)
+        self.work(1)
+        self.round()
+        self.work(2)
+        self.assertTrue(self.router.holding())
+        for chat in moved:
+            self.assertEqual(len(self.handled[chat]), 1)
+
+        # Once they have, what was held goes to the new worker in order
+        self.sendAcks()
+        self.assertFalse(self.router.holding())
+        self.round()
+        for node in [2, 0, 1]:
+            self.work(node)
+        self.checkHandled()
+
+    def testRemoveWorker (self):
+        self.router.addWorker(2, Queue())
+        self.work(0)
+        self.work(1)
+        self.sendAcks()
+        self.round()
+        moving = [chat for chat in self.chats
+                  if self.router.ring.nodeFor(chat) == 2]
+        self.router.removeWorker(2)
+        self.round()
+        # Worker 2's chats wait for it to finish what it had
+        self.work(0)
+        self.work(1)
+        self.sendAcks()
+        self.assertTrue(self.router.holding())
+        for chat in moving:
+            self.assertEqual(self.handled[chat], [])
+        self.work(2)
+        self.sendAcks()
+        self.assertFalse(self.router.holding())
+        self.router.forget(2)
+        self.assertNotIn(2, self.router.queues)
+        self.round()
+        self.work(0)
+        self.work(1)
+        self.checkHandled()
+
+    # A restarted worker is only sent the barrier again if it hasn't
+    # acknowledged it
+    def testRestarted (self):
+        self.router.addWorker(2, Queue())
+        self.work(0)
+        self.work(1)
+        # Worker 0 acknowledges the barrier, and worker 1 dies before it can
+        self.acks.put(self.unsent[0])
+        self.router.collect()
+        for node in [0, 1, 2]:
+            self.router.restarted(node)
+        self.assertEqual(takeAll(self.router.queues[0]), [])
+        self.assertEqual(takeAll(self.router.queues[2]), [])
+        self.assertEqual(takeAll(self.router.queues[1]),
+                         [self.router.barrier()])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# Checks the keyed journal in store.py: that merging a batch in with
+# bulk_insert gives the same journal as inserting it one element at a time,
+# and drops the checkpoints the merge changed. Run with
+#   python3 -m unittest test_store
+# (or pytest).
+
+import random
+import unittest
+
+from store import Store
+
+# Elements are (key, tag) pairs, so ones with the same key can be told apart
+def elemKey (elem):
+    return elem[0]
+
+# count elements with keys up to keys, so plenty of them share one
+def randomElems (rng, count, keys, tag):
+    return [(rng.randint(0, keys), (tag, i)) for i in range(count)]
+
+class TestBulkInsert (unittest.TestCase):
+
+    # Elements with the same key end up in the order they came, before or
+    # after the batch, as with insert
+    def testSameAsInsert (self):
+        for seed in range(50):
+            rng = random.Random(seed)
+            before = randomElems(rng, rng.randint(0, 30), 20, 'journal')
+            batch = randomElems(rng, rng.randint(0, 30), 20, 'batch')
+            one = Store(key=elemKey)
+            many = Store(key=elemKey)
+            for elem in before:
+                one.insert(elem)
+                many.insert(elem)
+            for elem in batch:
+                one.insert(elem)
+            many.bulk_insert(batch)
+            self.assertEqual(many.log(), one.log(), "seed %d" % seed)
+            self.assertEqual(many.keys, [k for (k, tag) in one.log()])
+
+    # The position returned is the first that changed, and only the
+    # checkpoints reflecting more than that are dropped
+    def testCheckpoints (self):
+        for seed in range(50):
+            rng = random.Random(seed)
+            store = Store(key=elemKey, interval=4, maxCheckpoints=100)
+            for elem in randomElems(rng, 40, 20, 'journal'):
+                store.insert(elem)
+            for pos in range(4, 41, 4):
+                store.checkpoint(pos, pos)
+            old = list(store.log())
+            start = store.bulk_insert(randomElems(rng, 5, 25, 'batch'))
+            new = store.log()
+            self.assertEqual(new[:start], old[:start], "seed %d" % seed)
+            if start < len(old):
+                self.assertNotEqual(new[start], old[start], "seed %d" % seed)
+            self.assertEqual(sorted(store.checkpoints),
+                             [pos for pos in range(4, 41, 4) if pos <= start],
+                             "seed %d" % seed)
+
+    # A batch that all goes on the end changes nothing before it
+    def testAppend (self):
+        store = Store(key=elemKey)
+        for i in range(8):
+            store.insert((i, i))
+        store.checkpoint(8, 'all')
+        self.assertEqual(store.bulk_insert([(9, 'b'), (8, 'a')]), 8)
+        self.assertEqual(store.log()[8:], [(8, 'a'), (9, 'b')])
+        self.assertEqual(store.checkpoints, {8: 'all'})
+
+if __name__ == '__main__':
+    unittest.main()
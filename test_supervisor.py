@@ -0,0 +1,100 @@
+# Checks the supervisor's pool of workers, running real worker processes
+# against the fake API in fakegram.py. Run with
+#   python3 -m unittest test_supervisor
+# (or pytest).
+
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+from time import monotonic, sleep
+
+import bot
+import metrics
+import processing
+import supervisor
+import worker
+from fakegram import FakeTelegram, moveText
+from storage import FileStorage
+
+class TestRestart (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp()
+        self.fake = FakeTelegram()
+        self.fake.start()
+        self.saved = (bot.api_base, processing.storage, worker.file_ids_file,
+                      metrics.stats_file)
+        # What the workers use is set here, before they're forked
+        bot.api_base = self.fake.url()
+        processing.storage = FileStorage(self.directory + '/')
+        worker.file_ids_file = self.directory + '/file_ids-%d.p'
+        metrics.stats_file = None
+        self.pool = supervisor.Pool('fake')
+        for i in range(2):
+            self.pool.add()
+        # Until the first worker has passed the barrier for the second, the
+        # updates of the chats that moved would be held
+        while len(self.pool.router.transitions) > 0:
+            self.pool.router.collect(1)
+
+    def tearDown (self):
+        self.pool.router.stop(0)
+        for p in self.pool.workers.values():
+            p.join(10)
+            if p.is_alive():
+                p.kill()
+                p.join()
+        self.fake.stop()
+        (bot.api_base, processing.storage, worker.file_ids_file,
+         metrics.stats_file) = self.saved
+        shutil.rmtree(self.directory)
+
+    # Hands a move in chat to the workers, as the poller would
+    def play (self, chat, player, row, col):
+        with self.fake.changed:
+            update = {'update_id': self.fake.nextUpdate,
+                      'message': {'chat': {'id': chat},
+                                  'text': moveText(player, row, col)}}
+            self.fake.nextUpdate += 1
+        self.pool.router.dispatch(update)
+
+    # Waits until every chat in chats has been sent more photos than it had
+    # in before, returning whether they were within timeout seconds
+    def waitForPhotos (self, chats, before, timeout):
+        deadline = monotonic() + timeout
+        with self.fake.changed:
+            while any(self.fake.photos.get(chat, 0) <= before.get(chat, 0)
+                      for chat in chats):
+                if monotonic() >= deadline:
+                    return False
+                self.fake.changed.wait(deadline - monotonic())
+        return True
+
+    # A worker killed while waiting on its queue is started again, and the
+    # chats it had are still answered
+    def testKillIdleWorker (self):
+        ring = self.pool.router.ring
+        chats = [chat for chat in range(1, 100) if ring.nodeFor(chat) == 0][:4]
+        others = [chat for chat in range(1, 100) if ring.nodeFor(chat) == 1][:4]
+        for chat in chats + others:
+            self.play(chat, "Black", 0, 0)
+        self.assertTrue(self.waitForPhotos(chats + others, {}, 30))
+
+        # Once it's sent its replies, worker 0 has nothing to do but wait on
+        # its queue
+        sleep(0.5)
+        dead = self.pool.workers[0]
+        os.kill(dead.pid, signal.SIGKILL)
+        dead.join()
+        self.pool.tend()
+        self.assertIsNot(self.pool.workers[0], dead)
+
+        before = dict(self.fake.photos)
+        for chat in chats + others:
+            self.play(chat, "White", 1, 1)
+        self.assertTrue(self.waitForPhotos(chats + others, before, 30))
+
+if __name__ == '__main__':
+    unittest.main()
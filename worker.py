@@ -1,86 +1,219 @@
 # The worker that processes messages passed to it from the poller.
-# Assumes it's one of many workers but has a dedicated queue.
-# It's ID is passed to it as an argument.
+# Assumes it's one of many workers, each with a dedicated queue that the
+# poller puts the updates of its chats on.
 
-# Nice way to make HTTP get requests
-import requests
+# To ignore signals meant for the poller
+import signal
 
-# To read arguments
-import sys
+# To time the coalescing window, how long we've been running and how long
+# the handlers take
+from time import monotonic, perf_counter
 
-# For our queues
-from collections import deque
+# For waiting on our queue
+from queue import Empty
 
-# To lock and unlock files
-import fcntl
-
-# To read/write files
-import os
-
-# To serialize/deserialize objects
-import pickle
-
-# To yield
-from time import sleep
+# To find the file_ids every worker has saved
+from glob import glob
 
 # Our class definitions
-from bot import Bot
+from bot import Bot, Update
+
+# To work out which chats are still ours
+from ring import Ring
 
 # Our command definitions
+import processing
 from processing import load
 
-# Gives the queue file name for queue i
-def queueName (i):
-    return queueDir + '/' + str(i) + '_queue.p'
-
-# Check to see if we've been canceled
-def canceled ():
-    f = open('cancel.txt', 'r')
-    done = f.readline.strip()
-    f.close()
-    return done == 'Yes'
-
-# Gets the queue that was written and write out what's left (hopefully nothing)
-# Replaces the work queue
-def getMessages ():
-    f = open(queueName(ourID), 'r+')
-    fcntl.flock(f, fcntl.LOCK_EX)
-    workQueue = pickle.load(f)
-    pickle.dump(deque(), f, pickle.HIGHEST_PROTOCOL)
-    fcntl.flock(f, fcntl.LOCK_UN)
-    f.close()
-
-# Package as a function to be run in go-lite-bot.py
-def run ():
-    # For ease of configuration, we pull our token from a text file located in the same directory
-    f = open('token.txt', 'r')
-    token = f.readline().strip()
-    f.close()
-
-    # Process our arguments, which should be safe since they're passed by start
-    queueDir = sys.argv[1]
-    ourID    = int(sys.argv[2])
+# What we've been doing, for Prometheus
+import metrics
+
+# The most updates handled before committing their saves
+max_batch = 100
+
+# Whether to coalesce the updates of a batch, so that a burst of moves in
+# a chat is applied together, saved once and answered with one image
+coalesce = True
+
+# How long (in seconds) to wait for more updates after one arrives, so that
+# bursts end up in one batch. 0 only batches what's already waiting.
+coalesce_window = 0.05
+
+# Where each worker keeps the file_ids of the images it's sent, by its ID
+# (see Bot.loadFileIDs). A worker starts with every worker's, as the IDs
+# (and which chats each worker has) change when workers are added and
+# removed.
+file_ids_file = 'file_ids-%d.p'
+
+# Waits for updates on queue, returning the first to arrive along with any
+# others that arrive within window seconds of it (up to max_batch in all).
+# Returns an empty list if nothing arrives within timeout seconds (None
+# waits for as long as it takes). The None that tells us to stop, and
+# barriers, are returned like updates and end the batch.
+def getMessages (queue, timeout=None, window=0):
+    try:
+        updates = [queue.get(timeout=timeout)]
+    except Empty:
+        return []
+    deadline = monotonic() + window
+    while len(updates) < max_batch and isUpdate(updates[-1]):
+        try:
+            left = deadline - monotonic()
+            if left > 0:
+                updates.append(queue.get(timeout=left))
+            else:
+                updates.append(queue.get_nowait())
+        except Empty:
+            break
+    return updates
+
+# The files every worker's file_ids are kept in, whatever their IDs
+def fileIDsFiles ():
+    return sorted(glob(file_ids_file.replace('%d', '*')))
+
+# Whether something from our queue is an update, rather than None or a
+# barrier
+def isUpdate (update):
+    return update != None and 'barrier' not in update
+
+# Runs the handler for an update (a dict as the poller got it), if it's a
+# command we know
+def handle (bot, update):
+    text = update['message'].get('text', '')
+    # Only process if it's a command
+    if not text.startswith('/'):
+        return
+    words = text[1:].split()
+    if len(words) == 0:
+        return
+    # In groups commands can be addressed to us as /command@botname
+    command = words[0].split('@')[0]
+    if command in bot.handlers:
+        start = perf_counter()
+        try:
+            bot.handlers[command](bot, Update(update), words[1:])
+        except Exception as ex:
+            print("Error handling " + command + "!")
+            print("exception: " + str(ex))
+            metrics.count('handler_errors_total', command=command)
+        metrics.histogram('handler_seconds', command=command).record(
+            perf_counter() - start)
+        metrics.count('updates_total', command=command)
+
+# Prints how much coalescing saved
+def printCoalescing (ourID):
+    counts = processing.coalescing
+    print("Worker " + str(ourID) + " saved " +
+          str(counts['saves asked'] - counts['saves made']) + " of " +
+          str(counts['saves asked']) + " saves and " +
+          str(counts['images asked'] - counts['images sent']) + " of " +
+          str(counts['images asked']) + " images by coalescing")
+
+# Prints how the sends went over the seconds we ran for
+def printSends (ourID, bot, seconds):
+    replaced = 0
+    if bot.outbox != None:
+        replaced = bot.outbox.replaced
+    print("Worker " + str(ourID) + " sent " + str(bot.sent) + ", retried " +
+          str(bot.retries) + ", gave up on " + str(bot.failed) +
+          " and replaced " + str(replaced) + " images before they went")
+    print("Worker " + str(ourID) + " uploaded " + str(bot.uploaded) +
+          " images (" + str(bot.uploadedBytes) + " bytes) and reused " +
+          str(bot.reused) + " (saving %.1f MB an hour)" %
+          (bot.savedBytes / 1e6 * 3600 / max(seconds, 1)))
+
+# Prints how long things took, from our metrics
+def printMetrics (ourID):
+    for line in metrics.summary():
+        print("Worker " + str(ourID) + " " + line)
+
+# Has our metrics export how our caches and Bot's outbox are doing
+def watchCaches (bot):
+    metrics.watchCache('images', processing.image_cache)
+    metrics.watchCache('boards', processing.board_cache)
+    metrics.watchCache('frames', processing.frames)
+    metrics.watchCache('file_ids', bot.fileIDs)
+    def collect ():
+        if bot.outbox != None:
+            metrics.setGauge('outbox_waiting', len(bot.outbox.waiting))
+    metrics.collectors.append(collect)
+
+# Handles a barrier from the router (see ring.py): everything before it
+# has been handled, so we save it, finish sending its replies (so none of
+# them can arrive after the next worker's), forget the chats that are no
+# longer ours and say we've got here on acks. Our share of the rate limit
+# changes with the number of workers.
+def passBarrier (barrier, ourID, acks, bot):
+    processing.commit_saves()
+    bot.flush()
+    bot.share(len(barrier['workers']))
+    ring = Ring(barrier['workers'], barrier['vnodes'])
+    processing.forget_chats(lambda chat: ring.nodeFor(chat) == ourID)
+    acks.put((ourID, barrier['barrier']))
+
+# Package as a function for the supervisor to run, with our queue, ID and
+# the queue to acknowledge barriers on, and how many workers there are.
+# Runs until it takes None off the queue.
+def run (queue, ourID, token=None, acks=None, workers=1):
+    # A Ctrl-C or SIGTERM sent to all of us is the poller's to handle. It
+    # stops putting updates on our queue and puts None at the end, so we
+    # carry on until we've handled everything before it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
 
-    # Our overall work queue
-    workQueue = deque()
+    # For ease of configuration, we pull our token from a text file located in the same directory
+    if token == None:
+        f = open('token.txt', 'r')
+        token = f.readline().strip()
+        f.close()
 
     # Initialize our bot
     bot = Bot(token)
+    bot.share(workers)
+    bot.loadFileIDs(file_ids_file % ourID, fileIDsFiles())
+    started = monotonic()
+
+    # Our stats go in a file of our own
+    metrics.setProcess('worker-' + str(ourID), worker=ourID)
+    watchCaches(bot)
+    batchTime = metrics.histogram('batch_seconds')
+    # While there's nothing to do we still wake up now and then to write
+    # them
+    timeout = None
+    if metrics.stats_file != None:
+        timeout = metrics.write_every
 
     # Load all of our event handlers into our Worker
     load(bot)
 
-    # Continually process incoming updates
-    while not canceled():
-        getMessages()
-        for i in range(len(workQueue)):
-            update = workQueue[i]
-            # Only process if it's a command
-            if update.message.text[0] == '/':
-                command = update.message.text[1:].split()[0]
-                if command in bot.handlers:
-                    args = update.message.text[1:].split()[1:]
-                    bot.handlers[command](bot, update, args)
-
-
-
+    # Saves are committed once per batch of updates rather than one by one
+    processing.batch_commits = True
+
+    # Continually process incoming updates. Each batch is coalesced, so
+    # every chat in it is saved once and sent at most one image.
+    while True:
+        updates = getMessages(queue, timeout=timeout, window=coalesce_window)
+        if len(updates) == 0:
+            metrics.writeIfDue()
+            continue
+        start = perf_counter()
+        if coalesce:
+            processing.start_batch()
+        for update in updates:
+            if isUpdate(update):
+                handle(bot, update)
+        processing.finish_batch(bot)
+        processing.commit_saves()
+        batchTime.record(perf_counter() - start)
+        metrics.writeIfDue()
+        last = updates[-1]
+        if last == None:
+            bot.close()
+            printCoalescing(ourID)
+            printSends(ourID, bot, monotonic() - started)
+            printMetrics(ourID)
+            metrics.writeIfDue(force=True)
+            return
+        if 'barrier' in last:
+            passBarrier(last, ourID, acks, bot)